@@ -45,4 +45,10 @@ def sender():
     send_msg(socket, 'Short message')
 
 print('Timing loop for %d messages:' % loop_count)
-print(timeit.timeit("sender()", setup="from __main__ import sender"))
+elapsed = timeit.timeit("sender()", setup="from __main__ import sender",
+                        number=loop_count)
+print('%.6f secs, %.0f msgs/sec' % (elapsed, loop_count / elapsed))
+
+# Wait for the queued messages to reach the server.
+socket.close()
+context.term()
@@ -4,12 +4,19 @@
     and socket typed.
 
     Usage:
-        ./logging_server_timing.py
+        ./log_server_timing.py  count
+
+    The arg "count" is the number of logs to time,
+    like the count of log_client_timing.py. The
+    clock starts with the first log received.
+
+    Omitting "count" results in a loop_count of 10000.
 
     Terminate this program with Ctrl-C.
 """
 
 import sys
+import time
 from datetime import datetime
 
 import zmq
@@ -29,11 +36,21 @@ socket = context.socket(zmq.PULL)
 # Bind the socket to the port
 socket.bind('tcp://*:%s' % PORT)
 
-while True:
-    # Discard envelop
-    socket.recv()
+loop_count = 10000  # Default loop count
+if len(sys.argv) > 1:
+    # User has requested a specfic loop count.
+    loop_count = int(sys.argv[1])
+
+# A PUSH socket sends each log as a single frame.
+msg = socket.recv()
+start = time.time()
+for ndx in xrange(loop_count - 1):
     msg = socket.recv()
     msg_timestamp = '%s %s\n' % (str(datetime.now()), msg)
     #log_file_handle.write(msg_timestamp)
     #log_file_handle.flush() # Insist on writing immediately
+elapsed = time.time() - start
+
+print('Received %d messages:' % loop_count)
+print('%.6f secs, %.0f msgs/sec' % (elapsed, (loop_count - 1) / elapsed))
 
@@ -0,0 +1,494 @@
+#!/usr/bin/env python
+def usage(exit_code):
+    print(' '.join(sys.argv) + """\n
+Benchmark log_server.py and log_client.py together.
+
+Every combination of the swept settings gets a run.
+Each run starts a fresh log_server and the clients
+as local processes, waits for every log to be
+received, then stops the server and measures:
+    records_per_sec  - logs received per second,
+                       first client start to last log
+    mb_per_sec       - log bytes received per second
+    p50, p99, p999   - delivery latency in seconds,
+                       from log_client --send-time.
+                       null with batch size 1: send
+                       times would need batch framing,
+                       so the plain single log path
+                       gets measured instead.
+    server_cpu       - server user + system CPU seconds
+    server_rss_kb    - server peak resident memory
+    client_cpu       - CPU seconds of all clients
+    lost             - logs sent but never received
+    failed           - why the run failed, if it did
+
+A run fails when a client or the server does not exit
+cleanly, the server stops answering, or any log gets
+lost. Failed runs get reported with the rest.
+
+The results get written as JSON. With a baseline,
+the runs of the baseline with the same settings
+get compared and any regression gets reported.
+
+Usage:
+    ./bench/log_bench.py [--count=N] [--sizes=N,...]
+        [--clients=N,...] [--batch-sizes=N,...]
+        [--transports=tcp,ipc] [--flush=policy,...]
+        [--repeat=N] [--output=aname]
+        [--baseline=aname] [--save-baseline=true/false]
+        [--tolerance=fraction]
+
+Where:
+    --count=N         - Logs sent by each client.
+                        Default: 20000
+    --sizes=N,...     - Log message sizes in bytes.
+                        Default: 16,256
+    --clients=N,...   - Number of client processes.
+                        Default: 1,4
+    --batch-sizes=N,... - log_client --batch-size values.
+                        Default: 1,100
+    --transports=t,... - tcp and/or ipc.
+                        Default: tcp,ipc
+    --flush=policy,... - Server flush policies:
+                          every    - flush every batch
+                          bytes    - flush every 1MB
+                          interval - flush every 100ms
+                          none     - leave it to the OS
+                        Default: every,interval
+    --repeat=N        - Runs of each combination. The run
+                        with the median records_per_sec
+                        gets reported.
+                        Default: 1
+    --output=aname    - Write the results to this file.
+                        Default: print them
+    --baseline=aname  - Compare with the results in this file.
+                        Default: bench/baseline.json if present
+    --save-baseline=true/false - Write the results to the
+                        baseline file as well, unless a
+                        run failed.
+                        Default: false
+    --tolerance=fraction - A run regresses when its
+                        records_per_sec drops or its p99
+                        grows by more than this fraction.
+                        Default: 0.1
+
+Run from the ch05 directory.
+
+Return codes:
+    0 - No regressions
+    1 - Invalid command line
+    2 - At least one run failed
+    3 - At least one run regressed against the baseline
+    """)
+    sys.exit(exit_code)
+
+
+import itertools
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+# The bench runs log_server.py and log_client.py
+# found in the directory above this one.
+CH05_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, CH05_DIR)
+
+from log_control import send_control
+
+LOG_SERVER_NAME = os.path.join(CH05_DIR, 'log_server.py')
+LOG_CLIENT_NAME = os.path.join(CH05_DIR, 'log_client.py')
+
+DEFAULT_BASELINE = os.path.join(CH05_DIR, 'bench', 'baseline.json')
+
+# log_server options for each --flush policy
+FLUSH_POLICIES = {
+    'every': ['--flush-every-n=1'],
+    'bytes': ['--flush-every-n=0', '--flush-bytes=1048576'],
+    'interval': ['--flush-every-n=0', '--flush-interval-ms=100'],
+    'none': ['--flush-every-n=0'],
+}
+
+# Settings swept, in the order they vary in the results
+SWEEP_KEYS = ['size', 'clients', 'batch_size', 'transport', 'flush']
+
+# Longest wait for the server to exit, in secs
+RUN_TIMEOUT = 120.0
+
+# Once the clients have exited, secs without a new log
+# arriving before the rest count as lost
+IDLE_TIMEOUT = 2.0
+
+
+def positive_int(opt, arg):
+    """Answer arg as a positive integer.
+    Invalid values print the usage and exit."""
+    try:
+        value = int(arg)
+        if value < 1:
+            raise ValueError('must be at least 1')
+    except ValueError as err:
+        print('Invalid %s value:%s' % (opt, err))
+        usage(1)
+    return value
+
+
+def int_list(opt, arg):
+    """Answer a comma separated list of positive integers.
+    Invalid values print the usage and exit."""
+    try:
+        values = [int(value) for value in arg.split(',')]
+        if [value for value in values if value < 1]:
+            raise ValueError('must be at least 1')
+    except ValueError as err:
+        print('Invalid %s value:%s' % (opt, err))
+        usage(1)
+    return values
+
+
+def choice_list(opt, arg, choices):
+    """Answer a comma separated list of values from choices.
+    Invalid values print the usage and exit."""
+    values = arg.split(',')
+    for value in values:
+        if value not in choices:
+            print('Invalid %s value:%s' % (opt, value))
+            usage(1)
+    return values
+
+
+def process_cmd_line(argv):
+    """
+    Command line code to handle user params
+    """
+
+    params = {
+        # Logs sent by each client
+        'count': 20000,
+
+        # Settings to sweep
+        'size': [16, 256],
+        'clients': [1, 4],
+        'batch_size': [1, 100],
+        'transport': ['tcp', 'ipc'],
+        'flush': ['every', 'interval'],
+
+        # Runs of each combination
+        'repeat': 1,
+
+        # Results file. None means print them.
+        'output': None,
+
+        # Baseline to compare with
+        'baseline': None,
+        'save_baseline': False,
+
+        # Fraction a result may get worse before it regresses
+        'tolerance': 0.1,
+    }
+
+    import getopt
+    try:
+        opts, _ = getopt.gnu_getopt(
+                argv, '',
+                    ['count=',      # Logs per client
+                     'sizes=',      # Message sizes
+                     'clients=',    # Client counts
+                     'batch-sizes=',        # Client batch sizes
+                     'transports=', # tcp, ipc
+                     'flush=',      # Server flush policies
+                     'repeat=',     # Runs of each combination
+                     'output=',     # Results file
+                     'baseline=',   # Baseline file
+                     'save-baseline=',      # Write the baseline
+                     'tolerance=',  # Allowed regression
+                     'help'         # Print help message then exit.
+                     ])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage(1)
+
+    for opt, arg in opts:
+        if opt == '--help':
+            usage(0)
+        if opt in ['--count', '--repeat']:
+            params[opt[2:]] = positive_int(opt, arg)
+            continue
+        if opt == '--sizes':
+            params['size'] = int_list(opt, arg)
+            continue
+        if opt == '--clients':
+            params['clients'] = int_list(opt, arg)
+            continue
+        if opt == '--batch-sizes':
+            params['batch_size'] = int_list(opt, arg)
+            continue
+        if opt == '--transports':
+            params['transport'] = choice_list(opt, arg, ['tcp', 'ipc'])
+            continue
+        if opt == '--flush':
+            params['flush'] = choice_list(opt, arg, FLUSH_POLICIES)
+            continue
+        if opt == '--output':
+            params['output'] = arg
+            continue
+        if opt == '--baseline':
+            params['baseline'] = arg
+            continue
+        if opt == '--save-baseline':
+            params['save_baseline'] = True if arg.lower() == 'true' else False
+            continue
+        if opt == '--tolerance':
+            try:
+                params['tolerance'] = float(arg)
+            except ValueError as err:
+                print('Invalid --tolerance value:%s' % err)
+                usage(1)
+            continue
+
+    if params['baseline'] is None and \
+            (params['save_baseline'] or os.path.isfile(DEFAULT_BASELINE)):
+        params['baseline'] = DEFAULT_BASELINE
+    return params
+
+
+def free_port():
+    """Answer a local tcp port nobody is listening on."""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_rusage(proc):
+    """Wait for proc to exit. Answers its resource usage.
+    Sets proc.returncode as subprocess would: the exit
+    status, or minus the signal that killed it."""
+    _, status, rusage = os.wait4(proc.pid, 0)
+    if os.WIFEXITED(status):
+        proc.returncode = os.WEXITSTATUS(status)
+    else:
+        proc.returncode = -os.WTERMSIG(status)
+    return rusage
+
+
+def runs(params):
+    """Yield a dict of settings for every combination
+    of the swept settings."""
+    for values in itertools.product(*[params[key] for key in SWEEP_KEYS]):
+        yield dict(zip(SWEEP_KEYS, values))
+
+
+def run_key(run):
+    """Answer the settings of a run as a string, to match
+    runs of the results with runs of the baseline."""
+    return ' '.join(['%s=%s' % (key, run[key]) for key in SWEEP_KEYS])
+
+
+def wait_for_records(control, expected, idle_timeout=IDLE_TIMEOUT):
+    """Poll the server stats until expected logs have been
+    received or none has arrived for idle_timeout secs.
+    Answers the last stats and the time the last log
+    was seen to arrive, (None, None) if the server stops
+    answering."""
+    received = -1
+    while True:
+        reply = send_control(control, 'stats')
+        if reply is None:
+            return None, None
+        stats = json.loads(reply)
+        now = time.time()
+        if stats['records_received'] != received:
+            received = stats['records_received']
+            last_change = now
+        if received >= expected or now - last_change > idle_timeout:
+            return stats, last_change
+        time.sleep(0.01)
+
+
+def bench_run(run, count, work_dir):
+    """Run the server and clients for one combination of
+    settings. Answers the run settings with its results.
+    failed lists why the run failed, if it did."""
+    log_filename = os.path.join(work_dir, 'bench.log')
+    control = 'ipc://%s/control' % work_dir
+    if run['transport'] == 'tcp':
+        endpoint = 'tcp://127.0.0.1:%d' % free_port()
+    else:
+        endpoint = 'ipc://%s/data' % work_dir
+    expected = count * run['clients']
+    failed = []
+    result = dict(run)
+    result.update({
+        'records': 0,
+        'lost': expected,
+        'elapsed': 0.0,
+        'records_per_sec': 0.0,
+        'mb_per_sec': 0.0,
+        'p50': None,
+        'p99': None,
+        'p999': None,
+        'server_cpu': 0.0,
+        'server_rss_kb': 0,
+        'client_cpu': 0.0,
+        'failed': failed,
+    })
+
+    devnull = open(os.devnull, 'w')
+    server = subprocess.Popen(
+            [sys.executable, LOG_SERVER_NAME,
+             '--log=%s' % log_filename, '--log-append=false',
+             '--bind=%s' % endpoint, '--control=%s' % control] +
+            FLUSH_POLICIES[run['flush']],
+            stdout=devnull, cwd=CH05_DIR)
+    if send_control(control, 'stats', timeout=10000) is None:
+        server.kill()
+        wait_rusage(server)
+        devnull.close()
+        failed.append('log_server did not start')
+        return result
+
+    # Send times need batch framing. Leave them out so batch
+    # size 1 measures the plain one log per message path.
+    latency = run['batch_size'] > 1
+    log_msg = 'x' * run['size']
+    start = time.time()
+    clients = [subprocess.Popen(
+            [sys.executable, LOG_CLIENT_NAME,
+             '--endpoint=%s' % endpoint, '--count=%d' % count,
+             '--log_msg=%s' % log_msg,
+             '--batch-size=%d' % run['batch_size'],
+             '--send-time=%s' % str(latency).lower()],
+            stdout=devnull, cwd=CH05_DIR)
+            for _ in range(run['clients'])]
+    client_cpu = 0.0
+    for client in clients:
+        rusage = wait_rusage(client)
+        client_cpu += rusage.ru_utime + rusage.ru_stime
+    stats, finish = wait_for_records(control, expected)
+    if stats is None or \
+            send_control(control, 'exit', timeout=RUN_TIMEOUT * 1000) is None:
+        failed.append('log_server stopped answering')
+        server.kill()
+    rusage = wait_rusage(server)
+    devnull.close()
+    failed.extend(['%s exited with %d' % (os.path.basename(proc_name),
+                                          proc.returncode)
+                   for proc, proc_name in [(client, LOG_CLIENT_NAME)
+                                           for client in clients] +
+                                          [(server, LOG_SERVER_NAME)]
+                   if proc.returncode != 0])
+    result.update({
+        'server_cpu': rusage.ru_utime + rusage.ru_stime,
+        'server_rss_kb': rusage.ru_maxrss,
+        'client_cpu': client_cpu,
+    })
+    if stats is None:
+        return result
+
+    elapsed = finish - start
+    received = stats['records_received']
+    result.update({
+        'records': received,
+        'lost': expected - received,
+        'elapsed': elapsed,
+        'records_per_sec': received / elapsed,
+        'mb_per_sec': stats['bytes_received'] / elapsed / 1e6,
+    })
+    if latency:
+        delivery = stats['delivery_latency'].get(platform.node(), {})
+        for key in ['p50', 'p99', 'p999']:
+            result[key] = delivery.get(key, 0.0)
+    if result['lost']:
+        failed.append('lost %d logs' % result['lost'])
+    return result
+
+
+def median_run(results):
+    """Answer the result with the median records_per_sec."""
+    results = sorted(results, key=lambda result: result['records_per_sec'])
+    return results[len(results) // 2]
+
+
+def compare(results, baseline, tolerance):
+    """Answer a list of messages for each result that regressed
+    against the baseline result with the same settings:
+    records_per_sec lower, or p99 higher, by more than
+    the tolerance fraction."""
+    previous = dict([(run_key(result), result) for result in baseline])
+    regressions = []
+    for result in results:
+        base = previous.get(run_key(result))
+        if base is None:
+            continue
+        if result['records_per_sec'] < \
+                base['records_per_sec'] * (1 - tolerance):
+            regressions.append('%s records_per_sec %.0f was %.0f' %
+                    (run_key(result), result['records_per_sec'],
+                     base['records_per_sec']))
+        if base['p99'] and result['p99'] and \
+                result['p99'] > base['p99'] * (1 + tolerance):
+            regressions.append('%s p99 %.6f was %.6f' %
+                    (run_key(result), result['p99'], base['p99']))
+        if result['lost'] > base['lost']:
+            regressions.append('%s lost %d was %d' %
+                    (run_key(result), result['lost'], base['lost']))
+    return regressions
+
+
+def mainline():
+    params = process_cmd_line(sys.argv[1:])
+    work_dir = tempfile.mkdtemp(prefix='log_bench_')
+    results = []
+    try:
+        for run in runs(params):
+            repeats = [bench_run(run, params['count'], work_dir)
+                       for _ in range(params['repeat'])]
+            result = median_run(repeats)
+            # The combination fails if any of its runs did.
+            result['failed'] = [reason for repeat in repeats
+                                for reason in repeat['failed']]
+            sys.stderr.write('%s records_per_sec:%.0f p99:%s lost:%d%s\n' %
+                    (run_key(result), result['records_per_sec'],
+                     'n/a' if result['p99'] is None else
+                         '%.6f' % result['p99'],
+                     result['lost'],
+                     ''.join([' FAILED %s' % reason
+                              for reason in result['failed']])))
+            results.append(result)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = json.dumps({'count': params['count'], 'results': results},
+                        indent=2, sort_keys=True)
+    if params['output']:
+        with open(params['output'], 'w') as handle:
+            handle.write(report + '\n')
+    else:
+        print(report)
+
+    regressions = []
+    baseline = params['baseline']
+    if baseline and os.path.isfile(baseline):
+        with open(baseline) as handle:
+            regressions = compare(results, json.load(handle)['results'],
+                                  params['tolerance'])
+        for regression in regressions:
+            sys.stderr.write('REGRESSION %s\n' % regression)
+    failed = [result for result in results if result['failed']]
+    if params['save_baseline'] and not failed:
+        with open(baseline, 'w') as handle:
+            handle.write(report + '\n')
+    if failed:
+        sys.exit(2)
+    sys.exit(3 if regressions else 0)
+
+
+if __name__ == '__main__':
+    mainline()
@@ -15,9 +15,23 @@ The current hostname prefixes each message.
 Usage:
     ./log_client.py [--port=port#]
             [--host=ahostname]
+            [--endpoint=endpoint]
             [--log_msg=a_log_msg]
             [--sleep=0]
             [--count=number_msgs]
+            [--control-port=port#] [--control=endpoint]
+            [--batch-size=N] [--batch-linger-ms=N]
+            [--compress-level=N] [--compress-min-bytes=N]
+            [--sndhwm=N] [--linger-ms=N] [--send-timeout-ms=N]
+            [--overflow=block/drop/spill/spool] [--spill-max=N]
+            [--spool-dir=path] [--spool-max-bytes=N]
+            [--spool-segment-bytes=N]
+            [--send-time=true/false] [--sequence=true/false]
+            [--rate=msgs_per_sec] [--arrivals=constant/poisson]
+            [--burst-rate=msgs_per_sec] [--burst-secs=secs]
+            [--burst-every-s=secs] [--threads=N] [--duration-s=secs]
+            [--fleet=N] [--fleet-prefix=name]
+            [--reliable=true/false] [--window=N] [--ack-timeout-ms=N]
 
 Where:
     --port=port#        - The port number for messaging.
@@ -26,26 +40,192 @@ Where:
                           Default: 10
     --host=ahostname    - The name of the host where server lives.
                           Default: localhost
+    --endpoint=endpoint - The full ZeroMQ endpoint of the server,
+                          for example: ipc:///tmp/iotlog.sock
+                          Overrides --host and --port.
     --sleep=sec_sleep   - Seconds to sleep between messages.
     --svr-exit=true     - true to send exit msg to server at end
                           Default: false
     --log_msg=a_log_msg - The message to send to log server.
                           Default: 'A log message'
                           --log_msg=@EXIT@   causes the server to exit.
+    --control-port=port# - The --control-port of the server.
+                          --svr-exit then sends the exit
+                          command to the control socket,
+                          once the server has received every
+                          log this client sent.
+                          Default: 0 meaning no control socket
+    --control=endpoint  - The --control endpoint of the server.
+    --batch-size=N      - Send up to N logs in each message.
+                          See log_wire.py.
+                          Default: 1 meaning no batching
+    --batch-linger-ms=N - Send a partial batch once its first
+                          log has waited N millisecs. Checked
+                          as each log gets sent.
+                          Default: 0 meaning wait for a full batch
+    --compress-level=N  - zlib compress batches at level 1 (fastest)
+                          to 9 (smallest). The server decompresses.
+                          Default: 0 meaning no compression
+    --compress-min-bytes=N - Compress only batches of at least
+                          N bytes.
+                          Default: 512
+    With batching, the compression ratio and time
+    get reported at exit.
+    --sndhwm=N          - Most messages ZeroMQ queues for the
+                          server before the --overflow policy
+                          applies. Memory use is bounded by
+                          about N times the message size.
+                          Default: 1000
+    --linger-ms=N       - How long unsent messages may delay
+                          exit. -1 waits until all are sent.
+                          Default: -1
+    --send-timeout-ms=N - With --overflow=block, most millisecs
+                          to wait for room in the queue. A
+                          message that times out gets dropped.
+                          Default: -1 meaning wait forever
+    --overflow=policy   - What happens to a message when the
+                          queue is full:
+                            block - wait for room
+                            drop  - drop the message
+                            spill - keep it in a local buffer
+                                    and send it once there is
+                                    room. Messages get dropped
+                                    only when the buffer is full.
+                            spool - append it to a spool on disk
+                                    and send it once there is
+                                    room, in batches. Messages
+                                    get dropped only when the
+                                    spool is full. The messages
+                                    left at exit get sent by the
+                                    next run. Messages queue in
+                                    memory only while connected,
+                                    so a lost link means the disk
+                                    gets used. Logs ZeroMQ already
+                                    queued when the link drops
+                                    may be lost: see --reliable.
+                                    See log_spool.py.
+                          Default: block
+    --spill-max=N       - Most messages in the --overflow=spill
+                          buffer.
+                          Default: 100000
+    --spool-dir=path    - Directory of the --overflow=spool
+                          segments. With --fleet, each client
+                          has a directory of its own in it,
+                          named for its host. Not used with
+                          --threads without --fleet.
+                          Default: ./log_client_spool
+    --spool-max-bytes=N - Most bytes on disk in the spool.
+                          Default: 104857600
+    --spool-segment-bytes=N - Start a new spool segment file
+                          once the last reaches N bytes.
+                          Default: 4194304
+    The messages sent, dropped and spilled get
+    reported at exit.
+    --send-time=true/false - Carry the time each batch was
+                          started in its header so the server
+                          can measure delivery latency per host.
+                          Sends batches even with --batch-size=1.
+                          Default: false
+    --sequence=true/false - Number the logs of each sending
+                          socket 0, 1, 2, ... under a random
+                          session id and carry the number of
+                          the first log in each batch header.
+                          The server counts the logs missing
+                          or repeated from each sender.
+                          Sends batches even with --batch-size=1.
+                          Default: false
+    --rate=msgs_per_sec - Send open loop at this rate. Each log
+                          has an intended send time fixed in
+                          advance. A client that falls behind
+                          catches up instead of slowing down.
+                          The intended, achieved and target
+                          rates and the lag behind schedule
+                          get reported. --sleep is not used.
+                          See log_load.py.
+                          Default: 0 meaning send flat out
+    --arrivals=constant/poisson - Evenly spaced sends, or
+                          random gaps as from many independent
+                          sources.
+                          Default: constant
+    --burst-rate=msgs_per_sec - Rate during bursts.
+                          Default: 0 meaning no bursts
+    --burst-secs=secs   - Length of each burst.
+    --burst-every-s=secs - Time from the start of one burst
+                          to the start of the next.
+    --threads=N         - Send from N threads, each with a
+                          socket of its own and 1/N of the rate.
+                          With N > 1, use --control-port for
+                          --svr-exit so no logs get cut off.
+                          Default: 1
+    --duration-s=secs   - With --rate, send for this long
+                          rather than --count logs.
+                          Default: 0 meaning use --count
+    --fleet=N           - Simulate N clients from this process,
+                          each with a socket and host name of
+                          its own, each sending --count logs.
+                          --rate is the rate of the whole fleet.
+                          --threads share out the clients and
+                          need no --rate. Use --control-port
+                          for --svr-exit. The server may need
+                          a higher ulimit -n for a large fleet.
+                          See log_fleet.py.
+                          Default: 0 meaning no fleet
+    --fleet-prefix=name - Simulated host names are name0000,
+                          name0001, ...
+                          Default: pi
+    --reliable=true/false - Send to a log_server --reliable
+                          from a DEALER socket and keep every
+                          batch until the server acks it, once
+                          written. Batches not acked in time get
+                          sent again. Numbers the logs as with
+                          --sequence so the server drops those
+                          it already has. --overflow is not used.
+                          Default: false
+    --window=N          - With --reliable, most logs waiting for
+                          an ack. Sending then waits for acks.
+                          Default: 10000
+    --ack-timeout-ms=N  - With --reliable, how long the oldest
+                          batch waits for an ack before every
+                          batch waiting gets sent again.
+                          With --linger-ms, logs still not acked
+                          at exit get counted as dropped.
+                          Default: 1000
     """)
     sys.exit(exit_code)
 
 
+import os
 import platform
+import random
 import sys
+import threading
 import time
+from collections import deque
 
 import zmq
 
+from log_control import control_endpoint, drain_server, send_control
+from log_server import compression_ratio
+from log_spool import (REPLAY_BATCH,
+                       REPLAY_WAIT_MS,
+                       DiskSpool,
+                       replay_message)
+from log_wire import (LENGTH,
+                      BatchError,
+                      add_unacked,
+                      batch_sequence,
+                      decode_ack,
+                      encode_batch)
 from log_server import (EXIT_SERVER, 
                        ECHO_SERVER_FALSE, 
                        ECHO_SERVER_TRUE)
 
+# What OverflowSender does when the send queue is full
+OVERFLOW_POLICIES = ['block', 'drop', 'spill', 'spool']
+
+# Prefix of every log sent from this host
+HOST_PREFIX = platform.node() + ' '
+
 
 def dict_to_cmd_string(params):
     """Utility to format run-time parameters as if
@@ -74,6 +254,10 @@ def process_cmd_line(argv):
         # Change this to a remote name by supplying a --host option.
         'host': 'localhost',
 
+        # Full endpoint of log server. None means
+        # tcp to host and port.
+        'endpoint': None,
+
         # Number of messages to send to log server
         'count': 10,
 
@@ -87,6 +271,66 @@ def process_cmd_line(argv):
         # May be a floating point number like 0.5 for a half a sec
         'sleep': 0,
 
+        # Control endpoint of the server. None means
+        # send the exit message in band.
+        'control': None,
+
+        # Logs per message and how long a partial batch waits.
+        'batch_size': 1,
+        'batch_linger_ms': 0,
+
+        # zlib level for batches. 0 means no compression.
+        'compress_level': 0,
+
+        # Smallest batch, in bytes, worth compressing
+        'compress_min_bytes': 512,
+
+        # Most messages queued by ZeroMQ for the server
+        'sndhwm': 1000,
+
+        # Millisecs unsent messages delay exit. -1 means forever.
+        'linger_ms': -1,
+
+        # Millisecs a blocked send waits. -1 means forever.
+        'send_timeout_ms': -1,
+
+        # What to do with messages when the queue is full.
+        # One of OVERFLOW_POLICIES.
+        'overflow': 'block',
+
+        # Most messages in the spill buffer
+        'spill_max': 100000,
+
+        # Spool directory, most bytes and segment size on disk
+        'spool_dir': './log_client_spool',
+        'spool_max_bytes': 104857600,
+        'spool_segment_bytes': 4194304,
+
+        # True to send the send time with each batch
+        'send_time': False,
+
+        # True to number the logs in the batch headers
+        'sequence': False,
+
+        # Open loop load. A rate of 0 means send flat out.
+        'rate': 0.0,
+        'arrivals': 'constant',
+        'burst_rate': 0.0,
+        'burst_secs': 0.0,
+        'burst_every_s': 0.0,
+        'threads': 1,
+        'duration_s': 0.0,
+
+        # Simulated clients and the prefix of their host names.
+        # 0 means send as this one client.
+        'fleet': 0,
+        'fleet_prefix': 'pi',
+
+        # True to send over DEALER and resend logs not acked.
+        # Most logs waiting for acks and how long they wait.
+        'reliable': False,
+        'window': 10000,
+        'ack_timeout_ms': 1000,
     }
 
 
@@ -96,12 +340,41 @@ def process_cmd_line(argv):
                     argv, '',
                     ['port=',       # Port number.
                      'host=',       # hostname
+                     'endpoint=',   # Full endpoint of server
                      'count=',      # Number of messages to send
                      'sleep=',      # Number of messages to send
                      'log_msg=',    # The log message to send to log server.
                      'log-msg=',    # The log message trivial alternative.
                      'svr-exit=',   # true to exit server at end
                      'svr_exit=',   # true to exit server at end
+                     'control-port=',       # Server control port
+                     'control=',    # Server control endpoint
+                     'batch-size=',         # Logs per message
+                     'batch-linger-ms=',    # Partial batch wait
+                     'compress-level=',     # zlib level for batches
+                     'compress-min-bytes=', # Smallest batch to compress
+                     'sndhwm=',     # Send high water mark
+                     'linger-ms=',  # Wait for unsent messages at exit
+                     'send-timeout-ms=',    # Most millisecs a send blocks
+                     'overflow=',   # Policy when the queue is full
+                     'spill-max=',  # Most messages spilled
+                     'spool-dir=',  # Directory of the disk spool
+                     'spool-max-bytes=',    # Most bytes spooled
+                     'spool-segment-bytes=',        # Bytes per segment
+                     'send-time=',  # Send time in batch headers
+                     'sequence=',   # Sequence numbers in batch headers
+                     'rate=',       # Open loop msgs/sec
+                     'arrivals=',   # constant or poisson
+                     'burst-rate=', # msgs/sec in bursts
+                     'burst-secs=', # Length of a burst
+                     'burst-every-s=',      # Secs between bursts
+                     'threads=',    # Sending threads
+                     'duration-s=', # Secs to send for
+                     'fleet=',      # Simulated clients
+                     'fleet-prefix=',       # Simulated host name prefix
+                     'reliable=',   # Resend until acked
+                     'window=',     # Most logs waiting for acks
+                     'ack-timeout-ms=',     # Millisecs before resending
                      'help'         # Print help message then exit.
                      ])
     except getopt.GetoptError as err:
@@ -146,6 +419,117 @@ def process_cmd_line(argv):
         if opt == '--host':
             params['host'] = arg
             continue
+        if opt == '--endpoint':
+            params['endpoint'] = arg
+            continue
+        if opt == '--control-port':
+            try:
+                # port must be integer
+                _ = int(arg)
+            except Exception as err:
+                print('Invalid control port:%s' % str(err))
+                usage(1)
+            params['control_port'] = int(arg)
+            continue
+        if opt == '--control':
+            params['control'] = arg
+            continue
+        if opt in ['--batch-size', '--batch-linger-ms',
+                   '--compress-level', '--compress-min-bytes',
+                   '--sndhwm', '--spill-max', '--fleet',
+                   '--spool-max-bytes', '--spool-segment-bytes']:
+            try:
+                # Must be a non-negative integer
+                value = int(arg)
+                if value < 0:
+                    raise ValueError('must not be negative')
+            except Exception as err:
+                print('Invalid %s value:%s' % (opt, str(err)))
+                usage(1)
+            params[opt[2:].replace('-', '_')] = value
+            continue
+        if opt in ['--linger-ms', '--send-timeout-ms']:
+            try:
+                # Must be an integer. -1 means forever.
+                value = int(arg)
+                if value < -1:
+                    raise ValueError('must be -1 or more')
+            except Exception as err:
+                print('Invalid %s value:%s' % (opt, str(err)))
+                usage(1)
+            params[opt[2:].replace('-', '_')] = value
+            continue
+        if opt in ['--rate', '--burst-rate', '--burst-secs',
+                   '--burst-every-s', '--duration-s']:
+            try:
+                # Must be a non-negative number
+                value = float(arg)
+                if value < 0:
+                    raise ValueError('must not be negative')
+            except Exception as err:
+                print('Invalid %s value:%s' % (opt, str(err)))
+                usage(1)
+            params[opt[2:].replace('-', '_')] = value
+            continue
+        if opt == '--arrivals':
+            if arg not in ['constant', 'poisson']:
+                print('Invalid --arrivals value:%s' % arg)
+                usage(1)
+            params['arrivals'] = arg
+            continue
+        if opt in ['--threads', '--window', '--ack-timeout-ms']:
+            try:
+                # Must be a positive integer
+                value = int(arg)
+                if value < 1:
+                    raise ValueError('must be at least 1')
+            except Exception as err:
+                print('Invalid %s value:%s' % (opt, str(err)))
+                usage(1)
+            params[opt[2:].replace('-', '_')] = value
+            continue
+        if opt == '--fleet-prefix':
+            params['fleet_prefix'] = arg
+            continue
+        if opt == '--spool-dir':
+            params['spool_dir'] = arg
+            continue
+        if opt == '--send-time':
+            params['send_time'] = True if 'true' == arg.lower() else False
+            continue
+        if opt == '--sequence':
+            params['sequence'] = True if 'true' == arg.lower() else False
+            continue
+        if opt == '--reliable':
+            params['reliable'] = True if 'true' == arg.lower() else False
+            continue
+        if opt == '--overflow':
+            if arg not in OVERFLOW_POLICIES:
+                print('Invalid --overflow value:%s' % arg)
+                usage(1)
+            params['overflow'] = arg
+            continue
+
+    if params['compress_level'] > 9:
+        print('Invalid --compress-level value:must be 0 to 9')
+        usage(1)
+
+    if params['duration_s'] and not params['rate']:
+        print('Invalid options:--duration-s needs --rate')
+        usage(1)
+
+    if params['threads'] > 1 and not (params['rate'] or params['fleet']):
+        print('Invalid options:--threads needs --rate or --fleet')
+        usage(1)
+
+    if params['overflow'] == 'spool' and params['threads'] > 1 and \
+            not params['fleet']:
+        print('Invalid options:--overflow=spool not used with --threads')
+        usage(1)
+
+    if 'control_port' in params:
+        params['control'] = control_endpoint(params['host'],
+                                             params.pop('control_port'))
 
     if params['log_msg'] == EXIT_SERVER or \
        params['log_msg'] == ECHO_SERVER_FALSE or \
@@ -160,7 +544,8 @@ def process_cmd_line(argv):
     return params
 
 
-def setup_zmq(your_host, port_number):
+def setup_zmq(your_host, port_number=None, sndhwm=1000, linger_ms=-1,
+              send_timeout_ms=-1, socket_type=zmq.PUSH, immediate=False):
     """
     Setup environment for ZeroMQ message logging.
 
@@ -169,6 +554,9 @@ def setup_zmq(your_host, port_number):
             "localhost" for logging on a local system.
             an IP address such as 192.168.1.76 .
             a remote system such as "trinity".
+        your_host may also be a full endpoint such as
+            "ipc:///tmp/iotlog.sock" for a local server
+            bound with --bind. port_number then gets ignored.
     The value of your_host depends on the location
     of log_server.
 
@@ -176,49 +564,624 @@ def setup_zmq(your_host, port_number):
         port_number is typically something like 5555, 5678, ...
         The port_number MUST batch the port number of the server!
 
+    sndhwm, linger_ms and send_timeout_ms set the ZeroMQ
+    SNDHWM, LINGER and SNDTIMEO of the socket.
+
+    socket_type is zmq.DEALER for log_client --reliable.
+
+    With immediate set, messages get queued only while
+    connected, as for --overflow=spool.
+
     For testing purposes, use:
         setup_zmq('localhost', 5555)
     """
     context = zmq.Context()
-    socket = context.socket(zmq.PUSH)
-    socket.connect('tcp://%s:%d' % (your_host, port_number))
+    socket = context.socket(socket_type)
+    socket.setsockopt(zmq.SNDHWM, sndhwm)
+    socket.setsockopt(zmq.LINGER, linger_ms)
+    socket.setsockopt(zmq.SNDTIMEO, send_timeout_ms)
+    socket.setsockopt(zmq.IMMEDIATE, 1 if immediate else 0)
+    socket.connect(server_endpoint(your_host, port_number))
     return context, socket
 
 
+def connect_socket(context, params):
+    """Answer another socket of context connected to the
+    server and configured like setup_zmq() by params."""
+    socket = context.socket(zmq.DEALER if params['reliable'] else zmq.PUSH)
+    socket.setsockopt(zmq.SNDHWM, params['sndhwm'])
+    socket.setsockopt(zmq.LINGER, params['linger_ms'])
+    socket.setsockopt(zmq.SNDTIMEO, params['send_timeout_ms'])
+    socket.setsockopt(zmq.IMMEDIATE,
+                      1 if params['overflow'] == 'spool' else 0)
+    socket.connect(server_endpoint(params['endpoint'] or params['host'],
+                                   params['port']))
+    return socket
+
+
+def make_senders(socket, params, host=None):
+    """Answer (flow, batcher) to send logs to socket as
+    configured by params. batcher is None when logs go
+    out one per message. host stands in for the name
+    of this host in batched logs, and names its spool
+    directory. With --reliable, flow is a ReliableSender
+    and logs always get batched."""
+    if params['reliable']:
+        flow = ReliableSender(socket, params['window'],
+                              params['ack_timeout_ms'], params['linger_ms'])
+    else:
+        spool = None
+        if params['overflow'] == 'spool':
+            directory = params['spool_dir']
+            if host:
+                directory = os.path.join(directory, host)
+            spool = DiskSpool(directory, params['spool_max_bytes'],
+                              params['spool_segment_bytes'])
+        flow = OverflowSender(socket, params['overflow'], params['spill_max'],
+                              spool)
+    batcher = None
+    if params['batch_size'] > 1 or params['send_time'] or \
+            params['sequence'] or params['reliable']:
+        batcher = BatchSender(socket, params['batch_size'],
+                              params['batch_linger_ms'],
+                              params['compress_level'],
+                              params['compress_min_bytes'],
+                              flow,
+                              params['send_time'],
+                              host,
+                              params['sequence'] or params['reliable'])
+    return flow, batcher
+
+
+def server_endpoint(your_host, port_number=None):
+    """Answer the endpoint of the server. your_host may
+    already be a full endpoint."""
+    if '://' in your_host:
+        return your_host
+    return 'tcp://%s:%d' % (your_host, port_number)
+
+
 def send_msg(socket, msg):
     """Send the message to the logger. Prefix the message with
     the host name of message origin."""
-    log = platform.node() + ' ' + msg
-    socket.send(log)
+    socket.send(HOST_PREFIX + msg)
 
 
-def mainline():
-    """Top level logic for a client. Your clients will
-    have different logic depending upon the application.
+class LogClient(object):
+    """Send logs to log_server from any thread of a process.
 
-    This script targets sending logs to a log_server
-    for testing purposes.
+        client = LogClient('tcp://localhost:5555')
+        client.send('Sensor 3 reads 21.5')
+        client.send_many(['Sensor 4 reads 20.0',
+                          'Sensor 5 reads 19.5'])
+
+    Every LogClient uses the one ZeroMQ context of the
+    process, zmq.Context.instance(), unless given one.
+    ZeroMQ sockets must not be shared between threads,
+    so each thread gets a PUSH socket of its own the
+    first time it sends, and keeps it. The host name
+    prefix gets built once. Unicode logs get sent as
+    UTF-8.
+
+    send_many() sends its logs as one batch. See
+    log_wire.py.
+
+    close() closes every thread's socket. Call it once
+    the threads are done sending. The context is left
+    for the rest of the process.
     """
 
-    # If the user has entered command line options, process them
-    params = process_cmd_line(sys.argv[1:])
+    def __init__(self, endpoint='tcp://localhost:5555', host=None,
+                 sndhwm=1000, linger_ms=-1, context=None):
+        self.endpoint = server_endpoint(endpoint)
+        self.prefix = HOST_PREFIX if host is None else host + ' '
+        self.sndhwm = sndhwm
+        self.linger_ms = linger_ms
+        self.context = context or zmq.Context.instance()
+        self.local = threading.local()
+        self.sockets = []
+        self.lock = threading.Lock()    # Guards sockets
+
+    def socket(self):
+        """Answer the socket of the calling thread."""
+        socket = getattr(self.local, 'socket', None)
+        if socket is None:
+            socket = self.context.socket(zmq.PUSH)
+            socket.setsockopt(zmq.SNDHWM, self.sndhwm)
+            socket.setsockopt(zmq.LINGER, self.linger_ms)
+            socket.connect(self.endpoint)
+            with self.lock:
+                self.sockets.append(socket)
+            self.local.socket = socket
+        return socket
+
+    def send(self, msg):
+        """Send a log."""
+        if isinstance(msg, unicode):
+            msg = msg.encode('utf-8')
+        self.socket().send(self.prefix + msg)
+
+    def send_many(self, msgs):
+        """Send a list of logs in one message."""
+        if not msgs:
+            return
+        prefix = self.prefix
+        records = [prefix + (msg.encode('utf-8') if isinstance(msg, unicode)
+                             else msg)
+                   for msg in msgs]
+        self.socket().send_multipart(encode_batch(records))
+
+    def close(self):
+        """Close the socket of every thread."""
+        with self.lock:
+            for socket in self.sockets:
+                socket.close()
+            del self.sockets[:]
+        self.local = threading.local()
+
+
+class OverflowSender(object):
+    """Send messages to a socket under one of the
+    OVERFLOW_POLICIES once the socket reaches its
+    send high water mark:
+        block - wait for room. With a send timeout, a
+                message that times out gets dropped.
+        drop  - drop the newest message.
+        spill - keep the message in a local buffer of at
+                most spill_max messages and send it once
+                there is room. Order is kept: nothing new
+                goes out before the buffer empties. When
+                the buffer is full the newest message
+                gets dropped.
+        spool - like spill, with the DiskSpool spool as
+                the buffer. Messages left in the spool
+                by an earlier run go out first. Plain
+                logs go out from the spool in batches.
+
+    Each message carries count logs. The logs sent,
+    dropped and spilled get totalled, along with the
+    most logs ever waiting in the buffer. Call flush()
+    when done sending to empty the buffer. flush()
+    leaves in the spool whatever the socket finds no
+    room for within REPLAY_WAIT_MS.
+    """
+
+    def __init__(self, socket, policy='block', spill_max=100000, spool=None):
+        self.socket = socket
+        self.policy = policy
+        self.spill_max = spill_max
+        self.spool = spool
+        self.spill = deque()    # (frames, count)
+        self.spill_logs = 0
+        self.sent_count = 0
+        self.drop_count = 0
+        self.spill_count = 0
+        self.spill_peak = 0
+
+    def send(self, frames, count=1):
+        """Send the frames of a message holding count logs."""
+        if self.policy == 'block':
+            self.send_blocking(frames, count)
+            return
+        if self.backlog() and not self.send_spilled():
+            self.overflow(frames, count)
+            return
+        try:
+            self.socket.send_multipart(frames, zmq.NOBLOCK)
+        except zmq.Again:
+            self.overflow(frames, count)
+            return
+        self.sent_count += count
+
+    def send_blocking(self, frames, count):
+        """Wait for room to send. Answers False if the
+        send timed out and the logs got dropped."""
+        try:
+            self.socket.send_multipart(frames)
+        except zmq.Again:
+            self.drop_count += count
+            return False
+        self.sent_count += count
+        return True
+
+    def backlog(self):
+        """Answer True while spilled messages wait to be sent."""
+        if self.spool is not None:
+            return not self.spool.empty()
+        return bool(self.spill)
+
+    def overflow(self, frames, count):
+        """Drop or spill a message the socket has no room for."""
+        if self.spool is not None:
+            if self.spool.append(frames, count):
+                self.spill_count += count
+            else:
+                self.drop_count += count
+            return
+        if self.policy == 'drop' or \
+                len(self.spill) >= self.spill_max:
+            self.drop_count += count
+            return
+        self.spill.append((frames, count))
+        self.spill_count += count
+        self.spill_logs += count
+        self.spill_peak = max(self.spill_peak, self.spill_logs)
+
+    def send_spilled(self):
+        """Send spilled messages while the socket has room.
+        Answers True once the buffer is empty."""
+        if self.spool is not None:
+            return self.send_spooled()
+        spill = self.spill
+        while spill:
+            frames, count = spill[0]
+            try:
+                self.socket.send_multipart(frames, zmq.NOBLOCK)
+            except zmq.Again:
+                return False
+            spill.popleft()
+            self.spill_logs -= count
+            self.sent_count += count
+        return True
+
+    def send_spooled(self):
+        """Replay the spool while the socket has room.
+        Answers True once the spool is empty."""
+        spool = self.spool
+        while not spool.empty():
+            messages = spool.peek(REPLAY_BATCH)
+            if not messages:
+                break
+            frames, count, taken = replay_message(messages)
+            try:
+                self.socket.send_multipart(frames, zmq.NOBLOCK)
+            except zmq.Again:
+                return False
+            spool.consume(taken)
+            self.sent_count += count
+        return True
+
+    def flush(self):
+        """Wait for room to send every spilled message."""
+        if self.spool is not None:
+            while not self.send_spooled() and \
+                    self.socket.poll(REPLAY_WAIT_MS, zmq.POLLOUT):
+                pass
+            self.spool.close()
+            return
+        while self.spill:
+            frames, count = self.spill.popleft()
+            self.spill_logs -= count
+            self.send_blocking(frames, count)
+
+    def report(self):
+        """Answer a one line summary of the logs sent and lost."""
+        report = ('overflow:%s sent:%d dropped:%d spilled:%d spill_peak:%d' %
+                  (self.policy, self.sent_count, self.drop_count,
+                   self.spill_count, self.spill_peak))
+        if self.spool is not None:
+            report += ' ' + self.spool.report()
+        return report
+
+
+class ReliableSender(object):
+    """Send batches over a DEALER socket to a log_server
+    --reliable and keep each one until the server acks
+    it. Batches must carry a sequence. See BatchSender.
+
+    At most window logs wait for an ack. A send that
+    would go over waits for acks first. An ack covers
+    every log numbered below the one it names, so the
+    server acks many batches at once.
+
+    Once the oldest batch has waited ack_timeout_ms with
+    no ack, every batch waiting gets sent again, oldest
+    first, as far as the socket has room. The server
+    drops the logs it already has.
+
+    Every batch sent, or sent again, carries the number
+    of the oldest log waiting for an ack. A server that
+    has not heard from this sender before, as after a
+    restart, then waits for that log rather than take
+    whichever batch arrives first.
+
+    Each message carries count logs. The logs acked
+    count as sent. flush() waits until every batch has
+    been acked, for at most linger_ms unless -1. Logs
+    still waiting then count as dropped. The counters
+    match an OverflowSender's so either can be the flow.
+    """
+
+    def __init__(self, socket, window=10000, ack_timeout_ms=1000,
+                 linger_ms=-1):
+        self.socket = socket
+        self.window = window
+        self.ack_timeout = ack_timeout_ms / 1000.0
+        self.linger = linger_ms / 1000.0 if linger_ms >= 0 else None
+        self.session = None
+        self.unacked = deque()  # (next sequence, frames, count)
+        self.unacked_logs = 0
+        self.ack_due = 0.0      # When the oldest batch is overdue
+        self.sent_count = 0
+        self.drop_count = 0
+        self.spill_count = 0
+        self.window_peak = 0
+        self.resend_count = 0
+        self.ack_count = 0
+
+    def send(self, frames, count=1):
+        """Send the frames of a batch holding count logs."""
+        while self.unacked and self.unacked_logs + count > self.window:
+            self.wait_for_ack()
+        self.session, first = batch_sequence(frames)
+        if not self.unacked:
+            self.ack_due = time.time() + self.ack_timeout
+        self.unacked.append((first + count, frames, count))
+        self.unacked_logs += count
+        self.window_peak = max(self.window_peak, self.unacked_logs)
+        try:
+            self.socket.send_multipart(add_unacked(frames, self.oldest()))
+        except zmq.Again:
+            # Sent again once overdue.
+            pass
+        self.receive_acks()
+
+    def receive_acks(self):
+        """Take the acks that have arrived without waiting.
+        Send the batches waiting again if overdue."""
+        socket = self.socket
+        while socket.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+            self.acknowledge(socket.recv())
+        if self.unacked and time.time() >= self.ack_due:
+            self.resend()
 
-    # Create the ZeroMQ context and socket.
-    context, socket = setup_zmq(params['host'], params['port'])
+    def acknowledge(self, frame):
+        """Release the batches an ack covers."""
+        try:
+            session, next_sequence = decode_ack(frame)
+        except BatchError:
+            return
+        if session != self.session:
+            return
+        self.ack_count += 1
+        unacked = self.unacked
+        if not unacked or unacked[0][0] > next_sequence:
+            return
+        while unacked and unacked[0][0] <= next_sequence:
+            _, _, count = unacked.popleft()
+            self.unacked_logs -= count
+            self.sent_count += count
+        self.ack_due = time.time() + self.ack_timeout
 
+    def wait_for_ack(self, deadline=None):
+        """Wait for an ack until the oldest batch is overdue
+        or the optional deadline, whichever comes first."""
+        until = self.ack_due
+        if deadline is not None:
+            until = min(until, deadline)
+        if self.socket.poll(max(0, int((until - time.time()) * 1000))):
+            self.acknowledge(self.socket.recv())
+        self.receive_acks()
+
+    def oldest(self):
+        """Answer the sequence number of the oldest log
+        waiting for an ack."""
+        next_sequence, _, count = self.unacked[0]
+        return next_sequence - count
+
+    def resend(self):
+        """Send every batch waiting for an ack again."""
+        oldest = self.oldest()
+        for _, frames, _ in self.unacked:
+            try:
+                self.socket.send_multipart(add_unacked(frames, oldest),
+                                           zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            self.resend_count += 1
+        self.ack_due = time.time() + self.ack_timeout
+
+    def flush(self):
+        """Wait for acks to every batch, up to linger_ms."""
+        deadline = None
+        if self.linger is not None:
+            deadline = time.time() + self.linger
+        while self.unacked:
+            if deadline is not None and time.time() >= deadline:
+                self.drop_count += self.unacked_logs
+                self.unacked.clear()
+                self.unacked_logs = 0
+                return
+            self.wait_for_ack(deadline)
+
+    def report(self):
+        """Answer a one line summary of the logs acked and lost."""
+        return ('reliable sent:%d dropped:%d window_peak:%d '
+                'resent_batches:%d acks:%d' %
+                (self.sent_count, self.drop_count, self.window_peak,
+                 self.resend_count, self.ack_count))
+
+
+class BatchSender(object):
+    """Send logs in batches of up to batch_size.
+
+    A batch goes out when full or, when linger_ms is
+    set, once its first log has waited linger_ms. The
+    wait gets checked only as logs get sent, so call
+    flush() when done sending.
+
+    With compress_level set, batches of at least
+    compress_min_bytes get zlib compressed. The bytes
+    before and after encoding and the seconds spent
+    encoding get totalled.
+
+    With an OverflowSender as flow, batches get sent
+    through it.
+
+    With send_time set, each batch carries the time its
+    first log was added so the server can measure how
+    long logs take to arrive, batching included.
+
+    With sequence set, the logs get numbered from 0 under
+    a random session id and each batch carries both, so
+    the server can tell if any went missing. A batch the
+    flow drops leaves a gap.
+
+    The host name prefix gets built once. host stands
+    in for the name of this host.
+    """
+
+    def __init__(self, socket, batch_size, linger_ms=0,
+                 compress_level=0, compress_min_bytes=0, flow=None,
+                 send_time=False, host=None, sequence=False):
+        self.socket = socket
+        self.flow = flow
+        self.send_time = send_time
+        self.session = random.getrandbits(64) if sequence else None
+        self.next_sequence = 0
+        self.batch_size = batch_size
+        self.linger = linger_ms / 1000.0
+        self.compress_level = compress_level
+        self.compress_min_bytes = compress_min_bytes
+        self.prefix = host + ' ' if host else HOST_PREFIX
+        self.records = []
+        self.first_time = 0
+        self.batch_count = 0
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self.encode_time = 0.0
+
+    def send(self, msg, when=None):
+        """Add msg to the batch. Send the batch if full or
+        if it has waited long enough. when is the time msg
+        was meant to be sent, if not now."""
+        records = self.records
+        if not records and (self.linger or self.send_time):
+            self.first_time = when or time.time()
+        records.append(self.prefix + msg)
+        if len(records) >= self.batch_size:
+            self.flush()
+        elif self.linger and time.time() - self.first_time >= self.linger:
+            self.flush()
+
+    def flush(self):
+        """Send any logs waiting in the batch."""
+        records = self.records
+        if not records:
+            return
+        start = time.time()
+        send_time = None
+        if self.send_time:
+            send_time = int(self.first_time * 1e9)
+        sequence = None
+        if self.session is not None:
+            sequence = (self.session, self.next_sequence)
+            self.next_sequence += len(records)
+        frames = encode_batch(records, 0, self.compress_level,
+                              self.compress_min_bytes, send_time, sequence)
+        self.encode_time += time.time() - start
+        if self.flow is not None:
+            self.flow.send(frames, len(records))
+        else:
+            self.socket.send_multipart(frames)
+        self.batch_count += 1
+        self.raw_bytes += sum([len(record) for record in records]) + \
+                LENGTH.size * len(records)
+        self.sent_bytes += len(frames[1])
+        self.records = []
+
+    def report(self):
+        """Answer a one line summary of the batches sent."""
+        return ('batches:%d raw_bytes:%d sent_bytes:%d ratio:%.2f '
+                'encode_time:%.3f' %
+                (self.batch_count, self.raw_bytes, self.sent_bytes,
+                 compression_ratio(self.raw_bytes, self.sent_bytes),
+                 self.encode_time))
+
+
+def send_count(socket, params):
+    """Send --count logs as fast as possible, sleeping
+    --sleep secs after each. Answers the number sent."""
     log_msg = params['log_msg']
     sleep = params['sleep']
+    flow, sender = make_senders(socket, params)
+    prefix = HOST_PREFIX
     # Send the requested number of messages to the server
     for ndx in xrange(params['count']):
         msg = '%d: %s' % (ndx, log_msg)
-        send_msg(socket, msg)
+        if sender:
+            sender.send(msg)
+        else:
+            flow.send([prefix + msg])
         if sleep > 0:
             time.sleep(sleep)
+    if sender:
+        sender.flush()
+        print('Client %s' % sender.report())
+    flow.flush()
+    print('Client %s' % flow.report())
+    return flow.sent_count
+
+
+def mainline():
+    """Top level logic for a client. Your clients will
+    have different logic depending upon the application.
+
+    This script targets sending logs to a log_server
+    for testing purposes.
+    """
+
+    # If the user has entered command line options, process them
+    params = process_cmd_line(sys.argv[1:])
+
+    # Create the ZeroMQ context and socket. A fleet has
+    # sockets of its own, so it only needs this one to
+    # send the exit message.
+    inband_exit = params['svr_exit'] and not params['control']
+    context = socket = None
+    if not params['fleet'] or inband_exit:
+        context, socket = setup_zmq(params['endpoint'] or params['host'],
+                                    params['port'],
+                                    params['sndhwm'],
+                                    params['linger_ms'],
+                                    params['send_timeout_ms'],
+                                    zmq.DEALER if params['reliable']
+                                    else zmq.PUSH,
+                                    params['overflow'] == 'spool')
+
+    if params['fleet']:
+        # Many simulated clients from this process.
+        from log_fleet import run_fleet
+        sent, lines = run_fleet(params)
+        for line in lines:
+            print('Client %s' % line)
+    elif params['rate']:
+        # Open loop load on a schedule.
+        from log_load import run_load
+        sent, lines = run_load(params, context, socket)
+        for line in lines:
+            print('Client %s' % line)
+    else:
+        sent = send_count(socket, params)
 
     # Conditionally send the exit message to the server.
-    if params['svr_exit']:
+    if inband_exit:
         send_msg(socket, EXIT_SERVER)
 
+    # Wait for the queued logs to reach the server.
+    # Exiting without this may drop them.
+    if socket is not None:
+        socket.close()
+        context.term()
+
+    if params['svr_exit'] and params['control']:
+        # Wait for the server to receive the logs in flight.
+        # It may hold logs from other clients as well.
+        stats = drain_server(params['control'], sent)
+        if stats is None or not stats['drained']:
+            print('Client logs not all received before exit')
+        send_control(params['control'], 'exit', timeout=60000)
+
     print('Client exiting')
     sys.exit(0)
 
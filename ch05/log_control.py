@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+def usage(exit_code):
+    print(' '.join(sys.argv) + """\n
+Send a control command to log_server.py and
+print the reply.
+
+The server must run with --control-port or --control.
+
+Usage:
+    ./log_control.py [--port=port#] [--host=ahostname]
+        [--endpoint=endpoint] [--timeout=millisecs] command
+
+Where:
+    --port=port#        - The --control-port of log_server.
+                          Default: 5557
+    --host=ahostname    - The name of the host where server lives.
+                          Default: localhost
+    --endpoint=endpoint - The --control endpoint of log_server.
+                          Overrides --host and --port.
+    --timeout=millisecs - How long to wait for the reply.
+                          Default: 5000
+    command             - One of:
+                            exit
+                            echo true
+                            echo false
+                            flush
+                            reopen
+                            stats
+                            drain [N [millisecs]]
+                          drain waits until the server has
+                          received N logs in total, then has
+                          it write and flush them. Give a
+                          --timeout longer than millisecs.
+
+Return codes:
+    0 - The server replied
+    1 - Invalid command line
+    2 - No reply within the timeout
+    """)
+    sys.exit(exit_code)
+
+
+import json
+import sys
+
+import zmq
+
+# Extra millisecs to wait for the reply to a drain
+# beyond the time the server may wait.
+DRAIN_REPLY_MS = 5000
+
+
+def process_cmd_line(argv):
+    """
+    Command line code to handle user params
+    """
+
+    params = {
+        # The --control-port of log_server
+        'port': 5557,
+
+        # Host name of log server
+        'host': 'localhost',
+
+        # The --control endpoint of log_server.
+        # None means use host and port.
+        'endpoint': None,
+
+        # Millisecs to wait for a reply
+        'timeout': 5000,
+
+        # The command to send
+        'command': None,
+    }
+
+    import getopt
+    try:
+        opts, args = getopt.gnu_getopt(
+                argv, '',
+                    ['port=',       # Port number.
+                     'host=',       # hostname
+                     'endpoint=',   # Control endpoint
+                     'timeout=',    # Millisecs to wait for reply
+                     'help'         # Print help message then exit.
+                     ])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage(1)
+
+    for opt, arg in opts:
+        if opt == '--help':
+            usage(0)
+        if opt in ['--port', '--timeout']:
+            try:
+                # Must be integer
+                params[opt[2:]] = int(arg)
+            except ValueError as err:
+                print('Invalid %s value:%s' % (opt, err))
+                usage(1)
+            continue
+        if opt == '--host':
+            params['host'] = arg
+            continue
+        if opt == '--endpoint':
+            params['endpoint'] = arg
+            continue
+
+    if not args:
+        print('Missing command')
+        usage(1)
+    params['command'] = ' '.join(args)
+    if params['endpoint'] is None:
+        params['endpoint'] = control_endpoint(params['host'], params['port'])
+    return params
+
+
+def control_endpoint(your_host, port_number):
+    """Answer the endpoint of a log_server --control-port."""
+    return 'tcp://%s:%d' % (your_host, port_number)
+
+
+def send_control(endpoint, command, timeout=5000, context=None):
+    """Send command to the log_server control socket at endpoint.
+    Answers the reply, or None if no reply arrived within
+    timeout millisecs."""
+    own_context = context is None
+    if own_context:
+        context = zmq.Context()
+    socket = context.socket(zmq.REQ)
+    socket.connect(endpoint)
+    socket.send(command)
+    reply = None
+    if socket.poll(timeout):
+        reply = socket.recv()
+    socket.close(linger=0)
+    if own_context:
+        context.term()
+    return reply
+
+
+def drain_server(endpoint, records=0, timeout=60000, context=None):
+    """Wait until the server at the control endpoint has
+    received records logs in total, or for at most timeout
+    millisecs, and has written and flushed them. Answers
+    the server stats, where drained is True if the records
+    arrived, or None if the server did not reply."""
+    reply = send_control(endpoint, 'drain %d %d' % (records, timeout),
+                         timeout + DRAIN_REPLY_MS, context)
+    if reply is None or reply.startswith('error'):
+        return None
+    return json.loads(reply)
+
+
+def mainline():
+    params = process_cmd_line(sys.argv[1:])
+    reply = send_control(params['endpoint'], params['command'],
+                         params['timeout'])
+    if reply is None:
+        print('No reply from %s' % params['endpoint'])
+        sys.exit(2)
+    print(reply)
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    mainline()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Run log_server.py in this process for tests.
+
+LogServerFixture starts a server on a thread of its
+own, bound where no other server can be: a tcp port
+picked by bind_to_random_port, or an ipc path in a
+fresh temporary directory. The log file goes in that
+directory too. Tests hand server.endpoint to clients,
+in this process or as log_client --endpoint, and
+server.control to log_control or log_client --control.
+With no port hard coded and no listeners to kill, test
+modules can run at the same time. See run_tests.py.
+
+    with LogServerFixture('--batch-max=50') as server:
+        ... send 100 logs to server.endpoint ...
+        server.drain(100)
+        lines = server.lines()
+
+The server always has a control socket, so logs are
+never parsed for @EXIT@. --workers is not supported.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+
+import zmq
+
+import log_server
+from log_control import drain_server, send_control
+
+# Transports a fixture can bind
+TRANSPORTS = ['tcp', 'ipc']
+
+
+class LogServerFixture(object):
+    """A log_server running on a thread of this process,
+    configured by log_server command line options in args.
+    """
+
+    def __init__(self, args='', transport='tcp'):
+        if transport not in TRANSPORTS:
+            raise ValueError('unknown transport:%s' % transport)
+        self.work_dir = tempfile.mkdtemp(prefix='log_fixture_')
+        self.log_filename = os.path.join(self.work_dir, 'test.log')
+        self.params = log_server.process_cmd_line(
+                ('--log=%s --log-append=false %s' %
+                 (self.log_filename, args)).split())
+        if self.params['workers'] > 1:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+            raise ValueError('--workers is not supported')
+
+        self.context = zmq.Context()
+        self.socket = log_server.data_socket(self.context, self.params)
+        self.control_socket = self.context.socket(zmq.REP)
+        if transport == 'tcp':
+            port = self.socket.bind_to_random_port('tcp://127.0.0.1')
+            self.endpoint = 'tcp://127.0.0.1:%d' % port
+            port = self.control_socket.bind_to_random_port('tcp://127.0.0.1')
+            self.control = 'tcp://127.0.0.1:%d' % port
+        else:
+            self.endpoint = 'ipc://%s/data' % self.work_dir
+            self.socket.bind(self.endpoint)
+            self.control = 'ipc://%s/control' % self.work_dir
+            self.control_socket.bind(self.control)
+        self.params['bind'] = [self.endpoint]
+        self.params['control'] = self.control
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        """Server thread: serve until the exit command."""
+        params = self.params
+        if params['async']:
+            from log_server_async import AsyncServer
+            AsyncServer(params, self.context, [self.socket],
+                        self.control_socket).run()
+        else:
+            writer = log_server.make_writer(
+                    log_server.open_log_file_for_writing(params),
+                    params, self.context)
+            publisher = None
+            if params['pub_port']:
+                publisher = log_server.LogPublisher(self.context, params)
+            log_server.serve(log_server.make_receiver(self.socket, params,
+                                                      publisher),
+                             writer, self.control_socket)
+            writer.close()
+            if publisher is not None:
+                publisher.close()
+        self.socket.close(linger=0)
+        self.control_socket.close(linger=0)
+
+    def command(self, request, timeout=5000):
+        """Send a control command. Answers the reply, None
+        if none arrived within timeout millisecs."""
+        return send_control(self.control, request, timeout, self.context)
+
+    def drain(self, records=0, timeout=10000):
+        """Wait until the server has received records logs
+        in total, at most timeout millisecs, and has written
+        and flushed them. Answers the stats. See log_control."""
+        return drain_server(self.control, records, timeout, self.context)
+
+    def lines(self):
+        """Answer the lines of the log file."""
+        with open(self.log_filename) as handle:
+            return handle.readlines()
+
+    def stop(self):
+        """Stop the server unless a client already has, then
+        remove the log file and the ipc endpoints."""
+        if self.thread.is_alive():
+            self.command('exit', timeout=60000)
+        self.thread.join()
+        self.context.term()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
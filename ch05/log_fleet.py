@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+"""
+Simulate a fleet of clients from one process for
+log_client.py --fleet.
+
+Each simulated client has a PUSH socket of its own,
+so the server sees one connection per client, and a
+host name of its own: pi0000, pi0001, ... Starting a
+thousand sockets takes a moment. Starting a thousand
+Python processes takes minutes.
+
+--threads sending threads share out the clients.
+ZeroMQ does the network I/O for every socket on the
+context's I/O threads, one per sending thread.
+
+Without --rate, each thread sends round robin, one
+log from each of its clients in turn, as fast as the
+sockets take them. With --overflow=block, one client
+whose queue is full holds up the rest of its thread.
+
+With --rate, the fleet as a whole sends open loop at
+that rate: each client on a schedule of its own at
+rate / clients, the starts spread so the fleet sends
+evenly. See log_load.py.
+
+This code base runs on Python 2, so the senders are
+threads rather than asyncio tasks.
+"""
+
+import heapq
+import itertools
+import resource
+import threading
+import time
+
+import zmq
+
+from log_client import connect_socket, make_senders
+from log_load import LoadStats, arrival_times, load_report
+
+# File descriptors needed by each simulated client:
+# one for its connection and one for its mailbox.
+FDS_PER_CLIENT = 2
+
+# File descriptors kept spare for everything else.
+FDS_SPARE = 64
+
+
+def raise_fd_limit(needed):
+    """Raise the soft limit on open files to at least
+    needed, up to the hard limit. Answers the limit."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        if hard != resource.RLIM_INFINITY:
+            needed = min(needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (needed, hard))
+        soft = needed
+    return soft
+
+
+def fleet_host(prefix, ndx):
+    """Answer the host name of simulated client ndx."""
+    return '%s%04d' % (prefix, ndx)
+
+
+class FleetClient(object):
+    """One simulated client: a socket of its own and
+    a host name of its own."""
+
+    def __init__(self, context, params, host):
+        self.host = host
+        self.prefix = host + ' '
+        self.socket = connect_socket(context, params)
+        self.flow, self.batcher = make_senders(self.socket, params, host)
+        self.count = 0
+
+    def send(self, log_msg, when=None):
+        """Send the client's next log. when is the time
+        it was meant to be sent, if not now."""
+        msg = '%d: %s' % (self.count, log_msg)
+        if self.batcher:
+            self.batcher.send(msg, when)
+        else:
+            self.flow.send([self.prefix + msg])
+        self.count += 1
+
+    def flush(self):
+        """Send everything batched or spilled."""
+        if self.batcher:
+            self.batcher.flush()
+        self.flow.flush()
+
+    def close(self):
+        self.socket.close()
+
+
+def send_round_robin(clients, count, log_msg):
+    """Send count logs from each client, one from each
+    client in turn."""
+    for _ in xrange(count):
+        for client in clients:
+            client.send(log_msg)
+
+
+def client_schedule(ndx, times, count, deadline=None):
+    """Yield (intended, ndx) for up to count of the
+    intended times, stopping past the optional deadline."""
+    for intended in itertools.islice(times, count):
+        if deadline is not None and intended > deadline:
+            return
+        yield intended, ndx
+
+
+def send_schedule(clients, schedules, log_msg, start):
+    """Send logs from clients at the intended times of
+    their schedules, merged into one. A sender that falls
+    behind catches up. Answers the LoadStats."""
+    stats = LoadStats(start)
+    for intended, ndx in heapq.merge(*schedules):
+        delay = intended - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        clients[ndx].send(log_msg, intended)
+        stats.record(intended, time.time())
+    return stats
+
+
+def fleet_report(params, clients, elapsed):
+    """Answer a one line summary of what the fleet sent."""
+    flows = [client.flow for client in clients]
+    sent = sum([flow.sent_count for flow in flows])
+    return ('fleet clients:%d threads:%d sent:%d dropped:%d spilled:%d '
+            'elapsed:%.3f rate:%.1f' %
+            (len(clients), params['threads'], sent,
+             sum([flow.drop_count for flow in flows]),
+             sum([flow.spill_count for flow in flows]),
+             elapsed, sent / elapsed if elapsed > 0 else 0.0))
+
+
+def run_fleet(params):
+    """Send from --fleet simulated clients, each sending
+    --count logs, or for --duration-s, as set by params.
+    Waits for every log to be sent. Answers the number
+    of logs sent and the report lines."""
+    number = params['fleet']
+    threads = min(params['threads'], number)
+    raise_fd_limit(number * FDS_PER_CLIENT + FDS_SPARE)
+
+    context = zmq.Context(threads)
+    context.set(zmq.MAX_SOCKETS, number + FDS_SPARE)
+    clients = [FleetClient(context, params,
+                           fleet_host(params['fleet_prefix'], ndx))
+               for ndx in range(number)]
+
+    rate = params['rate']
+    count = params['count']
+    start = time.time() + 0.01
+    deadline = None
+    if params['duration_s']:
+        deadline = start + params['duration_s']
+        count = None
+    results = [None] * threads
+
+    def sender(ndx):
+        mine = clients[ndx::threads]
+        if not rate:
+            send_round_robin(mine, count, params['log_msg'])
+        else:
+            schedules = []
+            for client_ndx in range(len(mine)):
+                # Spread the starts so the fleet sends evenly.
+                offset = (client_ndx * threads + ndx) / rate
+                times = arrival_times(start + offset, rate / number,
+                                      params['arrivals'] == 'poisson',
+                                      params['burst_rate'] / number,
+                                      params['burst_secs'],
+                                      params['burst_every_s'])
+                schedules.append(client_schedule(client_ndx, times, count,
+                                                 deadline))
+            results[ndx] = send_schedule(mine, schedules,
+                                         params['log_msg'], start)
+        for client in mine:
+            client.flush()
+
+    workers = []
+    for ndx in range(threads):
+        worker = threading.Thread(target=sender, args=(ndx,))
+        worker.start()
+        workers.append(worker)
+    for worker in workers:
+        worker.join()
+
+    # Wait for the queued logs to reach the server.
+    for client in clients:
+        client.close()
+    context.term()
+    lines = [fleet_report(params, clients, time.time() - start)]
+    if rate:
+        lines.append(load_report(params, results))
+    return sum([client.flow.sent_count for client in clients]), lines
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+"""
+A logging.Handler that sends to log_server.py.
+
+    import logging
+    from log_handler import ZmqLogHandler
+
+    handler = ZmqLogHandler('tcp://localhost:5555')
+    logging.getLogger().addHandler(handler)
+    logging.warning('Sensor %d reads %.1f', 3, 21.5)
+    ...
+    handler.close()     # or logging.shutdown()
+
+Logging a record costs the calling thread an append to
+a queue, nothing more. The lock logging.Handler takes
+around each record gets skipped, as the append needs
+none. Any number of threads may log at once.
+
+A background thread owns the ZeroMQ socket. It formats
+the queued records, then sends them in batches of up
+to batch_size, see log_wire.py, with any partial batch
+sent every batch_linger_ms. The host name prefixes each
+log as with log_client.py. Unicode messages get sent as UTF-8.
+
+Records get formatted on the background thread, so
+objects passed as arguments must not change after the
+logging call. Format them into the message if they do.
+
+The queue holds at most queue_max records. Records
+logged while it is full get dropped and counted, so a
+slow or missing server never blocks the caller. The
+background thread sends as the --overflow policy of
+log_client.py says, block by default.
+"""
+
+import logging
+import platform
+import sys
+import threading
+from collections import deque
+
+import zmq
+
+from log_client import BatchSender, OverflowSender, server_endpoint
+
+# Format of the records sent. log_server adds the time.
+DEFAULT_FORMAT = '%(levelname)s %(name)s: %(message)s'
+
+
+class ZmqLogHandler(logging.Handler):
+    """Send log records to log_server from a background
+    thread. See above.
+
+    flush() waits, up to close_timeout_ms, until the
+    records logged so far have been sent. close() does
+    too, then stops the background thread. A thread
+    still blocked on a send then gets stopped by closing
+    the ZeroMQ context.
+    """
+
+    def __init__(self, endpoint='tcp://localhost:5555', level=logging.NOTSET,
+                 batch_size=100, batch_linger_ms=100, queue_max=100000,
+                 overflow='block', sndhwm=1000, linger_ms=1000,
+                 close_timeout_ms=5000, host=None):
+        logging.Handler.__init__(self, level)
+        self.setFormatter(logging.Formatter(DEFAULT_FORMAT))
+        self.endpoint = server_endpoint(endpoint)
+        self.batch_size = batch_size
+        self.batch_linger = batch_linger_ms / 1000.0
+        self.queue_max = queue_max
+        self.overflow = overflow
+        self.sndhwm = sndhwm
+        self.linger_ms = linger_ms
+        self.close_timeout = close_timeout_ms / 1000.0
+        self.host = host or platform.node()
+        self.queue = deque()    # LogRecord, flush Event or None to stop
+        self.wakeup = threading.Event()
+        self.drop_count = 0
+        self.error_count = 0    # Logs lost to errors sending them
+        self.flow = None
+        self.batcher = None
+        self.context = zmq.Context()
+        self.thread = threading.Thread(target=self.run,
+                                       name='ZmqLogHandler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def handle(self, record):
+        """Queue record unless filtered out, without the
+        lock logging.Handler would take."""
+        queued = self.filter(record)
+        if queued:
+            self.emit(record)
+        return queued
+
+    def emit(self, record):
+        """Queue record for the background thread, or drop
+        it if the queue is full."""
+        queue = self.queue
+        if len(queue) >= self.queue_max:
+            self.drop_count += 1
+            return
+        queue.append(record)
+        if len(queue) == self.batch_size:
+            self.wakeup.set()
+
+    def run(self):
+        """Background thread: send the queued records until
+        told to stop. The socket gets closed however the
+        thread ends, so close() can always terminate the
+        context."""
+        socket = self.context.socket(zmq.PUSH)
+        linger_ms = self.linger_ms
+        try:
+            socket.setsockopt(zmq.SNDHWM, self.sndhwm)
+            socket.setsockopt(zmq.LINGER, linger_ms)
+            socket.connect(self.endpoint)
+            self.flow = OverflowSender(socket, self.overflow)
+            self.batcher = BatchSender(socket, self.batch_size,
+                                       flow=self.flow, host=self.host)
+            self.send_queued()
+        except zmq.ContextTerminated:
+            # close() gave up waiting. Drop whatever is left.
+            linger_ms = 0
+        finally:
+            socket.close(linger=linger_ms)
+
+    def send_queued(self):
+        """Format and send the queued records, every
+        batch_linger secs or once a batch is ready."""
+        queue = self.queue
+        while True:
+            self.wakeup.wait(self.batch_linger)
+            self.wakeup.clear()
+            while queue:
+                record = queue.popleft()
+                if isinstance(record, logging.LogRecord):
+                    self.send_record(record)
+                    continue
+                self.send_batch()
+                self.flow.flush()
+                if record is None:
+                    return
+                record.set()
+            self.send_batch()
+
+    def send_record(self, record):
+        """Format record and add it to the batch. A record
+        that cannot be formatted or sent gets reported with
+        handleError() and the thread carries on."""
+        try:
+            msg = self.format(record)
+            if isinstance(msg, unicode):
+                msg = msg.encode('utf-8')
+        except Exception:
+            self.handleError(record)
+            return
+        try:
+            self.batcher.send(msg)
+        except zmq.ContextTerminated:
+            raise
+        except Exception:
+            self.drop_batch()
+            self.handleError(record)
+
+    def send_batch(self):
+        """Send any partial batch. One that cannot be sent
+        gets dropped and the thread carries on."""
+        try:
+            self.batcher.flush()
+        except zmq.ContextTerminated:
+            raise
+        except Exception as err:
+            self.drop_batch()
+            sys.stderr.write('ZmqLogHandler dropped a batch:%s\n' % err)
+
+    def drop_batch(self):
+        """Drop the logs of the batch that failed to send."""
+        batcher = self.batcher
+        self.error_count += len(batcher.records)
+        batcher.records = []
+
+    def flush(self):
+        """Wait until the records logged so far have been sent."""
+        if not self.thread.is_alive():
+            return
+        flushed = threading.Event()
+        self.queue.append(flushed)
+        self.wakeup.set()
+        flushed.wait(self.close_timeout)
+
+    def close(self):
+        """Send the records logged so far, then stop."""
+        if self.thread.is_alive():
+            self.queue.append(None)
+            self.wakeup.set()
+            self.thread.join(self.close_timeout)
+        if not self.context.closed:
+            # run() closes the socket as it stops, at once if
+            # a send still blocked raises ContextTerminated,
+            # so the term does not wait on it.
+            self.context.term()
+            self.thread.join(self.close_timeout)
+        logging.Handler.close(self)
+
+    def report(self):
+        """Answer a one line summary of the records sent and lost."""
+        line = 'handler dropped:%d' % self.drop_count
+        if self.flow is not None:
+            line += ' %s %s' % (self.batcher.report(), self.flow.report())
+        return line + ' errors:%d' % self.error_count
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""
+Open loop load generation for log_client.py --rate.
+
+Every log has an intended send time taken from a
+schedule fixed in advance: arrivals at a constant
+rate or as a Poisson process, with optional bursts
+at a higher rate. A sender that falls behind sends
+at once to catch up rather than pushing the rest of
+the schedule back. A slow send then shows up as lag
+instead of quietly lowering the rate, the coordinated
+omission of a client that sleeps between sends.
+
+With --send-time, each batch carries the intended
+time of its first log, so the delivery latency the
+server measures includes any lag.
+
+--threads runs several senders in this process, each
+with its own socket and an equal share of the rate.
+"""
+
+import random
+import threading
+import time
+
+from log_client import HOST_PREFIX, connect_socket, make_senders
+from log_stats import DELIVERY_BUCKETS, Histogram
+
+
+def rate_at(elapsed, rate, burst_rate=0, burst_secs=0, burst_every_s=0):
+    """Answer the target rate elapsed secs into the schedule.
+    The first burst_secs of every burst_every_s secs run
+    at burst_rate."""
+    if burst_every_s and burst_rate and elapsed % burst_every_s < burst_secs:
+        return burst_rate
+    return rate
+
+
+def arrival_times(start, rate, poisson=False, burst_rate=0, burst_secs=0,
+                  burst_every_s=0, rng=random):
+    """Yield the intended send times of a schedule beginning
+    at start, forever. Gaps are 1/rate secs, or drawn from
+    an exponential distribution for Poisson arrivals."""
+    when = start
+    while True:
+        current = rate_at(when - start, rate, burst_rate, burst_secs,
+                          burst_every_s)
+        if poisson:
+            when += rng.expovariate(current)
+        else:
+            when += 1.0 / current
+        yield when
+
+
+class LoadStats(object):
+    """What a sender did against its schedule.
+
+    lag is how late each log got sent after its
+    intended time, counted into a histogram.
+    """
+
+    def __init__(self, start):
+        self.start = start
+        self.sent = 0
+        self.last_intended = start
+        self.last_sent = start
+        self.lag = Histogram(DELIVERY_BUCKETS)
+        self.max_lag = 0.0
+
+    def record(self, intended, sent):
+        """Count a log intended for, and sent at, these times."""
+        self.sent += 1
+        self.last_intended = intended
+        self.last_sent = sent
+        lag = sent - intended
+        self.lag.observe(lag)
+        if lag > self.max_lag:
+            self.max_lag = lag
+
+
+def send_load(send, start, times, count, log_msg, name='', deadline=None):
+    """Send up to count logs through send(msg, intended) at
+    the intended times yielded by times for a schedule
+    beginning at start. Stops at the first intended time
+    past the optional deadline. Answers the LoadStats."""
+    stats = LoadStats(start)
+    ndx = 0
+    for intended in times:
+        if ndx >= count or (deadline is not None and intended > deadline):
+            break
+        delay = intended - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        send('%s%d: %s' % (name, ndx, log_msg), intended)
+        stats.record(intended, time.time())
+        ndx += 1
+    return stats
+
+
+def load_report(params, all_stats):
+    """Answer a one line summary of the load sent by every
+    thread: the target rate, the rate the schedule called
+    for, the rate achieved and the lag behind schedule."""
+    start = min([stats.start for stats in all_stats])
+    sent = sum([stats.sent for stats in all_stats])
+    intended_secs = max([stats.last_intended for stats in all_stats]) - start
+    sent_secs = max([stats.last_sent for stats in all_stats]) - start
+    lag = Histogram(DELIVERY_BUCKETS)
+    for stats in all_stats:
+        lag.add(stats.lag)
+    return ('load target_rate:%.1f intended_rate:%.1f achieved_rate:%.1f '
+            'sent:%d lag_p50:%.6f lag_p99:%.6f lag_max:%.6f' %
+            (params['rate'],
+             sent / intended_secs if intended_secs > 0 else 0.0,
+             sent / sent_secs if sent_secs > 0 else 0.0,
+             sent, lag.quantile(0.5), lag.quantile(0.99),
+             max([stats.max_lag for stats in all_stats])))
+
+
+def run_load(params, context, socket):
+    """Send --count logs, or for --duration-s, on the
+    schedule set by params. The first thread sends on
+    socket, each other thread on a socket of its own.
+    Answers the number of logs sent and the report lines."""
+    threads = params['threads']
+    count = params['count']
+    start = time.time() + 0.01
+    deadline = None
+    if params['duration_s']:
+        deadline = start + params['duration_s']
+        count = float('inf')
+    prefix = HOST_PREFIX
+    results = [None] * threads
+    reports = [None] * threads
+    sent = [0] * threads
+
+    def sender(ndx, sock):
+        flow, batcher = make_senders(sock, params)
+
+        def send(msg, intended):
+            if batcher:
+                batcher.send(msg, intended)
+            else:
+                flow.send([prefix + msg])
+
+        share = count
+        if deadline is None:
+            share = count // threads + (1 if ndx < count % threads else 0)
+        times = arrival_times(start, params['rate'] / threads,
+                              params['arrivals'] == 'poisson',
+                              params['burst_rate'] / threads,
+                              params['burst_secs'],
+                              params['burst_every_s'])
+        name = '%d.' % ndx if threads > 1 else ''
+        results[ndx] = send_load(send, start, times, share,
+                                 params['log_msg'], name, deadline)
+        if batcher:
+            batcher.flush()
+        flow.flush()
+        reports[ndx] = flow.report()
+        sent[ndx] = flow.sent_count
+        if sock is not socket:
+            sock.close()
+
+    workers = []
+    for ndx in range(threads):
+        sock = socket if ndx == 0 else connect_socket(context, params)
+        worker = threading.Thread(target=sender, args=(ndx, sock))
+        worker.start()
+        workers.append(worker)
+    for worker in workers:
+        worker.join()
+    return sum(sent), [load_report(params, results)] + reports
@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+def usage(exit_code):
+    print(' '.join(sys.argv) + """\n
+Print the logs written by log_server.py between
+two times.
+
+Lines of a log start with their receive time
+and are in time order. A binary search on the
+line start times finds the first line of the
+time range without reading the log. Only the
+lines in the range get read.
+
+The rotated segments of the log and the shards
+written by --workers get searched as well. A
+segment that cannot hold the time range gets
+skipped. Compressed segments get read from the
+start.
+
+Usage:
+    ./log_query.py [--log=aname] [--start=time] [--end=time]
+        [--host=ahostname] [--contains=text]
+        [--format=text/binary]
+
+Where:
+    --log=aname       - The log filename used by log_server.
+                        Default: ./log.log
+    --start=time      - Print logs received at or after time.
+                        Default: the start of the log
+    --end=time        - Print logs received before time.
+                        Default: the end of the log
+    --host=ahostname  - Print only logs from this host.
+    --contains=text   - Print only logs containing text.
+    --format=text/binary - The --format used by log_server.
+                        Default: text
+
+Times are in local time, like the log:
+    2017-12-09 10:02
+    2017-12-09 10:02:30
+    2017-12-09 10:02:30.250000
+
+For example, what happened between 10:02 and 10:05:
+    ./log_query.py --start='2017-12-09 10:02' --end='2017-12-09 10:05'
+    """)
+    sys.exit(exit_code)
+
+
+import glob
+import gzip
+import heapq
+import mmap
+import os
+import re
+import sys
+import time
+from datetime import datetime, timedelta
+
+from log_rotate import COMPRESSED_SUFFIX, SEGMENT_TIME_FORMAT
+from log_segment import (INDEX_SUFFIX,
+                         find_offset,
+                         format_text,
+                         iter_records,
+                         read_index)
+
+# Formats accepted by --start and --end
+TIME_FORMATS = [
+    '%Y-%m-%d %H:%M:%S.%f',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d %H:%M',
+]
+
+# Format of a line start time made comparable as a string.
+KEY_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+# Rotated segment: aname.20171209-141928 with optional .N and .gz
+SEGMENT_RE = re.compile(r'\.(\d{8}-\d{6})(\.\d+)?(\.gz)?$')
+
+
+def dict_to_cmd_string(params):
+    """Utility to format run-time parameters as if
+    they came from the command line.
+
+    Input: The params as created by process_cmd_line.
+    Output: Formatted string of run-time switches."""
+
+    out = ""
+    for key, value in params.items():
+        out = out + ('%s=%s ' % (key, value))
+    return out
+
+
+def parse_time(arg):
+    """Answer the datetime for a --start or --end value.
+    None if arg matches none of the TIME_FORMATS."""
+    for fmt in TIME_FORMATS:
+        try:
+            return datetime.strptime(arg, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def process_cmd_line(argv):
+    """
+    Command line code to handle user params
+    """
+
+    params = {
+        # The log written by log_server
+        'log_filename': './log.log',
+
+        # Time range. None means unbounded.
+        'start': None,
+        'end': None,
+
+        # Filters. None means no filter.
+        'host': None,
+        'contains': None,
+
+        # The --format of log_server
+        'format': 'text',
+    }
+
+    import getopt
+    try:
+        opts, _ = getopt.gnu_getopt(
+                argv, '',
+                    ['log=',        # Name of log file.
+                     'start=',      # Start of time range
+                     'end=',        # End of time range
+                     'host=',       # Host filter
+                     'contains=',   # Substring filter
+                     'format=',     # text or binary
+                     'help'         # Print help message then exit.
+                     ])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage(1)
+
+    for opt, arg in opts:
+        if opt == '--help':
+            usage(0)
+        if opt == '--log':
+            params['log_filename'] = arg
+            continue
+        if opt in ['--start', '--end']:
+            when = parse_time(arg)
+            if when is None:
+                print('Invalid %s time:%s' % (opt, arg))
+                usage(1)
+            params[opt[2:]] = when
+            continue
+        if opt == '--host':
+            params['host'] = arg
+            continue
+        if opt == '--contains':
+            params['contains'] = arg
+            continue
+        if opt == '--format':
+            if arg not in ['text', 'binary']:
+                print('Invalid --format value:%s' % arg)
+                usage(1)
+            params['format'] = arg
+            continue
+
+    # Announce our run-time parameters on stderr
+    # so stdout holds only the logs.
+    sys.stderr.write('%s %s\n' %
+            (sys.argv[0], dict_to_cmd_string(params)))
+    return params
+
+
+def time_key(when):
+    """Answer a datetime as a string that compares
+    like the start time of a log line."""
+    return when.strftime(KEY_FORMAT)
+
+
+def time_to_ns(when):
+    """Answer a local datetime as nanoseconds since the epoch,
+    like the timestamps of binary records."""
+    return int(time.mktime(when.timetuple())) * 1000000000 + \
+            when.microsecond * 1000
+
+
+def line_key(line):
+    """Answer the start time of a log line as a string
+    comparable with time_key(). str(datetime) leaves off
+    the microseconds when they are 0."""
+    stamp = ' '.join(line.split(' ', 2)[:2])
+    if len(stamp) == 19:
+        stamp += '.000000'
+    return stamp
+
+
+def line_start(mm, pos):
+    """Answer the offset of the first line starting at or after pos."""
+    if pos == 0:
+        return 0
+    newline = mm.find('\n', pos - 1)
+    if newline < 0:
+        return len(mm)
+    return newline + 1
+
+
+def lower_bound(mm, key):
+    """Binary search the mapped log for the offset of the
+    first line starting at or after key."""
+    size = len(mm)
+    low, high = 0, size
+    while low < high:
+        mid = (low + high) // 2
+        start = line_start(mm, mid)
+        if start >= size or line_key(mm[start:start + 40]) >= key:
+            high = mid
+        else:
+            low = mid + 1
+    return line_start(mm, low)
+
+
+def iter_text_log(filename, start_key, end_key):
+    """Yield the lines of a text log in the time range.
+    Binary searches for the range then reads only
+    the lines in it."""
+    if os.path.getsize(filename) == 0:
+        return
+    with open(filename, 'rb') as handle:
+        mm = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            begin = lower_bound(mm, start_key) if start_key else 0
+            finish = lower_bound(mm, end_key) if end_key else len(mm)
+            pos = begin
+            while pos < finish:
+                newline = mm.find('\n', pos, finish)
+                end = finish if newline < 0 else newline + 1
+                yield mm[pos:end]
+                pos = end
+        finally:
+            mm.close()
+
+
+def iter_text_gz(filename, start_key, end_key):
+    """Yield the lines of a compressed text segment in
+    the time range. Reads from the start but stops at
+    the end of the range."""
+    with gzip.open(filename, 'rb') as handle:
+        for line in handle:
+            key = line_key(line)
+            if start_key and key < start_key:
+                continue
+            if end_key and key >= end_key:
+                return
+            yield line
+
+
+def iter_binary_log(filename, start_ns, end_ns):
+    """Yield the records of a binary segment in the time range
+    as text lines. The side index gives the offset to start
+    reading. A compressed segment gets read from the start."""
+    index_name = filename
+    if filename.endswith(COMPRESSED_SUFFIX):
+        index_name = filename[:-len(COMPRESSED_SUFFIX)]
+        handle = gzip.open(filename, 'rb')
+        offset = 0
+    else:
+        handle = open(filename, 'rb')
+        offset = 0
+        if start_ns is not None:
+            offset = find_offset(read_index(index_name + INDEX_SUFFIX),
+                                 start_ns)
+    try:
+        for ts_ns, msg, _ in iter_records(handle, offset):
+            if start_ns is not None and ts_ns < start_ns:
+                continue
+            if end_ns is not None and ts_ns >= end_ns:
+                return
+            yield format_text(ts_ns, msg)
+    finally:
+        handle.close()
+
+
+def segment_time(filename):
+    """Answer the rotation time in the name of a
+    rotated segment. None for any other file."""
+    match = SEGMENT_RE.search(filename)
+    if match is None:
+        return None
+    return datetime.strptime(match.group(1), SEGMENT_TIME_FORMAT)
+
+
+def is_segment(base, filename):
+    """Answer True if filename is a rotated segment of the
+    log base itself. The segments of a --workers shard of
+    base, base.shard00.20171209-141928 and the like, are
+    not."""
+    return SEGMENT_RE.match(filename[len(base):]) is not None
+
+
+def segment_order(filename):
+    """Sort key putting the rotated segments of a log in time order."""
+    count = SEGMENT_RE.search(filename).group(2)
+    return segment_time(filename), int(count[1:]) if count else 0
+
+
+def stream_files(base):
+    """Answer the files of the log base in time order:
+    its rotated segments then the current log."""
+    segments = [name for name in glob.glob(base + '.*')
+                if is_segment(base, name)]
+    segments.sort(key=segment_order)
+    if os.path.isfile(base):
+        return segments + [base]
+    return segments
+
+
+def find_streams(log_filename):
+    """Answer the logs written under log_filename as a list
+    of streams. Each stream is the list of its files in
+    time order: the rotated segments then the current log.
+    The log itself and each --workers shard are a stream."""
+    bases = [log_filename] + sorted(glob.glob(log_filename + '.shard[0-9][0-9]'))
+    streams = []
+    for base in bases:
+        files = stream_files(base)
+        if files:
+            streams.append(files)
+    return streams
+
+
+def iter_stream(files, params):
+    """Yield the lines in the time range from the files
+    of one stream. A rotated segment holds only logs
+    received before its rotation time, so segments
+    rotated before the range get skipped and the stream
+    ends after the segment rotated after the range."""
+    start, end = params['start'], params['end']
+    binary = params['format'] == 'binary'
+    if binary:
+        low = None if start is None else time_to_ns(start)
+        high = None if end is None else time_to_ns(end)
+    else:
+        low = None if start is None else time_key(start)
+        high = None if end is None else time_key(end)
+
+    for filename in files:
+        rotated = segment_time(filename)
+        # Segment names have 1 sec resolution.
+        if rotated is not None and start is not None and \
+                rotated + timedelta(seconds=1) < start:
+            continue
+        if binary:
+            lines = iter_binary_log(filename, low, high)
+        elif filename.endswith(COMPRESSED_SUFFIX):
+            lines = iter_text_gz(filename, low, high)
+        else:
+            lines = iter_text_log(filename, low, high)
+        for line in lines:
+            yield line
+        if rotated is not None and end is not None and rotated >= end:
+            return
+
+
+def query(params):
+    """Yield the lines of every stream of the log in the
+    time range, merged in time order, that pass the
+    host and substring filters."""
+    streams = [iter_stream(files, params)
+               for files in find_streams(params['log_filename'])]
+    host = params['host']
+    contains = params['contains']
+    for line in heapq.merge(*streams):
+        if host is not None:
+            fields = line.split(' ', 3)
+            if len(fields) < 3 or fields[2] != host:
+                continue
+        if contains is not None and contains not in line:
+            continue
+        yield line
+
+
+def mainline():
+    params = process_cmd_line(sys.argv[1:])
+    write = sys.stdout.write
+    for line in query(params):
+        write(line)
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    mainline()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+Log rotation for log_server.py
+
+A log rolls over when it reaches a size or when
+a wall clock interval expires. The closed log gets
+renamed to a segment named after the time of the
+rollover:
+    log.log -> log.log.20171209-141928
+A second rollover within the same second adds a count:
+    log.log.20171209-141928.1
+
+Segments get gzip compressed by a pool of worker
+processes so compression never blocks receiving:
+    log.log.20171209-141928 -> log.log.20171209-141928.gz
+The compressed file gets written under a temporary
+name and renamed when complete. A segment therefore
+exists either uncompressed or compressed, never
+half written.
+"""
+
+import gzip
+import multiprocessing
+import os
+import shutil
+import time
+
+# Timestamp format of rotated segment names. These sort in time order.
+SEGMENT_TIME_FORMAT = '%Y%m%d-%H%M%S'
+
+# Suffix of a compressed segment.
+COMPRESSED_SUFFIX = '.gz'
+
+
+def compress_segment(path):
+    """Gzip compress the segment at path then remove it.
+    Runs in a pool worker process.
+    Answers the name of the compressed segment."""
+    gz_path = path + COMPRESSED_SUFFIX
+    tmp_path = gz_path + '.tmp'
+    with open(path, 'rb') as src:
+        with gzip.open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+    os.rename(tmp_path, gz_path)
+    os.remove(path)
+    return gz_path
+
+
+def segment_name(log_filename, when):
+    """Answer an unused segment name for log_filename
+    rotated at time when."""
+    base = '%s.%s' % (log_filename,
+            time.strftime(SEGMENT_TIME_FORMAT, time.localtime(when)))
+    name = base
+    count = 0
+    while os.path.exists(name) or \
+            os.path.exists(name + COMPRESSED_SUFFIX):
+        count += 1
+        name = '%s.%d' % (base, count)
+    return name
+
+
+class LogRotator(object):
+    """Decide when a log should roll over, rename it
+    and hand the segment to the compression pool.
+
+        rotate_bytes      - roll over at this many bytes
+        rotate_interval_s - roll over after this many seconds
+        compress          - gzip the rotated segments?
+        compress_workers  - processes in the compression pool
+    A policy of 0 is never used.
+    """
+
+    def __init__(self, params):
+        self.rotate_bytes = params['rotate_bytes']
+        self.rotate_interval = params['rotate_interval_s']
+        self.last_rotate = time.time()
+        self.rotate_count = 0
+
+        self.pool = None
+        if params['compress']:
+            self.pool = multiprocessing.Pool(params['compress_workers'])
+        self.pending = []   # Compressions not yet known to be done
+
+    def due(self, file_bytes):
+        """Answer True when a log of file_bytes should roll over."""
+        if self.rotate_bytes and file_bytes >= self.rotate_bytes:
+            return True
+        if self.rotate_interval and \
+                time.time() - self.last_rotate >= self.rotate_interval:
+            return True
+        return False
+
+    def rotate(self, log_filename):
+        """Rename the closed log to a new segment and queue
+        it for compression. Answers the segment name."""
+        now = time.time()
+        segment = segment_name(log_filename, now)
+        os.rename(log_filename, segment)
+        self.last_rotate = now
+        self.rotate_count += 1
+        if self.pool is not None:
+            self.pending = [result for result in self.pending
+                            if not result.ready()]
+            self.pending.append(
+                    self.pool.apply_async(compress_segment, (segment,)))
+        return segment
+
+    def close(self):
+        """Wait for queued compressions to finish.
+        Report any that failed."""
+        if self.pool is None:
+            return
+        self.pool.close()
+        self.pool.join()
+        for result in self.pending:
+            try:
+                result.get()
+            except Exception as err:
+                print('Compression failed:%s' % str(err))
+        self.pending = []
+        self.pool = None
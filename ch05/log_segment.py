@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""
+Binary log segments for log_server.py --format=binary
+
+Each record in a segment is a 16 byte header
+followed by the message:
+    length  - 4 bytes, length of the message
+    ts_ns   - 8 bytes, receive time in nanoseconds
+              since the epoch
+    crc     - 4 bytes, CRC32 of ts_ns and the message
+    message - length bytes
+All integers are big endian.
+
+A sparse side index, the segment name plus '.idx',
+holds a (ts_ns, offset) entry every index_every records.
+Each entry is 16 bytes:
+    ts_ns   - 8 bytes, timestamp of the record
+    offset  - 8 bytes, byte offset of the record
+A binary search of the index finds the record to start
+reading for any time without reading the segment.
+
+After a crash the tail record may be torn. Recovery
+starts at the last index entry, checks each record
+and truncates the segment after the last good one.
+Index entries past the end get dropped.
+"""
+
+import bisect
+import os
+import struct
+import time
+import zlib
+from datetime import datetime
+
+# Record header: length, ts_ns, crc
+HEADER = struct.Struct('>IQI')
+
+# Index entry: ts_ns, offset
+INDEX_ENTRY = struct.Struct('>QQ')
+
+# The index of a segment is the segment name plus this.
+INDEX_SUFFIX = '.idx'
+
+
+def time_ns():
+    """Answer the current time in nanoseconds since the epoch."""
+    return int(time.time() * 1e9)
+
+
+def record_crc(ts_ns, msg):
+    """Answer the CRC32 of the timestamp and message."""
+    crc = zlib.crc32(struct.pack('>Q', ts_ns))
+    return zlib.crc32(msg, crc) & 0xffffffff
+
+
+def pack_record(ts_ns, msg):
+    """Answer the bytes of a record for msg received at ts_ns."""
+    return HEADER.pack(len(msg), ts_ns, record_crc(ts_ns, msg)) + msg
+
+
+def format_text(ts_ns, msg):
+    """Answer a record as the line the text format would
+    have written for it."""
+    return '%s %s\n' % (str(datetime.fromtimestamp(ts_ns / 1e9)), msg)
+
+
+def iter_records(handle, offset=0):
+    """Yield (ts_ns, msg, offset) for each good record in
+    the open segment handle from offset on. Stops at the
+    end of the segment or at a torn or corrupt record."""
+    handle.seek(offset)
+    while True:
+        header = handle.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return
+        length, ts_ns, crc = HEADER.unpack(header)
+        msg = handle.read(length)
+        if len(msg) < length or record_crc(ts_ns, msg) != crc:
+            return
+        yield ts_ns, msg, offset
+        offset += HEADER.size + length
+
+
+def read_index(index_filename):
+    """Answer the list of (ts_ns, offset) entries in an index.
+    A torn tail entry gets ignored. A missing index is empty."""
+    if not os.path.isfile(index_filename):
+        return []
+    with open(index_filename, 'rb') as handle:
+        data = handle.read()
+    count = len(data) // INDEX_ENTRY.size
+    return [INDEX_ENTRY.unpack_from(data, ndx * INDEX_ENTRY.size)
+            for ndx in range(count)]
+
+
+def find_offset(entries, ts_ns):
+    """Binary search the index entries. Answer the offset
+    of the last indexed record at or before ts_ns. Reading
+    from there finds every record at or after ts_ns."""
+    ndx = bisect.bisect_right(entries, (ts_ns, float('inf'))) - 1
+    if ndx < 0:
+        return 0
+    return entries[ndx][1]
+
+
+def recover_segment(log_filename, index_every):
+    """Truncate a torn tail record from a segment and
+    drop index entries past its end.
+
+    Answers the number of records after the last index
+    entry, counting the indexed record itself. Answers
+    index_every when the index is empty so the next
+    record written gets indexed."""
+    index_filename = log_filename + INDEX_SUFFIX
+    size = os.path.getsize(log_filename)
+    entries = [entry for entry in read_index(index_filename)
+               if entry[1] < size]
+
+    start = entries[-1][1] if entries else 0
+    end = start
+    records = 0
+    with open(log_filename, 'r+b') as handle:
+        for _, msg, offset in iter_records(handle, start):
+            end = offset + HEADER.size + len(msg)
+            records += 1
+        if end < size:
+            print('%s: truncating %d bytes of torn records' %
+                    (log_filename, size - end))
+            handle.truncate(end)
+
+    with open(index_filename, 'wb') as handle:
+        handle.write(''.join([INDEX_ENTRY.pack(*entry) for entry in entries]))
+    if not entries:
+        return index_every
+    return records
+
+
+class SegmentIndex(object):
+    """Maintain the side index of a segment being written.
+
+    Recovers the segment when opened. Then indexes every
+    index_every records as batches get written.
+    """
+
+    def __init__(self, log_file_handle, index_every):
+        self.index_every = index_every
+        log_filename = log_file_handle.name
+        self.since_index = recover_segment(log_filename, index_every)
+        self.file_offset = os.path.getsize(log_filename)
+        self.index_filename = log_filename + INDEX_SUFFIX
+        self.index_handle = open(self.index_filename, 'ab')
+
+    def add_data(self, data):
+        """Index the records in data, just written
+        to the end of the segment."""
+        entries = []
+        pos = 0
+        while pos < len(data):
+            length, ts_ns, _ = HEADER.unpack_from(data, pos)
+            if self.since_index >= self.index_every:
+                entries.append(INDEX_ENTRY.pack(ts_ns, self.file_offset + pos))
+                self.since_index = 0
+            self.since_index += 1
+            pos += HEADER.size + length
+        self.file_offset += len(data)
+        if entries:
+            self.index_handle.write(''.join(entries))
+
+    def flush(self):
+        self.index_handle.flush()
+
+    def close(self):
+        self.index_handle.close()
@@ -8,8 +8,21 @@ in any way, they just get written to the
 log file.
 
 Usage:
-    ./log_server.py [--log=aname] [--port=port#]
+    ./log_server.py [--log=aname] [--port=port#] [--bind=endpoint,...]
         [--log-append=true/false] [--echo=true/false]
+        [--batch-max=N] [--flush-every-n=N]
+        [--flush-bytes=N] [--flush-interval-ms=N]
+        [--pipeline=true/false] [--pipeline-depth=N]
+        [--workers=N]
+        [--rotate-bytes=N] [--rotate-interval-s=N]
+        [--compress=true/false] [--compress-workers=N]
+        [--format=text/binary] [--index-every=N]
+        [--pub-port=port#]
+        [--control-port=port#] [--control=endpoint]
+        [--async=true/false] [--stats-interval-s=N]
+        [--rcvhwm=N] [--sndhwm=N]
+        [--linger-ms=N] [--send-timeout-ms=N]
+        [--metrics-port=port#] [--reliable=true/false]
 
 Where:
     --log=aname   - The log filename for output.
@@ -19,20 +32,193 @@ Where:
                     Default: true
     --port=port#  - The port number for messaging.
                     Default: 5555
+    --bind=endpoint,... - Receive logs on each of these
+                    ZeroMQ endpoints, all at once. May be
+                    repeated. For example:
+                      --bind=tcp://*:5555,ipc:///tmp/iotlog.sock
+                    Local clients log faster over ipc than
+                    over tcp to localhost.
+                    Default: tcp://*:port#
     --echo=true/false - true to echo to stdout, 
                     false means keep silent
                     Default: false meaning no echo
+    --batch-max=N - Most messages drained from the socket
+                    and written with a single write().
+                    Default: 1000
+    --flush-every-n=N - Flush after N messages written.
+                    Default: 1 meaning flush every batch
+    --flush-bytes=N - Flush after N bytes written.
+                    Default: 0 meaning not used
+    --flush-interval-ms=N - Flush pending writes at least
+                    every N milliseconds.
+                    Default: 0 meaning not used
+    A flush happens when any flush policy triggers.
+    Setting all flush policies to 0 leaves flushing
+    to the file buffering and the OS.
+    --pipeline=true/false - true to receive on one thread
+                    and write to disk on another.
+                    Default: false
+    --pipeline-depth=N - Most batches waiting for the
+                    writer thread before the receiver stalls.
+                    Default: 100
+    --workers=N   - Number of worker processes writing
+                    the log. With N > 1 this process only
+                    forwards messages round robin to the
+                    workers and each worker writes its own
+                    shard: aname.shard00, aname.shard01, ...
+                    Use merge_shards() to merge the shards
+                    and their rotated segments into a
+                    single time ordered log, or query
+                    them with log_query.py.
+                    Default: 1 meaning no workers
+    --rotate-bytes=N - Roll the log over to a new file
+                    when it reaches N bytes.
+                    Default: 0 meaning not used
+    --rotate-interval-s=N - Roll the log over every N seconds.
+                    Default: 0 meaning not used
+    The rolled over log gets renamed with the time of
+    the rollover: aname.20171209-141928
+    --compress=true/false - gzip rolled over logs in
+                    background processes.
+                    Default: true
+    --compress-workers=N - Number of compression processes.
+                    Default: 1
+    --format=text/binary - text writes each message as a
+                    line prefixed with the receive time.
+                    binary writes length prefixed records
+                    with a nanosecond timestamp and a CRC
+                    plus a side index, aname.idx.
+                    See log_segment.py.
+                    Default: text
+    --index-every=N - For --format=binary, index every
+                    N records.
+                    Default: 1000
+    --pub-port=port# - Republish every timestamped log
+                    as a text line on a PUB socket
+                    bound to this port. Each log is a
+                    two part message: the host name as
+                    the topic, then the line. Subscribers
+                    filter by host name prefix inside
+                    ZeroMQ. See log_tail.py.
+                    Default: 0 meaning no publishing
+    --control-port=port# - Accept control commands on a
+                    REP socket bound to this port on
+                    localhost. See log_control.py.
+                    Default: 0 meaning no control socket
+    --control=endpoint - Accept control commands on a REP
+                    socket bound to any ZeroMQ endpoint,
+                    for example: ipc:///tmp/log_server.ctl
+    --async=true/false - true to run receiving, flushing,
+                    rotation and stats as tasks on an event
+                    loop with writes on an executor thread.
+                    See log_server_async.py. Not used
+                    with --workers.
+                    Default: false
+    --stats-interval-s=N - With --async, publish the stats
+                    every N seconds on the --pub-port
+                    under the @stats topic, or print them
+                    without a --pub-port.
+                    Default: 0 meaning no stats
+    --rcvhwm=N    - Most messages ZeroMQ queues on the
+                    receiving socket for each client. A
+                    client at the limit blocks or drops
+                    according to its --overflow.
+                    Default: 1000
+    --sndhwm=N    - Most messages queued on the --pub-port
+                    socket for each subscriber. Logs for a
+                    subscriber at the limit get dropped.
+                    Default: 1000
+    --linger-ms=N - How long unsent messages keep a socket
+                    open at exit. -1 waits until sent.
+                    Default: 0 meaning drop them
+    --send-timeout-ms=N - With --workers, most millisecs
+                    to wait for a worker to take a message.
+                    A message that times out gets dropped
+                    and counted in msgs_dropped.
+                    Default: -1 meaning wait forever
+    --metrics-port=port# - Serve the stats in the Prometheus
+                    text format at http://127.0.0.1:port#/metrics
+                    The stats command of the control socket
+                    answers the same stats as JSON.
+                    See log_stats.py. Not used with --workers.
+                    Default: 0 meaning no metrics
+    --reliable=true/false - Receive on a ROUTER socket from
+                    log_client --reliable and ack the logs
+                    of each sender once they are written.
+                    A log the server already has gets
+                    dropped, so a client may resend any log
+                    it has no ack for. A batch that skips
+                    ahead of its sender's sequence gets
+                    dropped until the missing logs arrive.
+                    The log gets flushed before each ack,
+                    whatever the flush policy.
+                    Other messages get written as usual
+                    but never acked. Logs already written
+                    before a restart may get written again.
+                    Not used with --workers, --pipeline or
+                    --async, which write after receiving.
+                    Default: false
+    With a control socket, logs are never parsed for
+    commands. The @EXIT@ and @ECHO=...@ messages below
+    are then ordinary logs.
+
+Control commands:
+    exit          - Write everything queued, then exit.
+    echo true/false - Turn echo to stdout on or off.
+    flush         - Flush the log file.
+    reopen        - Close and reopen the log file.
+    stats         - Reply with the server counters as JSON.
+    drain [N [millisecs]] - Wait until N logs have been
+                    received in total, or for at most
+                    millisecs, then write and flush
+                    everything queued. Replies with the
+                    stats, drained true if N arrived.
+                    Lets a test wait exactly as long as
+                    the server needs.
 
 Terminate this program with Ctrl-C
 or:
+    Send the exit control command.
+or, without a control socket:
     Send a log message with @EXIT@ as the message.
     """)
 
+import heapq
+import json
+import multiprocessing
+import os
+import shutil
 import sys
+import tempfile
+import threading
+import time
 from datetime import datetime
 
 import zmq
 
+from log_query import iter_stream, stream_files
+from log_rotate import LogRotator
+from log_stats import (DELIVERY_BUCKETS,
+                       Histogram,
+                       MetricsServer,
+                       SequenceTracker)
+from log_wire import (FLAG_COMPRESSED,
+                      LENGTH,
+                      BatchError,
+                      batch_flags,
+                      batch_send_time,
+                      batch_sequence,
+                      batch_unacked,
+                      decode_batch,
+                      encode_ack,
+                      is_batch)
+from log_segment import (HEADER,
+                         INDEX_SUFFIX,
+                         SegmentIndex,
+                         format_text,
+                         pack_record,
+                         time_ns)
+
 # Sending this as a message causes the server to exit.
 # The count also gets set to 1 after sending this message,
 EXIT_SERVER = '@EXIT@'
@@ -68,6 +254,15 @@ def echo_message_detector(msg):
     return ECHO_SWITCH
 
 
+def inband_exit(msgs, start):
+    """Answer the index of the first EXIT_SERVER message
+    in msgs from start on, None if there is none."""
+    for ndx in xrange(start, len(msgs)):
+        if EXIT_SERVER in msgs[ndx]:
+            return ndx
+    return None
+
+
 def dict_to_cmd_string(params):
     """Utility to format run-time parameters as if
     they came from the command line.
@@ -81,6 +276,41 @@ def dict_to_cmd_string(params):
     return out
 
 
+def int_param(opt, arg):
+    """Convert the value of a numeric option to a
+    non-negative integer. Invalid values print the usage
+    and exit."""
+    try:
+        value = int(arg)
+    except ValueError as err:
+        print('Invalid %s value:%s' % (opt, err))
+        usage()
+        sys.exit(1)
+    if value < 0:
+        print('Invalid %s value:%d must not be negative' % (opt, value))
+        usage()
+        sys.exit(1)
+    return value
+
+
+def millisecs_param(opt, arg):
+    """Convert the value of a ZeroMQ time option to an
+    integer. -1 means forever. Invalid values print the
+    usage and exit."""
+    value = int_param(opt, '0' if arg == '-1' else arg)
+    return -1 if arg == '-1' else value
+
+
+def set_socket_options(socket, params):
+    """Apply the high water marks, linger and send timeout
+    in params to socket. Must be called before the socket
+    binds or connects."""
+    socket.setsockopt(zmq.RCVHWM, params['rcvhwm'])
+    socket.setsockopt(zmq.SNDHWM, params['sndhwm'])
+    socket.setsockopt(zmq.LINGER, params['linger_ms'])
+    socket.setsockopt(zmq.SNDTIMEO, params['send_timeout_ms'])
+
+
 def process_cmd_line(argv):
     """
     Command line code to handle user params
@@ -98,8 +328,72 @@ def process_cmd_line(argv):
         # Use the default port
         'port': 5555,
 
+        # Endpoints to receive logs on. Empty means
+        # tcp on the port.
+        'bind': [],
+
         # True to echo msg to stdout
-        'echo': False
+        'echo': False,
+
+        # Most messages drained from the socket per write()
+        'batch_max': 1000,
+
+        # Flush policies. 0 disables a policy.
+        'flush_every_n': 1,
+        'flush_bytes': 0,
+        'flush_interval_ms': 0,
+
+        # Write to disk on a separate thread?
+        'pipeline': False,
+
+        # Most batches queued for the writer thread
+        'pipeline_depth': 100,
+
+        # Worker processes, each writing a shard of the log
+        'workers': 1,
+
+        # Log rotation policies. 0 disables a policy.
+        'rotate_bytes': 0,
+        'rotate_interval_s': 0,
+
+        # gzip rotated logs in this many background processes
+        'compress': True,
+        'compress_workers': 1,
+
+        # Output format: text or binary
+        'format': 'text',
+
+        # For binary format, index every N records
+        'index_every': 1000,
+
+        # Port to republish logs on. 0 means no publishing.
+        'pub_port': 0,
+
+        # Endpoint for control commands. None means commands
+        # come in band as logs.
+        'control': None,
+
+        # Run as tasks on an event loop?
+        'async': False,
+
+        # With async, seconds between stats. 0 means no stats.
+        'stats_interval_s': 0,
+
+        # ZeroMQ high water marks, in messages
+        'rcvhwm': 1000,
+        'sndhwm': 1000,
+
+        # Millisecs unsent messages wait at exit. -1 means forever.
+        'linger_ms': 0,
+
+        # Millisecs a send may block. -1 means forever.
+        'send_timeout_ms': -1,
+
+        # Local HTTP port for Prometheus. 0 means none.
+        'metrics_port': 0,
+
+        # Ack logs from DEALER clients on a ROUTER socket?
+        'reliable': False,
     }
 
     import getopt
@@ -107,10 +401,35 @@ def process_cmd_line(argv):
         opts, _ = getopt.gnu_getopt(
                 argv, '',
                     ['port=',       # Port number.
+                     'bind=',       # Endpoints to receive logs on
                      'log=',        # Name of log file.
                      'echo=',       # Echo logs to console
                      'log-append=', # Append to existing log or not?
                      'log_append=', # Append to existing log or not?
+                     'batch-max=',  # Most messages per write
+                     'flush-every-n=',      # Flush after N messages
+                     'flush-bytes=',        # Flush after N bytes
+                     'flush-interval-ms=',  # Flush every N millisecs
+                     'pipeline=',   # Separate writer thread
+                     'pipeline-depth=',     # Batches queued for writer
+                     'workers=',    # Worker processes writing shards
+                     'rotate-bytes=',       # Roll over at N bytes
+                     'rotate-interval-s=',  # Roll over every N secs
+                     'compress=',   # gzip rotated logs
+                     'compress-workers=',   # Compression processes
+                     'format=',     # text or binary
+                     'index-every=',        # Binary index spacing
+                     'pub-port=',   # Port to republish logs on
+                     'control-port=',       # Port for control commands
+                     'control=',    # Endpoint for control commands
+                     'async=',      # Event loop server
+                     'stats-interval-s=',   # Secs between stats
+                     'rcvhwm=',     # Receive high water mark
+                     'sndhwm=',     # Send high water mark
+                     'linger-ms=',  # Wait for unsent messages at exit
+                     'send-timeout-ms=',    # Most millisecs a send blocks
+                     'metrics-port=',       # Prometheus HTTP port
+                     'reliable=',   # Ack written logs
                      'help'         # Print help message then exit.
                      ])
     except getopt.GetoptError as err:
@@ -132,6 +451,10 @@ def process_cmd_line(argv):
                 sys.exit(1)
             params['port'] = int(arg) # Must convert to integer
             continue
+        if opt == '--bind':
+            params['bind'] += [endpoint for endpoint in arg.split(',')
+                               if endpoint]
+            continue
         if opt in ['--log-append', '--log_append']:
             params['log_append'] = True if arg.lower() == 'true' else False
             continue
@@ -141,6 +464,106 @@ def process_cmd_line(argv):
         if opt == '--log':
             params['log_filename'] = arg
             continue
+        if opt == '--batch-max':
+            params['batch_max'] = int_param(opt, arg)
+            if params['batch_max'] == 0:
+                print('Invalid --batch-max value:must be at least 1')
+                usage()
+                sys.exit(1)
+            continue
+        if opt == '--flush-every-n':
+            params['flush_every_n'] = int_param(opt, arg)
+            continue
+        if opt == '--flush-bytes':
+            params['flush_bytes'] = int_param(opt, arg)
+            continue
+        if opt == '--flush-interval-ms':
+            params['flush_interval_ms'] = int_param(opt, arg)
+            continue
+        if opt == '--pipeline':
+            params['pipeline'] = True if arg.lower() == 'true' else False
+            continue
+        if opt == '--pipeline-depth':
+            params['pipeline_depth'] = int_param(opt, arg)
+            if params['pipeline_depth'] == 0:
+                print('Invalid --pipeline-depth value:must be at least 1')
+                usage()
+                sys.exit(1)
+            continue
+        if opt == '--workers':
+            params['workers'] = int_param(opt, arg)
+            if params['workers'] == 0:
+                print('Invalid --workers value:must be at least 1')
+                usage()
+                sys.exit(1)
+            continue
+        if opt == '--rotate-bytes':
+            params['rotate_bytes'] = int_param(opt, arg)
+            continue
+        if opt == '--rotate-interval-s':
+            params['rotate_interval_s'] = int_param(opt, arg)
+            continue
+        if opt == '--compress':
+            params['compress'] = True if arg.lower() == 'true' else False
+            continue
+        if opt == '--compress-workers':
+            params['compress_workers'] = int_param(opt, arg)
+            if params['compress_workers'] == 0:
+                print('Invalid --compress-workers value:must be at least 1')
+                usage()
+                sys.exit(1)
+            continue
+        if opt == '--format':
+            if arg not in STAMPS:
+                print('Invalid --format value:%s' % arg)
+                usage()
+                sys.exit(1)
+            params['format'] = arg
+            continue
+        if opt == '--index-every':
+            params['index_every'] = int_param(opt, arg)
+            if params['index_every'] == 0:
+                print('Invalid --index-every value:must be at least 1')
+                usage()
+                sys.exit(1)
+            continue
+        if opt == '--pub-port':
+            params['pub_port'] = int_param(opt, arg)
+            continue
+        if opt == '--control-port':
+            params['control'] = 'tcp://127.0.0.1:%d' % int_param(opt, arg)
+            continue
+        if opt == '--control':
+            params['control'] = arg
+            continue
+        if opt == '--async':
+            params['async'] = True if arg.lower() == 'true' else False
+            continue
+        if opt == '--stats-interval-s':
+            params['stats_interval_s'] = int_param(opt, arg)
+            continue
+        if opt in ['--rcvhwm', '--sndhwm']:
+            params[opt[2:]] = int_param(opt, arg)
+            continue
+        if opt in ['--linger-ms', '--send-timeout-ms']:
+            params[opt[2:].replace('-', '_')] = millisecs_param(opt, arg)
+            continue
+        if opt == '--metrics-port':
+            params['metrics_port'] = int_param(opt, arg)
+            continue
+        if opt == '--reliable':
+            params['reliable'] = True if arg.lower() == 'true' else False
+            continue
+
+    if params['reliable'] and (params['workers'] > 1 or
+                               params['pipeline'] or params['async']):
+        print('Invalid options:--reliable not used with '
+              '--workers, --pipeline or --async')
+        usage()
+        sys.exit(1)
+
+    if not params['bind']:
+        params['bind'] = ['tcp://*:%d' % params['port']]
 
     # Set ECHO_SWITCH to the optional setting.
     ECHO_SWITCH = params['echo']
@@ -158,6 +581,8 @@ def open_log_file_for_writing(params):
         # Depending upon runtime options, append to existing log
         # or wipe existing log, if any.
         wipe_or_append = 'a' if params['log_append'] else 'wa'
+        if params['format'] == 'binary':
+            wipe_or_append += 'b'
         log_file_handle = open(params['log_filename'], wipe_or_append)
     except Exception as err:
         # Due to the nature of this logic, this should never happen.
@@ -166,32 +591,1179 @@ def open_log_file_for_writing(params):
         sys.exit(1)
     return log_file_handle
 
-def mainline():
+class LogWriter(object):
+    """Group commit for the log file.
+
+    Each batch of timestamped messages gets written with
+    one write() call. Flushing happens only when one of
+    the flush policies says so:
+        flush_every_n     - messages written since the last flush
+        flush_bytes       - bytes written since the last flush
+        flush_interval_ms - time since the last flush
+    A policy of 0 is never used.
+
+    With a rotate policy the log rolls over after the
+    write that reaches it. See log_rotate.py.
+
+    For the binary format the side index gets updated
+    with each write. See log_segment.py.
+
+    The time taken by each write and each flush gets
+    counted into a histogram. See log_stats.py.
+    """
+
+    def __init__(self, log_file_handle, params):
+        self.log_file_handle = log_file_handle
+        self.index_every = params['index_every']
+        self.index = None
+        if params['format'] == 'binary':
+            self.index = SegmentIndex(log_file_handle, self.index_every)
+        self.file_bytes = os.fstat(log_file_handle.fileno()).st_size
+        self.rotator = None
+        if params['rotate_bytes'] or params['rotate_interval_s']:
+            self.rotator = LogRotator(params)
+        self.flush_every_n = params['flush_every_n']
+        self.flush_bytes = params['flush_bytes']
+        self.flush_interval = params['flush_interval_ms'] / 1000.0
+
+        # Messages and bytes written but not yet flushed.
+        self.pending_msgs = 0
+        self.pending_bytes = 0
+        self.last_flush = time.time()
+
+        # Totals for the life of the writer.
+        self.msg_count = 0
+        self.write_count = 0
+        self.flush_count = 0
+        self.write_hist = Histogram()
+        self.flush_hist = Histogram()
+
+    def write_batch(self, lines):
+        """Write a list of timestamped messages with one write()
+        then flush if a count or byte policy triggers."""
+        self.write_data(''.join(lines), len(lines))
+
+    def write_data(self, data, msg_count):
+        """Write msg_count messages already joined into data
+        then flush if a count or byte policy triggers."""
+        start = time.time()
+        self.log_file_handle.write(data)
+        if self.index:
+            self.index.add_data(data)
+        self.write_hist.observe(time.time() - start)
+        self.msg_count += msg_count
+        self.write_count += 1
+        self.file_bytes += len(data)
+        self.pending_msgs += msg_count
+        self.pending_bytes += len(data)
+        if self.flush_every_n and self.pending_msgs >= self.flush_every_n:
+            self.flush()
+        elif self.flush_bytes and self.pending_bytes >= self.flush_bytes:
+            self.flush()
+        if self.rotator and self.rotator.due(self.file_bytes):
+            self.rotate()
+
+    def rotate(self):
+        """Close the log, hand it to the rotator and
+        continue writing to a fresh log of the same name."""
+        segment = self.rotator.rotate
+        self.reopen(lambda log_filename:
+                self.rename_index(log_filename, segment(log_filename)))
+
+    def rename_index(self, log_filename, segment):
+        """Move the index of a rotated log along with it."""
+        if self.index:
+            os.rename(log_filename + INDEX_SUFFIX, segment + INDEX_SUFFIX)
+
+    def reopen(self, closed=None):
+        """Close the log and open it again by name, for
+        example after something else has moved it.
+        closed(log_filename), if given, runs in between."""
+        if self.pending_msgs:
+            self.flush()
+        log_filename = self.log_file_handle.name
+        mode = 'ab' if self.index else 'a'
+        self.log_file_handle.close()
+        if self.index:
+            self.index.close()
+        if closed is not None:
+            closed(log_filename)
+        self.log_file_handle = open(log_filename, mode)
+        if self.index:
+            self.index = SegmentIndex(self.log_file_handle, self.index_every)
+        self.file_bytes = os.fstat(self.log_file_handle.fileno()).st_size
+
+    def stats(self):
+        """Answer the writer counters as a dict."""
+        return {
+            'msgs_written': self.msg_count,
+            'writes': self.write_count,
+            'flushes': self.flush_count,
+            'file_bytes': self.file_bytes,
+            'rotations': self.rotator.rotate_count if self.rotator else 0,
+            'write_seconds': self.write_hist.to_dict(),
+            'flush_seconds': self.flush_hist.to_dict(),
+        }
+
+    def flush(self):
+        """Flush unconditionally."""
+        start = time.time()
+        self.log_file_handle.flush()
+        if self.index:
+            self.index.flush()
+        self.last_flush = time.time()
+        self.flush_hist.observe(self.last_flush - start)
+        self.flush_count += 1
+        self.pending_msgs = 0
+        self.pending_bytes = 0
+
+    def sync(self):
+        """Flush everything written so far. Returns once
+        it is in the file."""
+        self.flush()
+
+    def flush_timeout(self):
+        """Answer the milliseconds until the interval flush is due.
+        None means no interval flush is waiting: either
+        the interval policy is off or nothing is pending."""
+        if not self.flush_interval or not self.pending_msgs:
+            return None
+        remaining = self.last_flush + self.flush_interval - time.time()
+        return max(0, int(remaining * 1000))
+
+    def flush_if_due(self):
+        """Flush if the interval policy has expired."""
+        if self.flush_timeout() == 0:
+            self.flush()
+
+    def close(self):
+        """Flush anything pending and close the log file.
+        Waits for background compression to finish."""
+        if self.pending_msgs:
+            self.flush()
+        self.log_file_handle.close()
+        if self.index:
+            self.index.close()
+        if self.rotator:
+            self.rotator.close()
+
+
+class PipelinedWriter(object):
+    """Double buffered writer.
+
+    The receiving thread joins each batch and hands it
+    over an inproc PAIR socket to a writer thread that
+    owns a LogWriter. A slow disk then stalls only the
+    writer thread until pipeline_depth batches are waiting.
+    Only then does the receiver block.
+
+    Presents the same interface as LogWriter so mainline
+    does not care which one it has. Interval flushes
+    happen on the writer thread.
+
+    For the receiver thread:
+        batches_sent - batches handed to the writer thread
+        max_depth    - most batches ever waiting
+        stall_count  - hand overs that had to block
+        stall_time   - seconds spent blocked in hand overs
+    """
+
+    # Sent in place of a message count to command the writer thread.
+    CLOSE = 'close'
+    FLUSH = 'flush'
+    REOPEN = 'reopen'
+    SYNC = 'sync'
+
+    def __init__(self, log_file_handle, params, context):
+        self.writer = LogWriter(log_file_handle, params)
+        endpoint = 'inproc://log_writer_%d' % id(self)
+
+        self.sender = context.socket(zmq.PAIR)
+        self.sender.set_hwm(params['pipeline_depth'])
+        self.sender.bind(endpoint)
+        receiver = context.socket(zmq.PAIR)
+        receiver.set_hwm(params['pipeline_depth'])
+        receiver.connect(endpoint)
+
+        self.batches_sent = 0
+        self.batches_written = 0    # Updated by the writer thread
+        self.max_depth = 0
+        self.stall_count = 0
+        self.stall_time = 0.0
+
+        self.thread = threading.Thread(target=self.run, args=(receiver,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def queue_depth(self):
+        """Answer the number of batches waiting for the writer thread."""
+        return self.batches_sent - self.batches_written
+
+    def write_batch(self, lines):
+        """Hand a list of timestamped messages to the writer thread.
+        Blocks only when pipeline_depth batches are waiting."""
+        frames = [str(len(lines)), ''.join(lines)]
+        try:
+            self.sender.send_multipart(frames, zmq.NOBLOCK)
+        except zmq.Again:
+            start = time.time()
+            self.sender.send_multipart(frames)
+            self.stall_count += 1
+            self.stall_time += time.time() - start
+        self.batches_sent += 1
+        self.max_depth = max(self.max_depth, self.queue_depth())
+
+    def flush_timeout(self):
+        """The writer thread handles interval flushes."""
+        return None
+
+    def flush_if_due(self):
+        """The writer thread handles interval flushes."""
+        pass
+
+    def flush(self):
+        """Have the writer thread flush after the queued batches."""
+        self.sender.send_multipart([self.FLUSH, ''])
+
+    def reopen(self):
+        """Have the writer thread reopen the log after
+        the queued batches."""
+        self.sender.send_multipart([self.REOPEN, ''])
+
+    def sync(self):
+        """Have the writer thread flush after the queued
+        batches. Returns once it has."""
+        self.sender.send_multipart([self.SYNC, ''])
+        self.sender.recv()
+
+    def stats(self):
+        """Answer the writer and pipeline counters as a dict."""
+        stats = self.writer.stats()
+        stats.update({
+            'batches_sent': self.batches_sent,
+            'queue_depth': self.queue_depth(),
+            'max_depth': self.max_depth,
+            'stalls': self.stall_count,
+            'stall_time': self.stall_time,
+        })
+        return stats
+
+    def close(self):
+        """Wait for the writer thread to write everything
+        queued, then flush and close the log file."""
+        self.sender.send_multipart([self.CLOSE, ''])
+        self.thread.join()
+        self.sender.close()
+        print('pipeline batches:%d max_depth:%d stalls:%d stall_time:%.3f' %
+                (self.batches_sent, self.max_depth,
+                 self.stall_count, self.stall_time))
+
+    def run(self, receiver):
+        """Writer thread: write batches as they arrive and flush
+        per the flush policies until told to close."""
+        writer = self.writer
+        while True:
+            if not receiver.poll(writer.flush_timeout()):
+                writer.flush_if_due()
+                continue
+            msg_count, data = receiver.recv_multipart()
+            if msg_count == self.CLOSE:
+                break
+            if msg_count == self.FLUSH:
+                writer.flush()
+                continue
+            if msg_count == self.REOPEN:
+                writer.reopen()
+                continue
+            if msg_count == self.SYNC:
+                writer.flush()
+                receiver.send(self.SYNC)
+                continue
+            writer.write_data(data, int(msg_count))
+            self.batches_written += 1
+            writer.flush_if_due()
+        writer.close()
+        receiver.close()
+
+
+def make_writer(log_file_handle, params, context):
+    """Answer the writer that params asks for."""
+    if params['pipeline']:
+        return PipelinedWriter(log_file_handle, params, context)
+    return LogWriter(log_file_handle, params)
+
+
+def stamp_text(msg):
+    """Answer msg as a log line prefixed with the current time."""
+    return '%s %s\n' % (str(datetime.now()), msg)
+
+
+def stamp_binary(msg):
+    """Answer msg as a binary record stamped with the current time."""
+    return pack_record(time_ns(), msg)
 
-    # If use has entered command line options, process them.
-    params = process_cmd_line(sys.argv[1:])
 
+# How to stamp a message for each --format
+STAMPS = {
+    'text': stamp_text,
+    'binary': stamp_binary,
+}
+
+
+class LogPublisher(object):
+    """Republish timestamped logs on a PUB socket.
+
+    Each log goes out as [host, line] so subscribers
+    can filter by host inside ZeroMQ. Binary records
+    get published as the text line of the record.
+    A PUB socket never blocks. Logs for subscribers
+    that fall behind get dropped by ZeroMQ.
+
+    Unsent logs wait --linger-ms at close.
+
+    The socket binds the --pub-port unless given
+    an endpoint to connect to. The workers of
+    --workers=N connect to their front process.
+    """
+
+    def __init__(self, context, params, endpoint=None):
+        self.binary = params['format'] == 'binary'
+        self.socket = context.socket(zmq.PUB)
+        set_socket_options(self.socket, params)
+        if endpoint is None:
+            self.socket.bind('tcp://*:%d' % params['pub_port'])
+        else:
+            self.socket.connect(endpoint)
+        self.publish_count = 0
+
+    def publish(self, msg, record):
+        """Publish msg, timestamped as record."""
+        if self.binary:
+            record = format_text(HEADER.unpack_from(record)[1], msg)
+        self.socket.send_multipart([msg.split(' ', 1)[0], record])
+        self.publish_count += 1
+
+    def close(self):
+        self.socket.close()
+
+
+def compression_ratio(uncompressed_bytes, compressed_bytes):
+    """Answer how many times smaller compression made the data."""
+    if not compressed_bytes:
+        return 0.0
+    return float(uncompressed_bytes) / compressed_bytes
+
+
+class Receiver(object):
+    """Receive and timestamp the messages on a socket.
+
+    With inband set, every message gets checked for the
+    EXIT_SERVER and ECHO_SERVER commands. A server with
+    a control socket clears inband so messages are
+    never parsed.
+
+    A batch from log_client --batch-size carries many
+    logs in one message. See log_wire.py. Each log in
+    a batch gets handled like a message of its own.
+
+    msg_count is the total of messages received,
+    record_count the total of logs in them.
+
+    For compressed batches, the payload bytes received,
+    the bytes after decompression and the seconds spent
+    decoding get totalled.
+
+    Each batch gets received off the socket, then
+    formatted. The time of each stage gets counted
+    into a histogram. See log_stats.py.
+
+    A batch from log_client --send-time carries the
+    time its oldest log was sent. The delivery latency,
+    receive time minus send time, gets counted into a
+    histogram for the host of the batch and one for
+    all hosts. The clocks of remote clients must be in
+    sync for this to mean anything.
+
+    A batch from log_client --sequence carries the
+    sequence number of its first log. Records missing
+    from or repeated in the stream of each sender get
+    counted as the batches arrive.
+    """
+
+    def __init__(self, socket, batch_max, stamp=stamp_text,
+                 publisher=None, inband=True):
+        self.socket = socket
+        self.batch_max = batch_max
+        self.stamp = stamp
+        self.publisher = publisher
+        self.inband = inband
+        self.msg_count = 0
+        self.record_count = 0
+        self.batch_count = 0
+        self.bad_batch_count = 0
+        self.compressed_bytes = 0
+        self.uncompressed_bytes = 0
+        self.decompress_time = 0.0
+        self.byte_count = 0
+        self.start_time = time.time()
+        self.recv_hist = Histogram()
+        self.format_hist = Histogram()
+        self.delivery_hist = Histogram(DELIVERY_BUCKETS)
+        self.host_delivery = {}     # Host name: Histogram
+        self.sequences = SequenceTracker()
+
+    def receive_batch(self):
+        """Drain the messages already queued on the socket without
+        blocking. Stops when the queue is empty, batch_max
+        messages have been read or an exit message arrives.
+        Each message gets handed to the optional publisher.
+
+        Answers (lines, exit_requested) where lines are the
+        messages timestamped by stamp ready for writing.
+        """
+        socket = self.socket
+        inband = self.inband
+        start = time.time()
+        msgs = []
+        exit_requested = False
+        while len(msgs) < self.batch_max:
+            try:
+                msg = socket.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            self.msg_count += 1
+            count = len(msgs)
+            if socket.rcvmore:
+                msgs.extend(self.unpack([msg] + socket.recv_multipart()))
+            else:
+                msgs.append(msg)
+            if inband:
+                exit_at = inband_exit(msgs, count)
+                if exit_at is not None:
+                    # Leave whatever follows an exit on the socket.
+                    del msgs[exit_at + 1:]
+                    exit_requested = True
+                    break
+        if not msgs:
+            return [], exit_requested
+        received = time.time()
+        self.recv_hist.observe(received - start)
+        self.record_count += len(msgs)
+        self.byte_count += sum([len(msg) for msg in msgs])
+
+        stamp = self.stamp
+        publisher = self.publisher
+        lines = []
+        # The exit message gets echoed, not logged.
+        exit_msg = msgs.pop() if exit_requested else None
+        for msg in msgs:
+            if inband:
+                echo_message_detector(msg)
+            if ECHO_SWITCH:
+                sys.stdout.write(stamp_text(msg))
+            record = stamp(msg)
+            if publisher is not None:
+                publisher.publish(msg, record)
+            lines.append(record)
+        if exit_msg is not None and echo_message_detector(exit_msg):
+            sys.stdout.write(stamp_text(exit_msg))
+        self.format_hist.observe(time.time() - received)
+        return lines, exit_requested
+
+    def unpack(self, frames):
+        """Answer the logs in a multi frame message. A batch
+        that cannot be decoded gets counted and dropped. Any
+        other message has a log in each frame."""
+        if not is_batch(frames):
+            return frames
+        start = time.time()
+        try:
+            msgs = decode_batch(frames)
+        except BatchError as err:
+            self.bad_batch_count += 1
+            sys.stderr.write('Dropped bad batch:%s\n' % str(err))
+            return ()
+        self.batch_count += 1
+        send_time = batch_send_time(frames)
+        sequence = batch_sequence(frames)
+        if msgs and (send_time is not None or sequence is not None):
+            host = msgs[0].split(' ', 1)[0]
+            if send_time is not None:
+                self.observe_delivery(host, time.time() - send_time / 1e9)
+        if batch_flags(frames) & FLAG_COMPRESSED:
+            self.decompress_time += time.time() - start
+            self.compressed_bytes += len(frames[1])
+            self.uncompressed_bytes += sum([len(msg) for msg in msgs]) + \
+                    LENGTH.size * len(msgs)
+        if msgs and sequence is not None:
+            msgs = self.observe_sequence(host, sequence[0], sequence[1],
+                                         msgs, batch_unacked(frames))
+        return msgs
+
+    def observe_sequence(self, host, session, first, msgs, unacked=None):
+        """Count the numbered msgs of a batch from host.
+        unacked is the oldest log the sender has no ack
+        for, if the batch says. Answers the msgs to write:
+        all of them."""
+        self.sequences.observe(host, session, first, len(msgs))
+        return msgs
+
+    def acknowledge(self, writer):
+        """Ack the logs written by writer since the last
+        call. Only a ReliableReceiver sends acks."""
+        pass
+
+    def observe_delivery(self, host, latency):
+        """Count the delivery latency of a batch from host."""
+        hist = self.host_delivery.get(host)
+        if hist is None:
+            hist = self.host_delivery[host] = Histogram(DELIVERY_BUCKETS)
+        hist.observe(latency)
+        self.delivery_hist.observe(latency)
+
+    def delivery_latency(self):
+        """Answer the count, mean and percentiles of the
+        delivery latency for each host, in seconds."""
+        return dict([(host, hist.percentiles())
+                     for host, hist in self.host_delivery.items()])
+
+    def latency_report(self):
+        """Answer the delivery latency as lines of text,
+        one per host."""
+        return ['delivery host:%s count:%d mean:%.6f '
+                'p50:%.6f p99:%.6f p999:%.6f' %
+                (host, latency['count'], latency['mean'],
+                 latency['p50'], latency['p99'], latency['p999'])
+                for host, latency in sorted(self.delivery_latency().items())]
+
+    def stats(self):
+        """Answer the receive counters as a dict. The rates
+        are averages since the receiver started."""
+        uptime = time.time() - self.start_time
+        stats = {
+            'uptime': uptime,
+            'msgs_received': self.msg_count,
+            'records_received': self.record_count,
+            'bytes_received': self.byte_count,
+            'records_per_sec': self.record_count / uptime,
+            'bytes_per_sec': self.byte_count / uptime,
+            'recv_seconds': self.recv_hist.to_dict(),
+            'format_seconds': self.format_hist.to_dict(),
+            'batches_received': self.batch_count,
+            'bad_batches': self.bad_batch_count,
+            'compressed_bytes': self.compressed_bytes,
+            'uncompressed_bytes': self.uncompressed_bytes,
+            'compression_ratio': compression_ratio(
+                self.uncompressed_bytes, self.compressed_bytes),
+            'decompress_time': self.decompress_time,
+            'delivery_seconds': self.delivery_hist.to_dict(),
+            'delivery_latency': self.delivery_latency(),
+        }
+        stats.update(self.sequences.stats())
+        if self.publisher is not None:
+            stats['msgs_published'] = self.publisher.publish_count
+        return stats
+
+
+class ReliableReceiver(Receiver):
+    """A Receiver for a ROUTER socket with log_client
+    --reliable senders on DEALER sockets.
+
+    Each message starts with the identity ZeroMQ gives
+    the connection of its sender. Batches must carry a
+    sequence. For each sender only logs numbered from
+    the next one expected get written:
+        - Logs seen before at the start of a batch, as
+          sent again for want of an ack, get dropped
+          and counted in records_duplicated.
+        - A batch that starts past the next one expected
+          gets dropped and counted in batches_early. The
+          sender sends it again after the missing logs.
+    A sender seen for the first time, as after a server
+    restart, gets expected from the oldest log it still
+    waits for an ack for, as its batches say. Any batch
+    past that is early. Without it, the sender may start
+    at any number.
+
+    Once the caller has written the logs, acknowledge()
+    flushes the writer, whatever its flush policy, then
+    sends each sender one ack for everything it sent:
+    the number of the next log expected. Acks that find
+    no room get dropped. A later ack covers them.
+    """
+
+    def __init__(self, socket, batch_max, stamp=stamp_text,
+                 publisher=None, inband=True):
+        Receiver.__init__(self, socket, batch_max, stamp, publisher, inband)
+        self.identity = None
+        self.acks = {}      # Identity: (session, next sequence)
+        self.early_count = 0
+        self.ack_count = 0
+
+    def unpack(self, frames):
+        """Answer the logs to write from a message, its
+        frames led by the identity of the sender."""
+        self.identity = frames[0]
+        frames = frames[1:]
+        if len(frames) == 1:
+            return frames
+        return Receiver.unpack(self, frames)
+
+    def observe_sequence(self, host, session, first, msgs, unacked=None):
+        """Answer the msgs of a batch never seen before and
+        queue the sender's ack. A batch that starts early
+        gets none of its msgs written."""
+        sequences = self.sequences
+        expected = sequences.expected(host, session)
+        if expected is None and unacked is not None:
+            # The logs before unacked were written and acked,
+            # maybe by an earlier run of the server.
+            sequences.start(host, session, unacked)
+            expected = unacked
+        if expected is not None and first > expected:
+            self.early_count += 1
+            msgs = []
+        else:
+            msgs = msgs[sequences.observe(host, session, first, len(msgs)):]
+            expected = sequences.expected(host, session)
+        self.acks[self.identity] = (session, expected)
+        return msgs
+
+    def acknowledge(self, writer):
+        """Flush what writer holds, then send each sender
+        the ack queued since the last call. A flush covers
+        every ack of a batch."""
+        if not self.acks:
+            return
+        if writer.pending_msgs:
+            writer.flush()
+        socket = self.socket
+        for identity, (session, expected) in self.acks.items():
+            try:
+                socket.send_multipart([identity,
+                                       encode_ack(session, expected)],
+                                      zmq.NOBLOCK)
+            except zmq.Again:
+                continue
+            self.ack_count += 1
+        self.acks.clear()
+
+    def stats(self):
+        """Answer the receive counters, acks included."""
+        stats = Receiver.stats(self)
+        stats['batches_early'] = self.early_count
+        stats['acks_sent'] = self.ack_count
+        return stats
+
+
+def server_stats(receiver, writer):
+    """Answer the receiver and writer counters as one dict."""
+    stats = receiver.stats()
+    stats.update(writer.stats())
+    return stats
+
+
+def control_command(request, receiver, writer):
+    """Carry out a control command other than exit.
+    Answers the reply for the control socket."""
+    global ECHO_SWITCH
+    command = request.split()
+    if command == ['echo', 'true']:
+        ECHO_SWITCH = True
+    elif command == ['echo', 'false']:
+        ECHO_SWITCH = False
+    elif command == ['flush']:
+        writer.flush()
+    elif command == ['reopen']:
+        writer.reopen()
+    elif command == ['stats']:
+        return json.dumps(server_stats(receiver, writer))
+    else:
+        return 'error: unknown command:%s' % request
+    return 'ok'
+
+
+def drain(receiver, writer):
+    """Write every message already queued on the socket."""
+    while True:
+        lines, exit_requested = receiver.receive_batch()
+        if lines:
+            writer.write_batch(lines)
+        receiver.acknowledge(writer)
+        if exit_requested or len(lines) < receiver.batch_max:
+            return
+
+
+def parse_drain(command):
+    """Answer (records, deadline) for the words of a
+    drain [N [millisecs]] command. deadline is None to
+    wait for ever. Answers None for a malformed command."""
+    if len(command) > 3 or not all([arg.isdigit() for arg in command[1:]]):
+        return None
+    records = int(command[1]) if len(command) > 1 else 0
+    deadline = None
+    if len(command) > 2:
+        deadline = time.time() + int(command[2]) / 1000.0
+    return records, deadline
+
+
+def drain_due(records_received, records, deadline):
+    """Answer True once a drain waiting for records need
+    wait no longer."""
+    return records_received >= records or \
+            (deadline is not None and time.time() >= deadline)
+
+
+def drain_timeout(deadline, timeout):
+    """Answer the poll timeout in millisecs, no later than
+    the deadline of a waiting drain."""
+    if deadline is None:
+        return timeout
+    remaining = max(0, int((deadline - time.time()) * 1000))
+    if timeout is None:
+        return remaining
+    return min(timeout, remaining)
+
+
+def drain_reply(stats, records):
+    """Answer the reply to a drain command as JSON: the
+    stats, with drained true if records have arrived."""
+    stats['drained'] = stats['records_received'] >= records
+    return json.dumps(stats)
+
+
+def serve(receiver, writer, control=None):
+    """Receive and write batches of messages until an exit
+    message or exit command arrives. Control commands on the
+    optional control socket get answered between batches.
+
+    The exit command writes everything already queued.
+    'exit N' waits until N messages have been received
+    in total, as the front process of --workers=N knows
+    how many it sent to each worker.
+
+    The drain command gets its reply once its logs have
+    arrived or its time is up. Messages keep being
+    received while it waits.
+    """
+    poller = zmq.Poller()
+    poller.register(receiver.socket, zmq.POLLIN)
+    if control is not None:
+        poller.register(control, zmq.POLLIN)
+    exit_after = None
+    waiting_drain = None    # (records, deadline)
+    while True:
+        # Wait for messages, but only until an interval
+        # flush or a drain deadline becomes due.
+        timeout = writer.flush_timeout()
+        if waiting_drain is not None:
+            timeout = drain_timeout(waiting_drain[1], timeout)
+        events = dict(poller.poll(timeout))
+        if control in events:
+            request = control.recv()
+            command = request.split()
+            if command == ['exit']:
+                drain(receiver, writer)
+                exit_after = receiver.msg_count
+            elif len(command) == 2 and command[0] == 'exit' and \
+                    command[1].isdigit():
+                exit_after = int(command[1])
+            elif command and command[0] == 'drain':
+                waiting_drain = parse_drain(command)
+                if waiting_drain is None:
+                    control.send('error: bad drain command:%s' % request)
+            else:
+                control.send(control_command(request, receiver, writer))
+        if receiver.socket in events:
+            lines, exit_requested = receiver.receive_batch()
+            if lines:
+                writer.write_batch(lines)
+            receiver.acknowledge(writer)
+            if exit_requested:
+                return
+        writer.flush_if_due()
+        if waiting_drain is not None and \
+                drain_due(receiver.record_count, *waiting_drain):
+            drain(receiver, writer)
+            writer.sync()
+            control.send(drain_reply(server_stats(receiver, writer),
+                                     waiting_drain[0]))
+            waiting_drain = None
+        if exit_after is not None and receiver.msg_count >= exit_after:
+            control.send('ok')
+            return
+
+
+def make_receiver(socket, params, publisher=None):
+    """Answer a Receiver for socket configured by params,
+    a ReliableReceiver with --reliable."""
+    receiver_class = ReliableReceiver if params['reliable'] else Receiver
+    return receiver_class(socket, params['batch_max'],
+                          STAMPS[params['format']],
+                          publisher, inband=params['control'] is None)
+
+
+def shard_filename(log_filename, shard):
+    """Answer the name of the log file written by worker shard.
+    All shards of a log share the log_filename prefix."""
+    return '%s.shard%02d' % (log_filename, shard)
+
+
+def merge_shards(filenames, out_handle, log_format='text'):
+    """Merge the shard logs in filenames into out_handle,
+    each with its rotated segments, compressed or not.
+    Every line starts with its timestamp and each shard
+    is already in time order, so a merge of the lines
+    yields a single time ordered log. Binary shards, as
+    written with log_format 'binary', merge into text
+    lines as log_query.py prints them."""
+    params = {'start': None, 'end': None, 'format': log_format}
+    streams = [iter_stream(stream_files(filename), params)
+               for filename in filenames]
+    out_handle.writelines(heapq.merge(*streams))
+
+
+def data_socket(context, params):
+    """Answer an unbound socket to receive logs on: a
+    ROUTER with --reliable, else a PULL."""
+    socket = context.socket(zmq.ROUTER if params['reliable'] else zmq.PULL)
+    set_socket_options(socket, params)
+    return socket
+
+
+def bind_data_socket(context, params):
+    """Answer a socket bound to every --bind endpoint.
+    ZeroMQ fair queues the messages from all of them."""
+    socket = data_socket(context, params)
+    for endpoint in params['bind']:
+        socket.bind(endpoint)
+    return socket
+
+
+def ipc_endpoint(ipc_dir, name):
+    """Answer the ipc endpoint called name in ipc_dir."""
+    return 'ipc://%s/%s' % (ipc_dir, name)
+
+
+def shard_worker(params, shard, ipc_dir):
+    """Worker process: write the messages forwarded by the
+    front process into this worker's shard of the log.
+    The front process and workers talk over ipc endpoints
+    in ipc_dir:
+        shardNN   - messages for worker NN
+        done      - a worker reports an exit message here
+                    so the front process can stop the others
+        pub       - published logs with --pub-port
+        controlNN - control commands for worker NN
+                    with a control socket
+    """
+    params = dict(params, log_filename=shard_filename(
+        params['log_filename'], shard))
     log_file_handle = open_log_file_for_writing(params)
 
-    # Establish a ZeroMQ Context and create a binding socket.
     context = zmq.Context()
+    writer = make_writer(log_file_handle, params, context)
     socket = context.socket(zmq.PULL)
+    set_socket_options(socket, params)
+    socket.connect(ipc_endpoint(ipc_dir, 'shard%02d' % shard))
+    done = context.socket(zmq.PUSH)
+    done.connect(ipc_endpoint(ipc_dir, 'done'))
+    publisher = None
+    if params['pub_port']:
+        publisher = LogPublisher(context, params,
+                ipc_endpoint(ipc_dir, 'pub'))
+    control = None
+    if params['control']:
+        control = context.socket(zmq.REP)
+        control.bind(ipc_endpoint(ipc_dir, 'control%02d' % shard))
+
+    serve(make_receiver(socket, params, publisher), writer, control)
+    writer.close()
+    if publisher:
+        publisher.close()
+    if control:
+        control.close()
+    else:
+        done.send(str(shard))
+    done.close()
+    socket.close(linger=0)
+    context.term()
+
+
+def forward_batch(frontend, backends, next_backend, batch_max, counts=None,
+                  drops=None):
+    """Forward the messages already queued on frontend to the
+    backends, round robin by batch. A backend that cannot take
+    the batch without blocking gets skipped. If all are busy,
+    block on the next one. A message still not taken when the
+    send timeout of the backend expires gets dropped. The
+    optional counts and drops lists hold the number of messages
+    sent to and dropped for each backend.
+
+    Answers the index of the backend to use next."""
+    count = len(backends)
+    while batch_max > 0:
+        try:
+            frames = frontend.recv_multipart(zmq.NOBLOCK)
+        except zmq.Again:
+            break
+        batch_max -= 1
+        for offset in range(count):
+            ndx = (next_backend + offset) % count
+            try:
+                backends[ndx].send_multipart(frames, zmq.NOBLOCK)
+                break
+            except zmq.Again:
+                continue
+        else:
+            ndx = next_backend
+            try:
+                backends[ndx].send_multipart(frames)
+            except zmq.Again:
+                if drops is not None:
+                    drops[ndx] += 1
+                continue
+        if counts is not None:
+            counts[ndx] += 1
+    return (next_backend + 1) % count
+
+
+def front_command(request, worker_controls, counts, drops):
+    """Relay a control command other than exit to every worker.
+    Answers the reply for the control socket. stats answers
+    the counters of each worker."""
+    replies = []
+    for worker_control in worker_controls:
+        worker_control.send(request)
+        replies.append(worker_control.recv())
+    if request.split() == ['stats']:
+        return json.dumps({
+            'msgs_forwarded': sum(counts),
+            'msgs_dropped': sum(drops),
+            'workers': [json.loads(reply) for reply in replies],
+        })
+    for reply in replies:
+        if reply != 'ok':
+            return reply
+    return 'ok'
 
-    # Bind the socket to the port
-    socket.bind('tcp://*:%d' % params['port'])
 
+def front_drain(records, deadline, frontend, backends, next_backend,
+                batch_max, worker_controls, counts, drops):
+    """Carry out a drain command for the front process.
+    Forwards everything queued, then drains each worker
+    until it has received every message sent to it. Stops
+    once records have arrived in total or the deadline
+    passes.
+
+    Answers (reply, next_backend)."""
     while True:
-        msg = socket.recv()
-        msg_timestamp = '%s %s\n' % (str(datetime.now()), msg)
-        #import pdb; pdb.set_trace()
-        if echo_message_detector(msg):
-            sys.stdout.write(msg_timestamp)
-        if EXIT_SERVER in msg:
-            print('server Exiting')
+        forwarded = -1
+        while forwarded != sum(counts) + sum(drops):
+            forwarded = sum(counts) + sum(drops)
+            next_backend = forward_batch(frontend, backends,
+                    next_backend, batch_max, counts, drops)
+        replies = []
+        for worker_control, count in zip(worker_controls, counts):
+            while True:
+                worker_control.send('drain')
+                reply = json.loads(worker_control.recv())
+                if reply['msgs_received'] >= count or \
+                        (deadline is not None and time.time() >= deadline):
+                    break
+                time.sleep(0.001)
+            replies.append(reply)
+        received = sum([reply['records_received'] for reply in replies])
+        if drain_due(received, records, deadline):
             break
-        log_file_handle.write(msg_timestamp)
-        # Comment out for production code. This slows the server down.
-        log_file_handle.flush() # Insist on writing immediately
+        frontend.poll(drain_timeout(deadline, 10))
+    return drain_reply({
+        'msgs_forwarded': sum(counts),
+        'msgs_dropped': sum(drops),
+        'records_received': received,
+        'workers': replies,
+    }, records), next_backend
+
+
+def run_sharded(params):
+    """Front process for --workers=N.
+
+    Each worker gets its own ipc PUSH socket, so messages
+    reach a worker in the order sent. An exit message gets
+    detected by whichever worker receives it. That worker
+    reports back and the front process forwards the exit
+    to the others after everything already sent to them.
+
+    With a control socket, the front process answers the
+    control commands. Exit tells each worker how many
+    messages were sent to it and waits for each to
+    write them all.
+
+    With --pub-port, the workers publish to an XSUB socket
+    and the front process forwards to subscribers on an
+    XPUB socket bound to the --pub-port.
+    """
+    ipc_dir = tempfile.mkdtemp(prefix='log_server_')
+    shards = range(params['workers'])
+
+    # Start the workers before this process creates a Context.
+    workers = []
+    for shard in shards:
+        worker = multiprocessing.Process(target=shard_worker,
+                args=(params, shard, ipc_dir))
+        worker.start()
+        workers.append(worker)
+
+    context = zmq.Context()
+    frontend = bind_data_socket(context, params)
+    done = context.socket(zmq.PULL)
+    done.bind(ipc_endpoint(ipc_dir, 'done'))
+    backends = []
+    for shard in shards:
+        backend = context.socket(zmq.PUSH)
+        set_socket_options(backend, params)
+        backend.set_hwm(params['batch_max'])
+        backend.bind(ipc_endpoint(ipc_dir, 'shard%02d' % shard))
+        backends.append(backend)
+    counts = [0 for shard in shards]
+    drops = [0 for shard in shards]
+
+    poller = zmq.Poller()
+    poller.register(frontend, zmq.POLLIN)
+    poller.register(done, zmq.POLLIN)
+    pub_sockets = []
+    if params['pub_port']:
+        xsub = context.socket(zmq.XSUB)
+        xsub.bind(ipc_endpoint(ipc_dir, 'pub'))
+        xpub = context.socket(zmq.XPUB)
+        set_socket_options(xpub, params)
+        xpub.bind('tcp://*:%d' % params['pub_port'])
+        poller.register(xsub, zmq.POLLIN)
+        poller.register(xpub, zmq.POLLIN)
+        pub_sockets = [xsub, xpub]
+    control = None
+    worker_controls = []
+    if params['control']:
+        control = context.socket(zmq.REP)
+        control.bind(params['control'])
+        poller.register(control, zmq.POLLIN)
+        for shard in shards:
+            worker_control = context.socket(zmq.REQ)
+            worker_control.connect(
+                    ipc_endpoint(ipc_dir, 'control%02d' % shard))
+            worker_controls.append(worker_control)
+
+    next_backend = 0
+    while True:
+        events = dict(poller.poll())
+        if frontend in events:
+            next_backend = forward_batch(frontend, backends,
+                    next_backend, params['batch_max'], counts, drops)
+        if pub_sockets:
+            # Logs flow xsub to xpub, subscriptions xpub to xsub.
+            if xsub in events:
+                xpub.send_multipart(xsub.recv_multipart())
+            if xpub in events:
+                xsub.send_multipart(xpub.recv_multipart())
+        if control in events:
+            request = control.recv()
+            command = request.split()
+            if command == ['exit']:
+                break
+            if command and command[0] == 'drain':
+                drain_request = parse_drain(command)
+                if drain_request is None:
+                    control.send('error: bad drain command:%s' % request)
+                    continue
+                records, deadline = drain_request
+                reply, next_backend = front_drain(records, deadline,
+                        frontend, backends, next_backend,
+                        params['batch_max'], worker_controls, counts, drops)
+                control.send(reply)
+                continue
+            control.send(front_command(request, worker_controls, counts,
+                                       drops))
+        if done in events:
+            break
+
+    if control is None:
+        # An exit message stopped one worker. Stop the others.
+        stopped = int(done.recv())
+        for shard, backend in enumerate(backends):
+            if shard != stopped:
+                backend.send(EXIT_SERVER)
+    else:
+        # Forward everything queued, then stop every worker
+        # once it has written what it was sent.
+        forwarded = -1
+        while forwarded != sum(counts) + sum(drops):
+            forwarded = sum(counts) + sum(drops)
+            next_backend = forward_batch(frontend, backends,
+                    next_backend, params['batch_max'], counts, drops)
+        for worker_control, count in zip(worker_controls, counts):
+            worker_control.send('exit %d' % count)
+            worker_control.recv()
+    for worker in workers:
+        worker.join()
+    if control is not None:
+        control.send('ok')
+    print('server Exiting')
+    for sock in backends + pub_sockets + worker_controls + [frontend, done]:
+        sock.close(linger=0)
+    if control is not None:
+        control.close()
+    context.term()
+    shutil.rmtree(ipc_dir, ignore_errors=True)
+
+
+def mainline():
+
+    # If use has entered command line options, process them.
+    params = process_cmd_line(sys.argv[1:])
+
+    if params['workers'] > 1:
+        run_sharded(params)
+        sys.exit(0)
+
+    # Establish a ZeroMQ Context and create a binding socket.
+    context = zmq.Context()
+    socket = bind_data_socket(context, params)
+
+    control = None
+    if params['control']:
+        control = context.socket(zmq.REP)
+        control.bind(params['control'])
+
+    if params['async']:
+        from log_server_async import AsyncServer
+        AsyncServer(params, context, [socket], control).run()
+        print('server Exiting')
+        if control:
+            control.close()
+        sys.exit(0)
+
+    log_file_handle = open_log_file_for_writing(params)
+    writer = make_writer(log_file_handle, params, context)
+    publisher = None
+    if params['pub_port']:
+        publisher = LogPublisher(context, params)
+    receiver = make_receiver(socket, params, publisher)
+    metrics = None
+    if params['metrics_port']:
+        metrics = MetricsServer(params['metrics_port'],
+                                lambda: server_stats(receiver, writer))
+
+    serve(receiver, writer, control)
+    for line in receiver.latency_report():
+        print(line)
+    print('server Exiting')
+    if metrics:
+        metrics.close()
+    writer.close()
+    if publisher:
+        publisher.close()
+    if control:
+        control.close()
     sys.exit(0)
 
 
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+"""
+Event loop server mode for log_server.py --async=true
+
+One thread runs an event loop over a zmq.Poller.
+Everything the server does is a task on that loop:
+    receive   - a reader task for each data socket
+    control   - a reader task for the control socket
+    flush     - a timer task every --flush-interval-ms
+    rotate    - a timer task every --rotate-interval-s
+    stats     - a timer task every --stats-interval-s
+With --metrics-port, the stats also get served over
+HTTP from a thread of their own. See log_stats.py.
+The timers replace the time checks the blocking
+server makes on every batch.
+
+File writes, flushes and rotations run in order on
+a single thread executor so a slow disk never stops
+the loop. Receiving blocks only when --pipeline-depth
+writes are waiting for the executor.
+
+This code base runs on Python 2, so the loop is built
+on zmq.Poller rather than asyncio and zmq.asyncio.
+"""
+
+import heapq
+import itertools
+import json
+import sys
+import time
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+import zmq
+
+from log_server import (LogPublisher,
+                        LogWriter,
+                        control_command,
+                        drain_due,
+                        drain_reply,
+                        drain_timeout,
+                        make_receiver,
+                        open_log_file_for_writing,
+                        parse_drain)
+from log_stats import MetricsServer, add_stats
+
+
+class EventLoop(object):
+    """Run reader tasks when their socket has messages
+    and timer tasks when they come due.
+
+    Tasks are plain callables that must not block.
+    """
+
+    def __init__(self):
+        self.poller = zmq.Poller()
+        self.readers = {}
+        self.timers = []    # Heap of (when, seq, interval, task)
+        self.seq = itertools.count()
+        self.running = False
+
+    def add_reader(self, socket, task):
+        """Run task whenever socket has a message."""
+        self.poller.register(socket, zmq.POLLIN)
+        self.readers[socket] = task
+
+    def call_every(self, interval, task):
+        """Run task every interval seconds."""
+        heapq.heappush(self.timers,
+                (time.time() + interval, next(self.seq), interval, task))
+
+    def timeout(self):
+        """Answer the millisecs until the next timer is due.
+        None when there are no timers."""
+        if not self.timers:
+            return None
+        return max(0, int((self.timers[0][0] - time.time()) * 1000))
+
+    def run_timers(self):
+        """Run the timer tasks that are due and reschedule them."""
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            _, seq, interval, task = heapq.heappop(self.timers)
+            heapq.heappush(self.timers, (now + interval, seq, interval, task))
+            task()
+
+    def run(self):
+        """Run tasks until stop() gets called."""
+        self.running = True
+        while self.running:
+            for socket, _ in self.poller.poll(self.timeout()):
+                self.readers[socket]()
+                if not self.running:
+                    return
+            self.run_timers()
+
+    def stop(self):
+        self.running = False
+
+
+class ExecutorWriter(object):
+    """Run the LogWriter operations in order on a single
+    thread executor. At most depth writes wait to run.
+
+    Flush, reopen and close wait for everything
+    submitted before them.
+    """
+
+    def __init__(self, writer, depth):
+        self.writer = writer
+        self.depth = depth
+        self.executor = ThreadPool(1)
+        self.waiting = deque()
+        self.stall_count = 0
+        self.stall_time = 0.0
+
+    def submit(self, func, *args):
+        """Queue func(*args) for the executor. Waits for
+        the oldest write if depth writes are waiting."""
+        waiting = self.waiting
+        while waiting and waiting[0].ready():
+            waiting.popleft().get()
+        if len(waiting) >= self.depth:
+            start = time.time()
+            waiting.popleft().get()
+            self.stall_count += 1
+            self.stall_time += time.time() - start
+        waiting.append(self.executor.apply_async(func, args))
+
+    def wait(self):
+        """Wait for everything submitted to finish."""
+        while self.waiting:
+            self.waiting.popleft().get()
+
+    def write_batch(self, lines):
+        self.submit(self.writer.write_batch, lines)
+
+    def flush_pending(self):
+        """Flush if anything is waiting to be flushed."""
+        self.submit(self.flush_if_pending)
+
+    def flush_if_pending(self):
+        # Runs on the executor thread.
+        if self.writer.pending_msgs:
+            self.writer.flush()
+
+    def rotate(self):
+        """Roll the log over if anything got written to it."""
+        self.submit(self.rotate_if_written)
+
+    def rotate_if_written(self):
+        # Runs on the executor thread.
+        if self.writer.file_bytes:
+            self.writer.rotate()
+
+    def flush(self):
+        self.submit(self.writer.flush)
+        self.wait()
+
+    def sync(self):
+        self.flush()
+
+    def reopen(self):
+        self.submit(self.writer.reopen)
+        self.wait()
+
+    def stats(self):
+        stats = self.writer.stats()
+        stats.update({
+            'queue_depth': len(self.waiting),
+            'stalls': self.stall_count,
+            'stall_time': self.stall_time,
+        })
+        return stats
+
+    def close(self):
+        self.submit(self.writer.close)
+        self.wait()
+        self.executor.close()
+        self.executor.join()
+
+
+class ReceiverGroup(object):
+    """The receivers of all the data sockets, answering
+    their stats as one. Counters and histograms get summed.
+    A host seen by several receivers gets the delivery
+    latency and sequence loss of just one of them."""
+
+    def __init__(self, receivers):
+        self.receivers = receivers
+
+    def stats(self):
+        total = {}
+        delivery_latency = {}
+        sequence_loss = {}
+        for receiver in self.receivers:
+            add_stats(total, receiver.stats())
+            delivery_latency.update(receiver.delivery_latency())
+            sequence_loss.update(receiver.sequences.loss())
+        total['delivery_latency'] = delivery_latency
+        total['sequence_loss'] = sequence_loss
+        return total
+
+    def latency_report(self):
+        lines = []
+        for receiver in self.receivers:
+            lines += receiver.latency_report()
+        return lines
+
+
+class AsyncServer(object):
+    """log_server as tasks on an EventLoop."""
+
+    def __init__(self, params, context, sockets, control=None):
+        self.loop = EventLoop()
+        self.control = control
+        self.publisher = None
+        if params['pub_port']:
+            self.publisher = LogPublisher(context, params)
+
+        # Timer tasks take over the interval policies so the
+        # writer makes no time checks as batches get written.
+        writer = LogWriter(open_log_file_for_writing(params), params)
+        writer.flush_interval = 0
+        if writer.rotator:
+            writer.rotator.rotate_interval = 0
+        self.writer = ExecutorWriter(writer, params['pipeline_depth'])
+
+        self.receivers = [make_receiver(socket, params, self.publisher)
+                          for socket in sockets]
+        for receiver in self.receivers:
+            self.loop.add_reader(receiver.socket, self.receive_task(receiver))
+        if control is not None:
+            self.loop.add_reader(control, self.control_task)
+        if params['flush_interval_ms']:
+            self.loop.call_every(params['flush_interval_ms'] / 1000.0,
+                                 self.writer.flush_pending)
+        if params['rotate_interval_s']:
+            self.loop.call_every(params['rotate_interval_s'],
+                                 self.writer.rotate)
+        if params['stats_interval_s']:
+            self.loop.call_every(params['stats_interval_s'],
+                                 self.stats_task)
+        self.metrics = None
+        if params['metrics_port']:
+            self.metrics = MetricsServer(params['metrics_port'], self.stats)
+
+    def receive_task(self, receiver):
+        """Answer the reader task for receiver."""
+        def task():
+            lines, exit_requested = receiver.receive_batch()
+            if lines:
+                self.writer.write_batch(lines)
+            if exit_requested:
+                self.loop.stop()
+        return task
+
+    def drain(self):
+        """Hand every message already queued to the writer."""
+        for receiver in self.receivers:
+            while True:
+                lines, _ = receiver.receive_batch()
+                if lines:
+                    self.writer.write_batch(lines)
+                if len(lines) < receiver.batch_max:
+                    break
+
+    def wait_for_records(self, records, deadline):
+        """Receive and write until records have arrived in
+        total or the deadline passes. Timers wait meanwhile."""
+        poller = zmq.Poller()
+        for receiver in self.receivers:
+            poller.register(receiver.socket, zmq.POLLIN)
+        while not drain_due(self.record_count(), records, deadline):
+            for socket, _ in poller.poll(drain_timeout(deadline, None)):
+                self.loop.readers[socket]()
+
+    def record_count(self):
+        return sum([receiver.record_count for receiver in self.receivers])
+
+    def control_task(self):
+        request = self.control.recv()
+        command = request.split()
+        if command == ['exit']:
+            self.drain()
+            self.writer.wait()
+            self.loop.stop()
+            self.control.send('ok')
+            return
+        if command and command[0] == 'drain':
+            drain_request = parse_drain(command)
+            if drain_request is None:
+                self.control.send('error: bad drain command:%s' % request)
+                return
+            self.wait_for_records(*drain_request)
+            self.drain()
+            self.writer.sync()
+            self.control.send(drain_reply(self.stats(), drain_request[0]))
+            return
+        self.control.send(control_command(request,
+                ReceiverGroup(self.receivers), self.writer))
+
+    def stats(self):
+        stats = ReceiverGroup(self.receivers).stats()
+        stats.update(self.writer.stats())
+        return stats
+
+    def stats_task(self):
+        """Publish the stats as JSON under the @stats topic,
+        or print them without a PUB socket."""
+        stats = json.dumps(self.stats())
+        if self.publisher is not None:
+            self.publisher.socket.send_multipart(['@stats', stats])
+        else:
+            sys.stdout.write('stats %s\n' % stats)
+            sys.stdout.flush()
+
+    def run(self):
+        """Run until an exit message or exit command."""
+        self.loop.run()
+        if self.metrics is not None:
+            self.metrics.close()
+        self.writer.close()
+        for line in ReceiverGroup(self.receivers).latency_report():
+            print(line)
+        if self.publisher is not None:
+            self.publisher.close()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+"""
+Store and forward spool for log_client.py --overflow=spool
+
+When the server cannot be reached, or the socket has
+no room, messages get appended to a spool on disk
+instead of being held in memory. Once the socket has
+room again, the spool gets replayed oldest first and
+ahead of anything new, so order is kept. Runs of plain
+logs go out as batches of up to REPLAY_BATCH logs.
+See log_wire.py.
+
+The spool is a directory of segment files numbered in
+order: 00000001.spool, 00000002.spool, ... Messages get
+appended to the newest segment until it reaches
+segment_bytes, then a new segment gets started. A
+segment gets deleted once every message in it has been
+sent. The segments hold at most max_bytes in all. A
+message that would go over gets dropped.
+
+Each message in a segment is a 12 byte header followed
+by its frames:
+    length  - 4 bytes, length of the frames
+    count   - 4 bytes, logs in the message
+    crc     - 4 bytes, CRC32 of the frames
+    frames  - each a 4 byte length then the frame
+All integers are big endian.
+
+Segments left by an earlier run get replayed first. A
+torn or corrupt record, as a crash may leave, ends its
+segment. The replay position does not get saved, so
+logs already sent from the oldest segment get sent
+again after a restart.
+"""
+
+import os
+import struct
+import zlib
+from collections import deque
+
+from log_wire import LENGTH, encode_batch
+
+# Record header: length, count, crc
+RECORD = struct.Struct('>III')
+
+# Segment file names end with this.
+SEGMENT_SUFFIX = '.spool'
+
+# Most plain logs replayed in one batch
+REPLAY_BATCH = 1000
+
+# Most millisecs to wait for room to replay at exit.
+# Whatever does not go out stays spooled for the next run.
+REPLAY_WAIT_MS = 1000
+
+
+def pack_message(frames, count):
+    """Answer the bytes of a record for a message of
+    frames holding count logs."""
+    body = ''.join([LENGTH.pack(len(frame)) + frame for frame in frames])
+    return RECORD.pack(len(body), count, zlib.crc32(body) & 0xffffffff) + body
+
+
+def unpack_frames(body):
+    """Answer the frames in the body of a record."""
+    frames = []
+    pos = 0
+    unpack_from = LENGTH.unpack_from
+    while pos < len(body):
+        length, = unpack_from(body, pos)
+        pos += LENGTH.size
+        frames.append(body[pos:pos + length])
+        pos += length
+    return frames
+
+
+def segment_filename(directory, number):
+    """Answer the file name of segment number."""
+    return os.path.join(directory, '%08d%s' % (number, SEGMENT_SUFFIX))
+
+
+def segment_numbers(directory):
+    """Answer the numbers of the segments in directory, oldest first."""
+    numbers = []
+    for name in os.listdir(directory):
+        stem = name[:-len(SEGMENT_SUFFIX)]
+        if name.endswith(SEGMENT_SUFFIX) and stem.isdigit():
+            numbers.append(int(stem))
+    return sorted(numbers)
+
+
+def replay_message(messages, limit=REPLAY_BATCH):
+    """Answer (frames, count, n): the next message to send
+    for the (frames, count, size) messages at the head of
+    a spool, and how many of them it covers. Up to limit
+    plain logs in a row go out as one batch. Anything
+    else goes out as it is."""
+    plain = []
+    for frames, _, _ in messages:
+        if len(frames) != 1 or len(plain) >= limit:
+            break
+        plain.append(frames[0])
+    if len(plain) > 1:
+        return encode_batch(plain), len(plain), len(plain)
+    frames, count, _ = messages[0]
+    return frames, count, 1
+
+
+class DiskSpool(object):
+    """An append only spool of messages in segment files
+    under directory. See above.
+
+    append() adds a message at the end. peek() answers
+    messages from the start without removing them, and
+    consume() removes them once sent.
+
+    pending_bytes counts the records not yet consumed,
+    size the bytes of every segment on disk. The logs
+    appended and consumed, and the segments cut short
+    by a torn or corrupt record, get totalled.
+    """
+
+    def __init__(self, directory, max_bytes=104857600,
+                 segment_bytes=4194304):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.segments = segment_numbers(directory)
+        self.size = sum([os.path.getsize(segment_filename(directory, number))
+                         for number in self.segments])
+        self.pending_bytes = self.size
+        self.writer = None
+        self.write_number = None
+        self.write_bytes = 0
+        self.reader = None
+        self.read_number = None
+        self.read_end = 0       # End of the last record peeked
+        self.cache = deque()    # (frames, count, size) peeked
+        self.append_count = 0
+        self.consume_count = 0
+        self.corrupt_count = 0
+
+    def empty(self):
+        """Answer True when every message has been consumed."""
+        return self.pending_bytes == 0
+
+    def append(self, frames, count):
+        """Add a message of frames holding count logs at the
+        end. Answers False if the spool is full."""
+        record = pack_message(frames, count)
+        if self.size + len(record) > self.max_bytes:
+            return False
+        if self.writer is None or self.write_bytes >= self.segment_bytes:
+            self.start_segment()
+        self.writer.write(record)
+        self.write_bytes += len(record)
+        self.size += len(record)
+        self.pending_bytes += len(record)
+        self.append_count += count
+        return True
+
+    def start_segment(self):
+        """Start appending to a new segment."""
+        if self.writer is not None:
+            self.writer.close()
+        number = self.segments[-1] + 1 if self.segments else 1
+        self.writer = open(segment_filename(self.directory, number), 'ab')
+        self.segments.append(number)
+        self.write_number = number
+        self.write_bytes = 0
+
+    def peek(self, limit):
+        """Answer up to limit (frames, count, size) messages
+        from the start, oldest first, without removing them.
+        Stops at the end of the oldest segment."""
+        cache = self.cache
+        while len(cache) < limit:
+            message = self.read_message()
+            if message is None:
+                break
+            cache.append(message)
+        return cache
+
+    def read_message(self):
+        """Answer the message after those peeked, None at
+        the end of the oldest segment. A segment consumed
+        to its end gets deleted."""
+        while self.segments:
+            if self.reader is None:
+                self.read_number = self.segments[0]
+                self.reader = open(segment_filename(self.directory,
+                                                    self.read_number), 'rb')
+                self.read_end = 0
+            if self.read_number == self.write_number:
+                self.writer.flush()
+            self.reader.seek(self.read_end)
+            header = self.reader.read(RECORD.size)
+            if len(header) == RECORD.size:
+                length, count, crc = RECORD.unpack(header)
+                body = self.reader.read(length)
+                if len(body) == length and \
+                        zlib.crc32(body) & 0xffffffff == crc:
+                    size = RECORD.size + length
+                    self.read_end += size
+                    return unpack_frames(body), count, size
+            if self.read_number == self.write_number or self.cache:
+                return None
+            self.finish_segment()
+        return None
+
+    def finish_segment(self):
+        """Delete the oldest segment. Any of it left unread
+        was torn or corrupt."""
+        filename = segment_filename(self.directory, self.read_number)
+        segment_size = os.path.getsize(filename)
+        if segment_size > self.read_end:
+            self.corrupt_count += 1
+            self.pending_bytes -= segment_size - self.read_end
+        self.reader.close()
+        self.reader = None
+        if self.read_number == self.write_number:
+            self.writer.close()
+            self.writer = None
+            self.write_number = None
+        os.remove(filename)
+        self.segments.pop(0)
+        self.size -= segment_size
+        self.read_number = None
+
+    def consume(self, count):
+        """Remove the first count messages peeked."""
+        cache = self.cache
+        for _ in xrange(count):
+            _, logs, size = cache.popleft()
+            self.pending_bytes -= size
+            self.consume_count += logs
+        if not cache and self.read_number is not None and \
+                self.read_number == self.write_number and \
+                self.read_end == self.write_bytes:
+            # Caught up. Start afresh rather than let
+            # the segment keep growing.
+            self.finish_segment()
+
+    def close(self):
+        """Close the segments when done with the spool.
+        Those consumed to the end get deleted, the rest
+        wait for the next run."""
+        if self.writer is not None:
+            self.writer.flush()
+        if self.reader is not None and not self.cache and \
+                self.read_end == os.path.getsize(
+                    segment_filename(self.directory, self.read_number)):
+            self.finish_segment()
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            self.write_number = None
+        self.cache.clear()
+
+    def report(self):
+        """Answer a one line summary of the spool."""
+        return ('spool dir:%s appended:%d replayed:%d pending_bytes:%d '
+                'segments:%d corrupt:%d' %
+                (self.directory, self.append_count, self.consume_count,
+                 self.pending_bytes, len(self.segments), self.corrupt_count))
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+"""
+Counters and latency histograms for log_server.py.
+
+Every batch of logs passes through four stages,
+each timed into a histogram:
+    recv   - taking the messages off the socket
+    format - timestamping and publishing them
+    write  - writing them to the log file
+    flush  - flushing the log file
+
+A histogram has fixed buckets allocated up front.
+Observing a time costs a bisect and a few adds,
+once per batch, never per message.
+
+With log_client --send-time, the delay from a client
+logging a record to the server receiving it gets
+counted into a histogram for each host. Percentiles
+come from the buckets, so memory stays fixed no
+matter how many records arrive.
+
+With log_client --sequence, every record carries its
+place in the numbered stream of its sender. The server
+keeps the next number it expects from each sender and
+counts the records skipped or repeated as batches
+arrive, so loss shows in the stats straight away
+rather than in a count of log file lines afterwards.
+
+The server answers its stats as a dict. The control
+socket replies with it as JSON. MetricsServer serves
+it in the Prometheus text format over HTTP.
+"""
+
+import threading
+from bisect import bisect_left
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+# Upper bounds, in seconds, of the latency buckets.
+# Logs beyond the last bound go in the +Inf bucket.
+LATENCY_BUCKETS = [
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5,
+]
+
+# Upper bounds, in seconds, of the delivery latency buckets:
+# 10 microsecs to about 2 minutes, each bound 25% above the
+# last. Percentiles are good to within a bucket.
+DELIVERY_BUCKETS = [0.00001 * 1.25 ** ndx for ndx in range(74)]
+
+# Percentiles reported for delivery latency
+DELIVERY_PERCENTILES = [('p50', 0.5), ('p99', 0.99), ('p999', 0.999)]
+
+# Content type of the Prometheus text format
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+class Histogram(object):
+    """Count observed values into fixed buckets.
+
+    counts[i] is the number of values above bounds[i-1]
+    and at most bounds[i]. The last count holds the
+    values above every bound. The sum and count of
+    all values get kept as well.
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Count value into its bucket."""
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def add(self, other):
+        """Add the counts of a histogram with the same bounds."""
+        for ndx, count in enumerate(other.counts):
+            self.counts[ndx] += count
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, q):
+        """Answer the value below which a fraction q of the
+        observed values fall, interpolated within its bucket.
+        Values beyond the last bound count as the last bound.
+        0.0 when nothing has been observed."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        total = 0
+        for ndx, count in enumerate(self.counts):
+            if count and total + count >= rank:
+                if ndx == len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[ndx - 1] if ndx else 0.0
+                upper = self.bounds[ndx]
+                return lower + (upper - lower) * (rank - total) / count
+            total += count
+        return self.bounds[-1]
+
+    def percentiles(self, percentiles=DELIVERY_PERCENTILES):
+        """Answer a dict of the count, mean and each of the
+        (name, q) percentiles."""
+        summary = {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else 0.0,
+        }
+        for name, q in percentiles:
+            summary[name] = self.quantile(q)
+        return summary
+
+    def to_dict(self):
+        """Answer the histogram as a dict ready for JSON:
+        buckets is a list of [upper bound, cumulative count]
+        pairs, the last with the bound '+Inf'."""
+        buckets = []
+        total = 0
+        for bound, count in zip(self.bounds + ['+Inf'], self.counts):
+            total += count
+            buckets.append([bound, total])
+        return {'buckets': buckets, 'sum': self.sum, 'count': self.count}
+
+
+class SequenceTracker(object):
+    """Follow the numbered streams of records from each
+    sender, keyed by (host, session id).
+
+    streams maps each key to a list of the next sequence
+    number expected, the records missing and the records
+    repeated. A stream whose first batch does not start
+    at 0 lost its earlier records.
+
+    Records get counted, not stored, so a stream costs
+    the same however long it runs.
+    """
+
+    def __init__(self):
+        self.streams = {}
+        self.gap_count = 0
+        self.missing_count = 0
+        self.duplicate_count = 0
+
+    def observe(self, host, session, first, count):
+        """Count a batch of count records numbered from
+        first. Answers the number of records at the start
+        of the batch that were seen before."""
+        stream = self.streams.get((host, session))
+        if stream is None:
+            stream = self.streams[(host, session)] = [0, 0, 0]
+        expected = stream[0]
+        repeated = 0
+        if first > expected:
+            self.gap_count += 1
+            stream[1] += first - expected
+            self.missing_count += first - expected
+        elif first < expected:
+            repeated = min(count, expected - first)
+            stream[2] += repeated
+            self.duplicate_count += repeated
+        stream[0] = max(expected, first + count)
+        return repeated
+
+    def start(self, host, session, first):
+        """Follow a stream not seen yet from first on. The
+        records before first count as neither missing nor
+        repeated."""
+        self.streams.setdefault((host, session), [first, 0, 0])
+
+    def expected(self, host, session):
+        """Answer the next sequence number expected from
+        a stream, None for a stream not seen yet."""
+        stream = self.streams.get((host, session))
+        return None if stream is None else stream[0]
+
+    def loss(self):
+        """Answer the records missing and repeated for each
+        host with any, summed over its sessions."""
+        loss = {}
+        for (host, _), (_, missing, repeated) in self.streams.items():
+            if missing or repeated:
+                host_loss = loss.setdefault(host,
+                        {'missing': 0, 'duplicated': 0})
+                host_loss['missing'] += missing
+                host_loss['duplicated'] += repeated
+        return loss
+
+    def stats(self):
+        """Answer the counters as a dict."""
+        return {
+            'sequence_streams': len(self.streams),
+            'sequence_gaps': self.gap_count,
+            'records_missing': self.missing_count,
+            'records_duplicated': self.duplicate_count,
+            'sequence_loss': self.loss(),
+        }
+
+
+def is_histogram(value):
+    """Answer True if a stats value is a Histogram.to_dict()."""
+    return isinstance(value, dict) and 'buckets' in value
+
+
+def add_stats(total, stats):
+    """Add the numbers and histograms in stats into total.
+    Anything else in stats gets ignored."""
+    for key, value in stats.items():
+        if is_histogram(value):
+            if key not in total:
+                total[key] = {'buckets': [list(pair) for pair in
+                                          value['buckets']],
+                              'sum': value['sum'],
+                              'count': value['count']}
+                continue
+            merged = total[key]
+            for pair, (_, count) in zip(merged['buckets'], value['buckets']):
+                pair[1] += count
+            merged['sum'] += value['sum']
+            merged['count'] += value['count']
+        elif isinstance(value, (int, long, float)):
+            total[key] = total.get(key, 0) + value
+    return total
+
+
+def prometheus_text(stats, prefix='log_server_'):
+    """Answer stats in the Prometheus text format, each
+    name prefixed with prefix. Numbers become untyped
+    samples, histograms become histograms. Anything else
+    gets left out."""
+    lines = []
+    for key in sorted(stats):
+        value = stats[key]
+        name = prefix + key
+        if is_histogram(value):
+            lines.append('# TYPE %s histogram' % name)
+            for bound, count in value['buckets']:
+                lines.append('%s_bucket{le="%s"} %d' % (name, bound, count))
+            lines.append('%s_sum %r' % (name, value['sum']))
+            lines.append('%s_count %d' % (name, value['count']))
+        elif isinstance(value, bool):
+            lines.append('%s %d' % (name, value))
+        elif isinstance(value, (int, long, float)):
+            lines.append('%s %r' % (name, value))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer(object):
+    """Serve the dict answered by stats() in the Prometheus
+    text format at /metrics on a local HTTP port.
+
+    Requests get handled on a daemon thread, so stats()
+    runs on that thread. The server counters are plain
+    numbers, so reading them while the server updates
+    them is safe, but a scrape may see one stage a batch
+    ahead of another.
+    """
+
+    def __init__(self, port, stats, host='127.0.0.1'):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = prometheus_text(stats())
+                self.send_response(200)
+                self.send_header('Content-Type', PROMETHEUS_CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Keep scrapes out of the server output.
+                pass
+
+        self.httpd = HTTPServer((host, port), Handler)
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        """Stop serving and release the port."""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
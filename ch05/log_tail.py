@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+def usage(exit_code):
+    print(' '.join(sys.argv) + """\n
+Follow the logs republished by log_server.py --pub-port.
+
+Each log arrives as the timestamped line written
+to the log file. Filtering by host happens inside
+ZeroMQ so unwanted logs never reach this process.
+
+Usage:
+    ./log_tail.py [--port=port#] [--host=ahostname]
+        [--topic=prefix]
+
+Where:
+    --port=port#     - The --pub-port of log_server.
+                       Default: 5556
+    --host=ahostname - The name of the host where server lives.
+                       Default: localhost
+    --topic=prefix   - Follow only logs from hosts whose name
+                       starts with prefix. May be repeated.
+                       Default: follow all hosts
+
+Terminate this program with Ctrl-C.
+    """)
+    sys.exit(exit_code)
+
+
+import sys
+
+import zmq
+
+
+def dict_to_cmd_string(params):
+    """Utility to format run-time parameters as if
+    they came from the command line.
+
+    Input: The params as created by process_cmd_line.
+    Output: Formatted string of run-time switches."""
+
+    out = ""
+    for key, value in params.items():
+        out = out + ('%s=%s ' % (key, value))
+    return out
+
+
+def process_cmd_line(argv):
+    """
+    Command line code to handle user params
+    """
+
+    params = {
+        # The --pub-port of log_server
+        'port': 5556,
+
+        # Host name of log server
+        'host': 'localhost',
+
+        # Host name prefixes to follow. Empty means all.
+        'topics': [],
+    }
+
+    import getopt
+    try:
+        opts, _ = getopt.gnu_getopt(
+                argv, '',
+                    ['port=',       # Port number.
+                     'host=',       # hostname
+                     'topic=',      # Host name prefix to follow
+                     'help'         # Print help message then exit.
+                     ])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage(1)
+
+    for opt, arg in opts:
+        if opt == '--help':
+            usage(0)
+        if opt == '--port':
+            try:
+                # port must be integer
+                _ = int(arg)
+            except ValueError as err:
+                print('Invalid port number:%s' % err)
+                usage(1)
+            params['port'] = int(arg)
+            continue
+        if opt == '--host':
+            params['host'] = arg
+            continue
+        if opt == '--topic':
+            params['topics'].append(arg)
+            continue
+
+    # Announce our run-time parameters on stderr
+    # so stdout holds only the logs.
+    sys.stderr.write('%s %s\n' %
+            (sys.argv[0], dict_to_cmd_string(params)))
+    return params
+
+
+def setup_zmq(your_host, port_number, topics):
+    """Answer (context, socket) subscribed to the logs
+    of hosts starting with any of topics. No topics
+    subscribes to all logs."""
+    context = zmq.Context()
+    socket = context.socket(zmq.SUB)
+    for topic in topics or ['']:
+        socket.setsockopt(zmq.SUBSCRIBE, topic)
+    socket.connect('tcp://%s:%d' % (your_host, port_number))
+    return context, socket
+
+
+def mainline():
+    params = process_cmd_line(sys.argv[1:])
+    context, socket = setup_zmq(params['host'], params['port'],
+                                params['topics'])
+    try:
+        while True:
+            _, line = socket.recv_multipart()
+            sys.stdout.write(line)
+    except KeyboardInterrupt:
+        pass
+    socket.close(linger=0)
+    context.term()
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    mainline()
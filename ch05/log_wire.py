@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+"""
+Wire format of batched logs between log_client.py
+and log_server.py.
+
+A plain log is a single frame ZeroMQ message holding
+the host name, a blank and the log text.
+
+A batch carries many logs in one two frame message:
+    header  - magic, version, flags and record count,
+              then the fields the flags call for
+    payload - the records, each a 4 byte length
+              followed by the log
+All integers are big endian.
+
+The flags tell which optional features the batch
+uses. log_server decodes any combination:
+    FLAG_COMPRESSED - the payload is zlib compressed
+    FLAG_SEND_TIME  - the header ends with the wall clock
+                      time, in nanoseconds since the epoch,
+                      when the client logged the oldest
+                      record of the batch
+    FLAG_SEQUENCE   - the header ends with the session id of
+                      the sender and the sequence number of
+                      the first record. The records of a
+                      session are numbered 0, 1, 2, ... so
+                      the server can spot lost and repeated
+                      records.
+    FLAG_UNACKED    - with FLAG_SEQUENCE, the header ends
+                      with the sequence number of the oldest
+                      record the sender still waits for an
+                      ack for. See below.
+The fields come in the order of the flags.
+
+In reliable mode, log_client --reliable, batches go
+from a DEALER socket to a ROUTER socket and each one
+carries a sequence. The server answers with an ack:
+a one frame message holding the session id and the
+sequence number of the next record it expects. Every
+record numbered below it has been written, so one ack
+covers any number of batches. Each batch also carries
+FLAG_UNACKED, so a server that has not heard from the
+sender before, as after a restart, knows which record
+to expect first.
+"""
+
+import struct
+import zlib
+
+# First bytes of a batch header.
+MAGIC = 'IOTB'
+
+# Version of the batch format.
+VERSION = 1
+
+# Batch header: magic, version, flags, record count
+HEADER = struct.Struct('>4sBBI')
+
+# Length prefix of each record in the payload.
+LENGTH = struct.Struct('>I')
+
+# Send time field of the header
+SEND_TIME = struct.Struct('>Q')
+
+# Sequence fields of the header: session id, first sequence number
+SEQUENCE = struct.Struct('>QQ')
+
+# Unacked field of the header: oldest sequence number not acked
+UNACKED = struct.Struct('>Q')
+
+# Ack from server to client: session id, next sequence number
+ACK = struct.Struct('>QQ')
+
+# Header flags
+FLAG_COMPRESSED = 0x01
+FLAG_SEND_TIME = 0x02
+FLAG_SEQUENCE = 0x04
+FLAG_UNACKED = 0x08
+
+
+class BatchError(Exception):
+    """A batch that cannot be decoded."""
+    pass
+
+
+def encode_batch(records, flags=0, compress_level=0, compress_min_bytes=0,
+                 send_time=None, sequence=None):
+    """Answer the frames of a batch holding records.
+    With compress_level 1 to 9, a payload of at least
+    compress_min_bytes gets zlib compressed. A send_time
+    in nanoseconds and a sequence of (session id, first
+    sequence number) get carried in the header."""
+    pack = LENGTH.pack
+    payload = ''.join([pack(len(record)) + record for record in records])
+    if compress_level and len(payload) >= compress_min_bytes:
+        payload = zlib.compress(payload, compress_level)
+        flags |= FLAG_COMPRESSED
+    if send_time is not None:
+        flags |= FLAG_SEND_TIME
+    if sequence is not None:
+        flags |= FLAG_SEQUENCE
+    header = HEADER.pack(MAGIC, VERSION, flags, len(records))
+    if send_time is not None:
+        header += SEND_TIME.pack(send_time)
+    if sequence is not None:
+        header += SEQUENCE.pack(*sequence)
+    return [header, payload]
+
+
+def header_size(flags):
+    """Answer the size of a header with these flags."""
+    size = HEADER.size
+    if flags & FLAG_SEND_TIME:
+        size += SEND_TIME.size
+    if flags & FLAG_SEQUENCE:
+        size += SEQUENCE.size
+    if flags & FLAG_UNACKED:
+        size += UNACKED.size
+    return size
+
+
+def add_unacked(frames, unacked):
+    """Answer the frames of a batch that carries a sequence
+    and no unacked field, with unacked, the sequence
+    number of the oldest record not yet acked, added to
+    the header."""
+    header = frames[0]
+    magic, version, flags, count = HEADER.unpack_from(header)
+    return [HEADER.pack(magic, version, flags | FLAG_UNACKED, count) +
+            header[HEADER.size:] + UNACKED.pack(unacked), frames[1]]
+
+
+def batch_flags(frames):
+    """Answer the flags in the header of a batch."""
+    return HEADER.unpack_from(frames[0])[2]
+
+
+def batch_send_time(frames):
+    """Answer the send time in the header of a batch,
+    None if it has none."""
+    header = frames[0]
+    if not HEADER.unpack_from(header)[2] & FLAG_SEND_TIME:
+        return None
+    return SEND_TIME.unpack_from(header, HEADER.size)[0]
+
+
+def batch_sequence(frames):
+    """Answer (session id, first sequence number) from the
+    header of a batch, None if it has none."""
+    header = frames[0]
+    flags = HEADER.unpack_from(header)[2]
+    if not flags & FLAG_SEQUENCE:
+        return None
+    return SEQUENCE.unpack_from(header,
+                                header_size(flags & ~FLAG_UNACKED) -
+                                SEQUENCE.size)
+
+
+def batch_unacked(frames):
+    """Answer the sequence number of the oldest record not
+    yet acked from the header of a batch, None if it has
+    none."""
+    header = frames[0]
+    flags = HEADER.unpack_from(header)[2]
+    if not flags & FLAG_UNACKED:
+        return None
+    return UNACKED.unpack_from(header, header_size(flags) - UNACKED.size)[0]
+
+
+def encode_ack(session, next_sequence):
+    """Answer the frame of an ack for every record of
+    session numbered below next_sequence."""
+    return ACK.pack(session, next_sequence)
+
+
+def decode_ack(frame):
+    """Answer (session id, next sequence number) from an
+    ack. Raises BatchError for a malformed ack."""
+    if len(frame) != ACK.size:
+        raise BatchError('bad ack length %d' % len(frame))
+    return ACK.unpack(frame)
+
+
+def is_batch(frames):
+    """Answer True if the frames of a message are a batch."""
+    return len(frames) == 2 and frames[0][:len(MAGIC)] == MAGIC
+
+
+def decode_batch(frames):
+    """Answer the list of records in the frames of a batch.
+    Raises BatchError for a malformed batch."""
+    header, payload = frames
+    if len(header) < HEADER.size:
+        raise BatchError('short header')
+    _, version, flags, count = HEADER.unpack_from(header)
+    if version != VERSION:
+        raise BatchError('unknown version %d' % version)
+    if len(header) < header_size(flags):
+        raise BatchError('short header')
+    if flags & FLAG_COMPRESSED:
+        try:
+            payload = zlib.decompress(payload)
+        except zlib.error as err:
+            raise BatchError('decompress:%s' % str(err))
+    records = []
+    pos = 0
+    size = len(payload)
+    unpack_from = LENGTH.unpack_from
+    for _ in range(count):
+        if pos + LENGTH.size > size:
+            raise BatchError('truncated payload')
+        length, = unpack_from(payload, pos)
+        pos += LENGTH.size
+        records.append(payload[pos:pos + length])
+        pos += length
+    if pos != size:
+        raise BatchError('payload length mismatch')
+    return records
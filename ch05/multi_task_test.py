@@ -26,18 +26,19 @@ import functools
 import os
 import sys
 import subprocess       # To spawn subprocesses
-import time
 import unittest
 
-from listening_port import listening, is_listening
 import log_client 
 import log_server
-from named_kill import find_procs_by_name
+from log_fixture import LogServerFixture
 
 # Names of client and server python scripts.
 LOG_SERVER_NAME = './log_server.py'
 LOG_CLIENT_NAME = './log_client.py'
 
+# Most millisecs to wait for a server to receive the logs.
+DRAIN_TIMEOUT_MS = 60000
+
 # NOISY == True prints trace messages that might
 # assist in debugging.
 NOISY = True
@@ -58,9 +59,6 @@ class ServerCmdLineTest(unittest.TestCase):
     """
     import log_server
 
-    def setUp(self):
-        kill_listening_processes(ServerClientTest.port)
-
     # In testing for invalid command line operations,
     # this should always be None, meaning the log_server
     # could not start.
@@ -93,7 +91,7 @@ class ServerCmdLineTest(unittest.TestCase):
         log_server_proc = create_process_with_stderr(
                 '%s --Xlog=%s --log_append=False --port=5555' %
             (LOG_SERVER_NAME, 'log.log'))
-        self.assertEqual(0, log_server_proc.returncode)
+        self.assertEqual(1, log_server_proc.returncode)
 
 
     def test_invalid_port(self):
@@ -107,21 +105,10 @@ class ServerCmdLineTest(unittest.TestCase):
         print('bad_port_proc:%r' % bad_port_proc.__dict__)
 
 
-def accum_sleep_time(sleep_time):
-    """Accumulate the total sleep time. The server does not
-    know the queue size so the delay in sleep allows the
-    server to catch up with queue values. YUCK! I HATE
-    forced delays.
-    """
-    time.sleep(sleep_time)
-
-
-def stop_timer(start, sleeper):
-    """Given a start time and the sleep time,
-    return the delta suitable for printing via %s"""
-    stop = datetime.datetime.now()
-    delta = stop - (start + datetime.timedelta(0, sleeper))
-    return delta
+def stop_timer(start):
+    """Given a start time, return the delta
+    suitable for printing via %s"""
+    return datetime.datetime.now() - start
 
 
 def create_process(cmd_line):
@@ -132,11 +119,9 @@ def create_process(cmd_line):
     return proc
 
 def create_process_with_stderr(cmd_line):
-    """Create a process with stderr sent to stdout.
-    Start it running but don't wait.
+    """Create a process with stderr sent to stdout
+    and wait for it to exit.
     Generally use for test that expect to fail."""
-    #import pdb; pdb.set_trace()
-    time.sleep(1)
     if NOISY:
         print('create_process_with_stderr %s' % cmd_line)
     try:
@@ -151,9 +136,8 @@ def create_process_with_stderr(cmd_line):
         return -2
     else:
         # Process ran. Got something as output.
+        proc.wait()
         print('output:\n%s' % proc)
-    finally:
-        time.sleep(1)
 
     return proc
 
@@ -182,25 +166,6 @@ def count_lines_in_file(filename):
     return wc_count
 
 
-def kill_listening_processes(port):
-    """
-    Determine if this port has been assigned
-    If any procss are listening, attempt to kill them.
-    Answers # listeners.
-    If 0 listeners, then proceed.
-    If non-0, then the test should not proceed.
-    """
-    port_status = listening(port, kill=True)
-    if not port_status == 0:
-        print('For port %s, listeners:%d' % (port, port_status))
-        port_status = is_listening(port)
-        if not port_status == 0:
-            print('port %d: Attempted to kill, but %d listeners remain' % \
-                    (port, port_status))
-            return port_status
-    return 0    # No listeners
-
-
 def get_line_count(log_name):
     """Given a log file name, 
     answer the number of lines in that log file.
@@ -215,36 +180,36 @@ def get_line_count(log_name):
     """
     return  count_lines_in_file(log_name)
 
-@unittest.skip('skipping ServerClientTest')
 class ServerClientTest(unittest.TestCase):
+    """Clients as processes against a server on a thread
+    of this process. Each server gets a random port, so
+    these tests need no free port and can run alongside
+    others. See log_fixture.py."""
 
-    # Port value used by all tests.
-    port = 5555
-
-    def setUp(self):
-        kill_listening_processes(ServerClientTest.port)
+    def client_cmd(self, server, args):
+        """Answer the command line of a client of server."""
+        return '%s --endpoint=%s --control=%s %s' % \
+            (LOG_CLIENT_NAME, server.endpoint, server.control, args)
 
     def test_happy_path(self):
         """Test the happy path where parameters
         provide a simple and happy logging environment.
 
-        python -m unittest server_client_test.ServerClientTest.test_happy_path
+        python -m unittest multi_task_test.ServerClientTest.test_happy_path
         """
 
         print function_name()
 
-        log_name = 'happy.log'
         count = 10  # logs from client to server
 
-        # Create a server
-        server_proc = create_process('%s --log=%s --log_append=False --port=%d' %
-            (LOG_SERVER_NAME, log_name, ServerClientTest.port))
-
-        # Create a client and send logs
-        client_proc = create_process('%s --svr-exit=true --count=%d --port=%d' %
-            (LOG_CLIENT_NAME, count, ServerClientTest.port))
-        time.sleep(1)
-        self.assertEqual(count, get_line_count(log_name))
+        with LogServerFixture() as server:
+            # Create a client and send logs. It makes the server
+            # exit once the server has received them all.
+            client_proc = create_process(self.client_cmd(server,
+                '--svr-exit=true --count=%d' % count))
+            client_proc.wait()
+            server.thread.join()
+            self.assertEqual(count, len(server.lines()))
 
 
     def test_two_clients(self):
@@ -254,114 +219,60 @@ class ServerClientTest(unittest.TestCase):
 
         print function_name()
 
-        log_name = '2clients.log'
         count = 10000   # 10k logs
-        sleeper = 4     # Sleep time to allow server to process.
-
-        # Create a client and send count logs
-        client_proc1 = create_process('%s --count=%d --port=%d --log_msg=Client1' %
-            (LOG_CLIENT_NAME, count, ServerClientTest.port))
-
-        # Create another client and send count logs
-        client_proc2 = create_process('%s --count=%d --port=%d --log_msg=Client2' %
-            (LOG_CLIENT_NAME, count, ServerClientTest.port))
-
-        # Create a server
-        server_proc = create_process('%s --log_append=False --log=%s --port=%d' % 
-            (LOG_SERVER_NAME, log_name, ServerClientTest.port))
-
-        # Wait for the 2 clients to terminate
-        client_proc1.communicate()
-        client_proc2.communicate()
-
-        # Need to sleep because the server has not had time
-        # to process all the logs.
-        accum_sleep_time(sleeper)
-
-        # Create another client simply to exit
-        # If the sleep time is too short, the buffered logs
-        # in the server get dropped. This yields a false negative.
-        client_exit = create_process('%s --svr-exit=true --count=1 --port=%d --log_msg=@EXIT@ test_two_clients' %
-            (LOG_CLIENT_NAME, ServerClientTest.port))
-
-        self.assertEqual(2*count, get_line_count(log_name))
-
-    '''
-    def test_timing_100k(self):
-        """Time sending 10000 simple logs."""
-        log_count = 100000    # Number of l0gs to send.
-        log_name = '100k.log'
-        sleeper = 15          # Time to sleep and let the server write the data.
-        print function_name()
-
-
-        start = datetime.datetime.now()
 
-        # Create a client and send logs
-        client_proc1 = create_process('%s --svr_exit=true --count=%d --port=%d --log_msg="100k logs"' %
-            (LOG_CLIENT_NAME, log_count, ServerClientTest.port))
+        with LogServerFixture() as server:
+            # Create a client and send count logs
+            client_proc1 = create_process(self.client_cmd(server,
+                '--count=%d --log_msg=Client1' % count))
 
-        # Create a server
-        server_proc = create_process('%s --log_append=False --log=%s --port=%d' %
-            (LOG_SERVER_NAME, log_name, ServerClientTest.port))
+            # Create another client and send count logs
+            client_proc2 = create_process(self.client_cmd(server,
+                '--count=%d --log_msg=Client2' % count))
 
-        accum_sleep_time(sleeper)
+            # Wait for the 2 clients to terminate
+            client_proc1.communicate()
+            client_proc2.communicate()
 
-        delta = stop_timer(start, sleeper)
-        print('Time to send %d logs:%s' % (log_count, delta))
-
-        self.assertEqual(log_count, get_line_count(log_name) )
-    '''
+            # Wait exactly as long as the server needs to
+            # write every log.
+            self.assertTrue(server.drain(2*count, DRAIN_TIMEOUT_MS)['drained'])
+            self.assertEqual(2*count, len(server.lines()))
 
     def test_timing_10k_20clients(self):
         """Time sending 1000 logs from each of 20 clients."""
 
         log_count = 1000     # Number of l0gs to send.
-        log_name = '20client.log'
-        number_clients = 10  # Number of clients banging on the server
-        sleeper = 4          # Time is sec to let server write lots.
+        number_clients = 20  # Number of clients banging on the server
 
         print function_name()
 
-        # Create another client simply to exit
         start = datetime.datetime.now()
 
-        if NOISY:
-            print(' Create a server, port%d' % ServerClientTest.port)
-        server_proc = create_process('%s --log_append=False --log=%s --port=%d' %
-            (LOG_SERVER_NAME, log_name, ServerClientTest.port))
-
-        client_list = []
-        for ndx in range(number_clients):
-            # Create a client and send log_count logs
-            client_list.append(create_process(
-                '%s --count=%d --port=%d --log_msg="client %d"' %
-                (LOG_CLIENT_NAME, log_count, ServerClientTest.port, ndx)))
-
-        if NOISY:
-            print(' Wait for all %d clients to exit' % len(client_list))
-        for client in client_list:
-            out, err = client.communicate()     # Wait for client to exit
-            client_ret_code = client.wait()
+        with LogServerFixture() as server:
             if NOISY:
-                print('status return code: %d, client: %r' % (client_ret_code, client.pid))
-            if not (client_ret_code == 0):
-                print('Non-zero return: %d, client: %r', (client_ret_code, client.pid))
+                print(' Server at %s' % server.endpoint)
 
-        if NOISY:
-            print(' All clients finished. Sleep 4 sec to allow server to catch up.')
-        accum_sleep_time(sleeper)
+            # One process simulates every client, each with
+            # its own socket, sending log_count logs.
+            client = create_process(self.client_cmd(server,
+                '--fleet=%d --threads=4 --count=%d --log_msg=client' %
+                (number_clients, log_count)))
 
-        if NOISY:
-            print(' Sending @EXIT@ to the server')
-        client_list.append(create_process(
-            '%s --count=1 --svr-exit=true --port=%d --log_msg=@EXIT@ test_timing_10k_20clients' %
-            (LOG_CLIENT_NAME, ServerClientTest.port)))
+            if NOISY:
+                print(' Wait for the %d clients to exit' % number_clients)
+            client.communicate()
+            self.assertEqual(0, client.returncode)
 
-        delta = stop_timer(start, sleeper)
-        print('Time to send %d logs:%s' % (number_clients*log_count, delta))
+            if NOISY:
+                print(' All clients finished. Wait for the server to catch up.')
+            stats = server.drain(number_clients*log_count, DRAIN_TIMEOUT_MS)
+            self.assertTrue(stats['drained'])
 
-        self.assertEqual(number_clients*log_count, get_line_count(log_name))
+            delta = stop_timer(start)
+            print('Time to send %d logs:%s' % (number_clients*log_count, delta))
+
+            self.assertEqual(number_clients*log_count, len(server.lines()))
 
 
 def list_hanging_processes():
@@ -376,6 +287,8 @@ def list_hanging_processes():
     Returns count of hanging processes.
     """
 
+    from named_kill import find_procs_by_name
+
     print('\n-----------------\nlist_hanging_processes:')
     hanging = 0
     for proc in ['log_client', 'log_server']:
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+def usage(exit_code):
+    print(' '.join(sys.argv) + """\n
+Run the test classes of test modules in parallel,
+each class in a process of its own.
+
+Tests that start servers through log_fixture.py bind
+random ports and private ipc paths, so classes do not
+get in each other's way. A class that needs a fixed
+port or file must not share it with another class.
+
+Usage:
+    ./run_tests.py [--processes=N] [module ...]
+
+Where:
+    --processes=N       - Most classes run at once.
+                          Default: the number of CPUs
+    module              - Test modules to run.
+                          Default: server_client_test
+
+The output of each class that fails gets printed,
+then a line for every class.
+
+Return codes:
+    0 - Every test passed
+    1 - Invalid command line or a test failed
+    """)
+    sys.exit(exit_code)
+
+
+import multiprocessing
+import re
+import subprocess
+import sys
+import time
+import unittest
+from multiprocessing.pool import ThreadPool
+
+
+def process_cmd_line(argv):
+    """
+    Command line code to handle user params
+    """
+
+    params = {
+        # Most classes run at once
+        'processes': multiprocessing.cpu_count(),
+
+        # Test modules to run
+        'modules': ['server_client_test'],
+    }
+
+    import getopt
+    try:
+        opts, args = getopt.gnu_getopt(
+                argv, '',
+                    ['processes=',  # Classes at once
+                     'help'         # Print help message then exit.
+                     ])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage(1)
+
+    for opt, arg in opts:
+        if opt == '--help':
+            usage(0)
+        if opt == '--processes':
+            try:
+                # Must be a positive integer
+                params['processes'] = int(arg)
+                if params['processes'] < 1:
+                    raise ValueError('must be at least 1')
+            except ValueError as err:
+                print('Invalid %s value:%s' % (opt, err))
+                usage(1)
+            continue
+
+    if args:
+        params['modules'] = args
+    return params
+
+
+def test_classes(modules):
+    """Answer 'module.Class' for every TestCase class
+    with tests in the modules."""
+    loader = unittest.TestLoader()
+    names = []
+    for module_name in modules:
+        module = __import__(module_name)
+        for name in sorted(dir(module)):
+            value = getattr(module, name)
+            if isinstance(value, type) and \
+                    issubclass(value, unittest.TestCase) and \
+                    loader.getTestCaseNames(value):
+                names.append('%s.%s' % (module_name, name))
+    return names
+
+
+def result_count(output, name):
+    """Answer the count called name in the summary line
+    unittest ends its output with."""
+    found = re.search(r'\b%s=(\d+)' % name, output.splitlines()[-1])
+    return int(found.group(1)) if found else 0
+
+
+def run_class(name):
+    """Run the tests of the class called name in a process
+    of its own, as tests may start processes of their own.
+    Answers (name, tests run, failures, errors, skipped,
+    secs, output)."""
+    start = time.time()
+    proc = subprocess.Popen([sys.executable, '-m', 'unittest', name],
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    output = proc.communicate()[0]
+    ran = re.search(r'^Ran (\d+) test', output, re.MULTILINE)
+    if ran is None:
+        # The module did not load.
+        return name, 0, 0, 1, 0, time.time() - start, output
+    return (name, int(ran.group(1)), result_count(output, 'failures'),
+            result_count(output, 'errors'), result_count(output, 'skipped'),
+            time.time() - start, output)
+
+
+def mainline():
+    params = process_cmd_line(sys.argv[1:])
+    names = test_classes(params['modules'])
+    start = time.time()
+    pool = ThreadPool(params['processes'])
+    results = pool.map(run_class, names, chunksize=1)
+    pool.close()
+    pool.join()
+
+    failed = 0
+    for name, run, failures, errors, skipped, secs, output in results:
+        if failures or errors:
+            failed += 1
+            print('========== %s ==========\n%s' % (name, output))
+    for name, run, failures, errors, skipped, secs, output in results:
+        print('%-50s run:%d failures:%d errors:%d skipped:%d secs:%.2f' %
+              (name, run, failures, errors, skipped, secs))
+    print('classes:%d failed:%d secs:%.2f' %
+          (len(results), failed, time.time() - start))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    mainline()
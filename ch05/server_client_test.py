@@ -4,11 +4,39 @@ Test suite for command line interfaces of
 log_server.py and log_client.py
 """
 
+import glob
+import gzip
+import json
+import logging
+import os
+import random
+import shutil
+import signal
+import StringIO
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 import unittest
+import urllib2
+
+import zmq
 
 import log_server
 import log_client
+import log_segment
+import log_query
+import log_control
+import log_wire
+import log_server_async
+import log_stats
+import log_load
+import log_fleet
+import log_fixture
+import log_spool
+import log_handler
+from bench import log_bench
 
 # Names of client and server python scripts.
 LOG_SERVER_NAME = './log_server.py'
@@ -140,6 +168,1813 @@ class LogServerCmdLineTest(unittest.TestCase):
         self.assertEqual(params['port'], 12345)
 
 
+    def test_server_bind(self):
+        """--bind takes a list of endpoints, default is tcp on port"""
+        print(FCN_FMT % function_name())
+        params = log_server.process_cmd_line(['--port=6000'])
+        self.assertEqual(params['bind'], ['tcp://*:6000'])
+        params = log_server.process_cmd_line([
+            '--bind=tcp://*:6000,ipc:///tmp/bind_test.sock',
+            '--bind=inproc://bind_test'])
+        self.assertEqual(params['bind'], ['tcp://*:6000',
+            'ipc:///tmp/bind_test.sock', 'inproc://bind_test'])
+
+        # One socket receives from all the endpoints.
+        context = zmq.Context()
+        params['bind'] = ['inproc://bind_a', 'ipc:///tmp/bind_test.sock']
+        pull = log_server.bind_data_socket(context, params)
+        pushes = []
+        for endpoint in params['bind']:
+            push = context.socket(zmq.PUSH)
+            push.connect(endpoint)
+            push.send('host via %s' % endpoint)
+            pushes.append(push)
+        receiver = log_server.Receiver(pull, 10)
+        lines = []
+        while len(lines) < 2:
+            pull.poll(1000)
+            lines += receiver.receive_batch()[0]
+        self.assertEqual(len(lines), 2)
+        for sock in pushes + [pull]:
+            sock.close(linger=0)
+        context.term()
+
+    def test_client_endpoint(self):
+        """The client takes a full endpoint or a host and port"""
+        print(FCN_FMT % function_name())
+        self.assertEqual(log_client.server_endpoint('pi1', 5555),
+                         'tcp://pi1:5555')
+        self.assertEqual(log_client.server_endpoint('ipc:///tmp/x.sock'),
+                         'ipc:///tmp/x.sock')
+        params = log_client.process_cmd_line(['--endpoint=ipc:///tmp/x'])
+        self.assertEqual(params['endpoint'], 'ipc:///tmp/x')
+
+    def test_server_flush_params(self):
+        """Flush policies and batch size come from the cmd line"""
+        print(FCN_FMT % function_name())
+        argv = str_to_argv('--batch-max=50 --flush-every-n=100 '
+                '--flush-bytes=65536 --flush-interval-ms=250')
+        params = log_server.process_cmd_line(argv)
+        self.assertEqual(params['batch_max'], 50)
+        self.assertEqual(params['flush_every_n'], 100)
+        self.assertEqual(params['flush_bytes'], 65536)
+        self.assertEqual(params['flush_interval_ms'], 250)
+
+        # Defaults flush every batch.
+        params = log_server.process_cmd_line([])
+        self.assertEqual(params['flush_every_n'], 1)
+        self.assertEqual(params['flush_bytes'], 0)
+        self.assertEqual(params['flush_interval_ms'], 0)
+
+    def test_server_invalid_flush_params(self):
+        """Non-numeric, negative and zero batch values fail"""
+        print(FCN_FMT % function_name())
+        for bad in ['--flush-bytes=XYZ', '--flush-every-n=-1',
+                    '--batch-max=0']:
+            with self.assertRaises(SystemExit) as err:
+                log_server.process_cmd_line([bad])
+            self.assertEqual(err.exception.code, 1)
+
+
+class LogWriterTest(unittest.TestCase):
+    """
+    Test the group commit writer and the batch receive.
+    """
+
+    filename = '/tmp/log_writer_test.log'
+
+    def make_writer(self, argv):
+        params = log_server.process_cmd_line(
+                str_to_argv('--log=%s --log-append=false %s' %
+                    (self.filename, argv)))
+        return log_server.LogWriter(
+                log_server.open_log_file_for_writing(params), params)
+
+    def tearDown(self):
+        for name in glob.glob(self.filename + '*'):
+            os.remove(name)
+
+    def test_flush_every_n(self):
+        """Flush only after N messages get written"""
+        print(FCN_FMT % function_name())
+        writer = self.make_writer('--flush-every-n=3')
+        writer.write_batch(['a\n', 'b\n'])
+        self.assertEqual(writer.flush_count, 0)
+        self.assertEqual(writer.pending_msgs, 2)
+        writer.write_batch(['c\n'])
+        self.assertEqual(writer.flush_count, 1)
+        self.assertEqual(writer.pending_msgs, 0)
+        writer.close()
+        self.assertEqual(open(self.filename).read(), 'a\nb\nc\n')
+
+    def test_flush_bytes(self):
+        """Flush only after N bytes get written"""
+        print(FCN_FMT % function_name())
+        writer = self.make_writer('--flush-every-n=0 --flush-bytes=10')
+        writer.write_batch(['12345\n'])
+        self.assertEqual(writer.flush_count, 0)
+        writer.write_batch(['12345\n'])
+        self.assertEqual(writer.flush_count, 1)
+        writer.close()
+
+    def test_flush_interval(self):
+        """The interval flush is only due with pending messages"""
+        print(FCN_FMT % function_name())
+        writer = self.make_writer('--flush-every-n=0 --flush-interval-ms=50')
+        self.assertEqual(writer.flush_timeout(), None)
+        writer.write_batch(['a\n'])
+        self.assertTrue(0 < writer.flush_timeout() <= 50)
+        writer.last_flush -= 1.0
+        writer.flush_if_due()
+        self.assertEqual(writer.flush_count, 1)
+        self.assertEqual(writer.flush_timeout(), None)
+        writer.close()
+
+    def test_rotate_bytes(self):
+        """The log rolls over by size and segments get compressed"""
+        print(FCN_FMT % function_name())
+        writer = self.make_writer('--rotate-bytes=10')
+        writer.write_batch(['12345\n'])
+        self.assertEqual(writer.rotator.rotate_count, 0)
+        writer.write_batch(['12345\n'])
+        self.assertEqual(writer.rotator.rotate_count, 1)
+        writer.write_batch(['abc\n'])
+        writer.close()
+        self.assertEqual(open(self.filename).read(), 'abc\n')
+        segments = glob.glob(self.filename + '.*')
+        self.assertEqual(len(segments), 1)
+        self.assertTrue(segments[0].endswith('.gz'))
+        self.assertEqual(gzip.open(segments[0]).read(), '12345\n12345\n')
+
+    def test_rotate_no_compress(self):
+        """Segment names stay unique within the same second"""
+        print(FCN_FMT % function_name())
+        writer = self.make_writer('--rotate-bytes=1 --compress=false')
+        for ndx in range(3):
+            writer.write_batch(['%d\n' % ndx])
+        writer.close()
+        segments = sorted(glob.glob(self.filename + '.*'))
+        self.assertEqual(len(segments), 3)
+        self.assertEqual([open(name).read() for name in segments],
+                ['0\n', '1\n', '2\n'])
+
+    def test_binary_format(self):
+        """Binary records get indexed, read back and recovered"""
+        print(FCN_FMT % function_name())
+        writer = self.make_writer('--format=binary --index-every=4')
+        records = [log_segment.pack_record(1000 + ndx, 'host %d' % ndx)
+                   for ndx in range(10)]
+        writer.write_batch(records[:6])
+        writer.write_batch(records[6:])
+        writer.close()
+
+        entries = log_segment.read_index(
+                self.filename + log_segment.INDEX_SUFFIX)
+        self.assertEqual([ts_ns for ts_ns, _ in entries], [1000, 1004, 1008])
+        offset = log_segment.find_offset(entries, 1006)
+        self.assertEqual(offset, entries[1][1])
+        with open(self.filename, 'rb') as handle:
+            found = [msg for _, msg, _ in
+                     log_segment.iter_records(handle, offset)]
+        self.assertEqual(found, ['host %d' % ndx for ndx in range(4, 10)])
+
+        # Tear the last record and reopen for append.
+        size = os.path.getsize(self.filename)
+        with open(self.filename, 'r+b') as handle:
+            handle.truncate(size - 3)
+        writer = self.make_writer('--format=binary --index-every=4 '
+                                  '--log-append=true')
+        self.assertEqual(os.path.getsize(self.filename),
+                size - len(records[9]))
+        writer.write_batch([log_segment.pack_record(2000, 'host again')])
+        writer.close()
+        with open(self.filename, 'rb') as handle:
+            found = [msg for _, msg, _ in log_segment.iter_records(handle)]
+        self.assertEqual(found[-2:], ['host 8', 'host again'])
+        entries = log_segment.read_index(
+                self.filename + log_segment.INDEX_SUFFIX)
+        self.assertEqual([ts_ns for ts_ns, _ in entries], [1000, 1004, 1008])
+
+    def test_pipelined_writer(self):
+        """The writer thread writes every batch before closing"""
+        print(FCN_FMT % function_name())
+        params = log_server.process_cmd_line(
+                str_to_argv('--log=%s --log-append=false '
+                    '--pipeline=true --pipeline-depth=2' % self.filename))
+        context = zmq.Context()
+        writer = log_server.make_writer(
+                log_server.open_log_file_for_writing(params),
+                params, context)
+        self.assertTrue(isinstance(writer, log_server.PipelinedWriter))
+        for ndx in range(10):
+            writer.write_batch(['%d\n' % ndx])
+        writer.close()
+        self.assertEqual(writer.batches_sent, 10)
+        self.assertEqual(writer.queue_depth(), 0)
+        self.assertEqual(writer.writer.flush_count, 10)
+        self.assertEqual(open(self.filename).read(),
+                ''.join(['%d\n' % ndx for ndx in range(10)]))
+        context.term()
+
+    def test_publish(self):
+        """Received logs get published with the host as topic"""
+        print(FCN_FMT % function_name())
+        context = zmq.Context()
+        pull = context.socket(zmq.PULL)
+        pull.bind('inproc://publish')
+        push = context.socket(zmq.PUSH)
+        push.connect('inproc://publish')
+        params = log_server.process_cmd_line(['--format=binary'])
+        publisher = log_server.LogPublisher(context, params,
+                'inproc://publish_sub')
+        sub = context.socket(zmq.SUB)
+        sub.setsockopt(zmq.SUBSCRIBE, 'pi2')
+        sub.bind('inproc://publish_sub')
+        # Let the subscription reach the publisher.
+        sub.poll(100)
+
+        for host in ['pi1', 'pi2']:
+            push.send('%s a log' % host)
+        pull.poll(1000)
+        receiver = log_server.Receiver(pull, 10,
+                log_server.stamp_binary, publisher)
+        lines, _ = receiver.receive_batch()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(publisher.publish_count, 2)
+        sub.poll(1000)
+        topic, line = sub.recv_multipart()
+        self.assertEqual(topic, 'pi2')
+        self.assertTrue(line.endswith(' pi2 a log\n'))
+        self.assertEqual(sub.poll(100), 0)
+
+        for sock in [pull, push, sub]:
+            sock.close(linger=0)
+        publisher.close()
+        context.term()
+
+    def test_receive_batch(self):
+        """Drain queued messages up to the batch limit, stop at exit"""
+        print(FCN_FMT % function_name())
+        context = zmq.Context()
+        pull = context.socket(zmq.PULL)
+        pull.bind('inproc://receive_batch')
+        push = context.socket(zmq.PUSH)
+        push.connect('inproc://receive_batch')
+        for ndx in range(5):
+            push.send('host %d' % ndx)
+        push.send('host %s' % log_server.EXIT_SERVER)
+        push.send('host after exit')
+        pull.poll(1000)
+
+        receiver = log_server.Receiver(pull, 3)
+        lines, exit_requested = receiver.receive_batch()
+        self.assertEqual(len(lines), 3)
+        self.assertFalse(exit_requested)
+        self.assertTrue(lines[0].endswith(' host 0\n'))
+
+        receiver.batch_max = 100
+        lines, exit_requested = receiver.receive_batch()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(exit_requested)
+        self.assertEqual(receiver.msg_count, 6)
+
+        # Without in band commands, @EXIT@ is just a log.
+        receiver.inband = False
+        lines, exit_requested = receiver.receive_batch()
+        self.assertEqual(len(lines), 1)
+        self.assertFalse(exit_requested)
+
+        # The logs after an exit inside a batch get dropped.
+        receiver.inband = True
+        push.send_multipart(log_wire.encode_batch(
+                ['host a', 'host %s' % log_server.EXIT_SERVER, 'host b']))
+        pull.poll(1000)
+        lines, exit_requested = receiver.receive_batch()
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].endswith(' host a\n'))
+        self.assertTrue(exit_requested)
+
+        # Echo commands take effect in order, message by message,
+        # and the exit message gets echoed too.
+        push.send_multipart(log_wire.encode_batch(
+                ['host a', 'host %s' % log_server.ECHO_SERVER_FALSE,
+                 'host b', 'host %s' % log_server.ECHO_SERVER_TRUE,
+                 'host %s' % log_server.EXIT_SERVER]))
+        pull.poll(1000)
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        log_server.ECHO_SWITCH = True
+        try:
+            lines, exit_requested = receiver.receive_batch()
+            echoed = sys.stdout.getvalue().splitlines()
+        finally:
+            sys.stdout = stdout
+            log_server.ECHO_SWITCH = False
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(exit_requested)
+        self.assertEqual([line.split(' ', 3)[3] for line in echoed],
+                ['a', log_server.ECHO_SERVER_TRUE, log_server.EXIT_SERVER])
+
+        push.close()
+        pull.close()
+        context.term()
+
+
+class BatchTest(unittest.TestCase):
+    """
+    Test batches of logs from client to server.
+    """
+
+    def test_encode_decode(self):
+        """Records survive a round trip, bad batches get refused"""
+        print(FCN_FMT % function_name())
+        records = ['host a', '', 'host ' + 'x' * 1000]
+        frames = log_wire.encode_batch(records)
+        self.assertTrue(log_wire.is_batch(frames))
+        self.assertEqual(log_wire.decode_batch(frames), records)
+        self.assertFalse(log_wire.is_batch(['host a', 'host b']))
+        with self.assertRaises(log_wire.BatchError):
+            log_wire.decode_batch([frames[0], frames[1][:-1]])
+
+        frames = log_wire.encode_batch(records * 10, compress_level=6,
+                                       compress_min_bytes=100)
+        self.assertTrue(log_wire.batch_flags(frames) &
+                        log_wire.FLAG_COMPRESSED)
+        self.assertTrue(len(frames[1]) < 1000)
+        self.assertEqual(log_wire.decode_batch(frames), records * 10)
+        with self.assertRaises(log_wire.BatchError):
+            log_wire.decode_batch([frames[0], 'not zlib'])
+
+        # Too small to be worth compressing
+        frames = log_wire.encode_batch(['host a'], compress_level=6,
+                                       compress_min_bytes=100)
+        self.assertEqual(log_wire.batch_flags(frames), 0)
+
+    def test_batch_sender(self):
+        """Batches get unpacked into the same lines as single logs"""
+        print(FCN_FMT % function_name())
+        context = zmq.Context()
+        pull = context.socket(zmq.PULL)
+        pull.bind('inproc://batch')
+        push = context.socket(zmq.PUSH)
+        push.connect('inproc://batch')
+
+        sender = log_client.BatchSender(push, 4, compress_level=1)
+        for ndx in range(10):
+            sender.send('%d' % ndx)
+        self.assertEqual(sender.batch_count, 2)
+        sender.flush()
+        self.assertEqual(sender.batch_count, 3)
+        log_client.send_msg(push, 'single')
+        push.send_multipart(['IOTB bad', 'frames'])
+
+        receiver = log_server.Receiver(pull, 100)
+        lines = []
+        while receiver.msg_count < 5:
+            pull.poll(1000)
+            lines += receiver.receive_batch()[0]
+        self.assertEqual(receiver.batch_count, 3)
+        self.assertEqual(receiver.bad_batch_count, 1)
+        self.assertEqual(receiver.record_count, 11)
+        self.assertEqual(receiver.uncompressed_bytes, sender.raw_bytes)
+        self.assertEqual(receiver.compressed_bytes, sender.sent_bytes)
+        self.assertEqual([line.split(' ', 3)[3] for line in lines],
+                ['%d\n' % ndx for ndx in range(10)] + ['single\n'])
+
+        push.close(linger=0)
+        pull.close(linger=0)
+        context.term()
+
+    def test_send_time(self):
+        """Delivery latency gets measured per host"""
+        print(FCN_FMT % function_name())
+        frames = log_wire.encode_batch(['host a'], send_time=123)
+        self.assertEqual(log_wire.batch_send_time(frames), 123)
+        self.assertEqual(log_wire.decode_batch(frames), ['host a'])
+        self.assertIsNone(log_wire.batch_send_time(
+                log_wire.encode_batch(['host a'])))
+        with self.assertRaises(log_wire.BatchError):
+            log_wire.decode_batch([frames[0][:-1], frames[1]])
+
+        context = zmq.Context()
+        pull = context.socket(zmq.PULL)
+        pull.bind('inproc://send_time')
+        push = context.socket(zmq.PUSH)
+        push.connect('inproc://send_time')
+        sender = log_client.BatchSender(push, 1, send_time=True)
+        sender.send('one')
+        sender.send('two')
+        push.send_multipart(log_wire.encode_batch(
+                ['other late'], send_time=log_segment.time_ns() - 10 ** 9))
+
+        receiver = log_server.Receiver(pull, 100)
+        while receiver.msg_count < 3:
+            pull.poll(1000)
+            receiver.receive_batch()
+        latency = receiver.stats()['delivery_latency']
+        host = sender.prefix.strip()
+        self.assertEqual(sorted(latency), sorted([host, 'other']))
+        self.assertEqual(latency[host]['count'], 2)
+        self.assertTrue(latency[host]['p99'] < 1.0)
+        self.assertTrue(latency['other']['p50'] > 0.8)
+        self.assertEqual(len(receiver.latency_report()), 2)
+        self.assertTrue(log_client.process_cmd_line(
+                ['--send-time=true'])['send_time'])
+
+        push.close(linger=0)
+        pull.close(linger=0)
+        context.term()
+
+    def test_sequence(self):
+        """Missing and repeated logs get counted per sender"""
+        print(FCN_FMT % function_name())
+        frames = log_wire.encode_batch(['host a', 'host b'], send_time=123,
+                                       sequence=(7, 40))
+        self.assertEqual(log_wire.batch_send_time(frames), 123)
+        self.assertEqual(log_wire.batch_sequence(frames), (7, 40))
+        self.assertEqual(log_wire.decode_batch(frames), ['host a', 'host b'])
+        self.assertIsNone(log_wire.batch_sequence(
+                log_wire.encode_batch(['host a'], send_time=123)))
+        with self.assertRaises(log_wire.BatchError):
+            log_wire.decode_batch([frames[0][:-1], frames[1]])
+        self.assertIsNone(log_wire.batch_unacked(frames))
+        frames = log_wire.add_unacked(frames, 30)
+        self.assertEqual(log_wire.batch_unacked(frames), 30)
+        self.assertEqual(log_wire.batch_sequence(frames), (7, 40))
+        self.assertEqual(log_wire.batch_send_time(frames), 123)
+        self.assertEqual(log_wire.decode_batch(frames), ['host a', 'host b'])
+
+        tracker = log_stats.SequenceTracker()
+        self.assertEqual(tracker.observe('a', 1, 0, 10), 0)
+        self.assertEqual(tracker.observe('a', 1, 15, 5), 0)
+        self.assertEqual(tracker.observe('a', 1, 18, 4), 2)
+        self.assertEqual(tracker.observe('a', 2, 3, 1), 0)
+        self.assertEqual(tracker.observe('b', 1, 0, 10), 0)
+        stats = tracker.stats()
+        self.assertEqual(stats['sequence_streams'], 3)
+        self.assertEqual(stats['sequence_gaps'], 2)
+        self.assertEqual(stats['records_missing'], 8)
+        self.assertEqual(stats['records_duplicated'], 2)
+        self.assertEqual(stats['sequence_loss'],
+                         {'a': {'missing': 8, 'duplicated': 2}})
+
+        context = zmq.Context()
+        pull = context.socket(zmq.PULL)
+        pull.bind('inproc://sequence')
+        push = context.socket(zmq.PUSH)
+        push.connect('inproc://sequence')
+        params = log_client.process_cmd_line(
+                ['--sequence=true', '--batch-size=10'])
+        _, sender = log_client.make_senders(push, params, 'seq')
+        batches = []
+
+        class Flow(object):
+            def send(self, frames, count):
+                batches.append(frames)
+        sender.flow = Flow()
+        for ndx in range(30):
+            sender.send('%d' % ndx)
+        # Lose the second batch.
+        for frames in batches[:1] + batches[2:]:
+            push.send_multipart(frames)
+
+        receiver = log_server.Receiver(pull, 100)
+        while receiver.msg_count < 2:
+            pull.poll(1000)
+            receiver.receive_batch()
+        stats = receiver.stats()
+        self.assertEqual(stats['records_received'], 20)
+        self.assertEqual(stats['records_missing'], 10)
+        self.assertEqual(stats['sequence_loss'],
+                         {'seq': {'missing': 10, 'duplicated': 0}})
+
+        push.close(linger=0)
+        pull.close(linger=0)
+        context.term()
+
+    def test_batch_params(self):
+        """Batch options must be non-negative integers"""
+        print(FCN_FMT % function_name())
+        params = log_client.process_cmd_line(
+                ['--batch-size=100', '--batch-linger-ms=5'])
+        self.assertEqual(params['batch_size'], 100)
+        self.assertEqual(params['batch_linger_ms'], 5)
+        with self.assertRaises(SystemExit) as err:
+            log_client.process_cmd_line(['--batch-size=-1'])
+        self.assertEqual(err.exception.code, 1)
+
+
+class OverflowTest(unittest.TestCase):
+    """
+    Test high water marks and the client overflow policies.
+    """
+
+    def setUp(self):
+        self.context = zmq.Context()
+        # A PUSH socket with no peer has no room for anything.
+        self.push = self.context.socket(zmq.PUSH)
+        self.push.bind('inproc://overflow')
+
+    def tearDown(self):
+        self.push.close(linger=0)
+        self.context.term()
+
+    def test_overflow_params(self):
+        """HWM, linger, send timeout and overflow options"""
+        print(FCN_FMT % function_name())
+        params = log_client.process_cmd_line(
+                ['--sndhwm=10', '--linger-ms=-1', '--send-timeout-ms=50',
+                 '--overflow=spill', '--spill-max=5'])
+        self.assertEqual(params['sndhwm'], 10)
+        self.assertEqual(params['linger_ms'], -1)
+        self.assertEqual(params['send_timeout_ms'], 50)
+        self.assertEqual(params['overflow'], 'spill')
+        self.assertEqual(params['spill_max'], 5)
+        for argv in [['--overflow=wait'], ['--linger-ms=-2']]:
+            with self.assertRaises(SystemExit) as err:
+                log_client.process_cmd_line(argv)
+            self.assertEqual(err.exception.code, 1)
+
+        params = log_server.process_cmd_line(
+                ['--rcvhwm=10', '--sndhwm=20', '--linger-ms=-1',
+                 '--send-timeout-ms=100'])
+        self.assertEqual(params['rcvhwm'], 10)
+        self.assertEqual(params['sndhwm'], 20)
+        self.assertEqual(params['linger_ms'], -1)
+        self.assertEqual(params['send_timeout_ms'], 100)
+        with self.assertRaises(SystemExit) as err:
+            log_server.process_cmd_line(['--send-timeout-ms=-5'])
+        self.assertEqual(err.exception.code, 1)
+
+    def test_drop(self):
+        """Messages without room get dropped and counted"""
+        print(FCN_FMT % function_name())
+        flow = log_client.OverflowSender(self.push, 'drop')
+        flow.send(['host a'])
+        flow.send(['host b'], 10)
+        self.assertEqual((flow.sent_count, flow.drop_count), (0, 11))
+
+        # A blocking send that times out drops too.
+        self.push.setsockopt(zmq.SNDTIMEO, 10)
+        flow = log_client.OverflowSender(self.push, 'block')
+        flow.send(['host a'])
+        self.assertEqual((flow.sent_count, flow.drop_count), (0, 1))
+
+    def test_spill(self):
+        """Spilled messages get sent in order once there is room"""
+        print(FCN_FMT % function_name())
+        flow = log_client.OverflowSender(self.push, 'spill', spill_max=3)
+        for ndx in range(5):
+            flow.send(['host %d' % ndx])
+        self.assertEqual(flow.spill_count, 3)
+        self.assertEqual(flow.spill_peak, 3)
+        self.assertEqual(flow.drop_count, 2)
+
+        pull = self.context.socket(zmq.PULL)
+        pull.connect('inproc://overflow')
+        # The push socket sees the new peer after a moment.
+        while not flow.send_spilled():
+            time.sleep(0.01)
+        flow.send(['host 5'])
+        flow.flush()
+        self.assertEqual(flow.sent_count, 4)
+        self.assertEqual([pull.recv() for _ in range(4)],
+                         ['host 0', 'host 1', 'host 2', 'host 5'])
+        self.assertIn('dropped:2', flow.report())
+        pull.close(linger=0)
+
+    def test_forward_drops(self):
+        """Messages a worker cannot take in time get dropped"""
+        print(FCN_FMT % function_name())
+        frontend = self.context.socket(zmq.PULL)
+        frontend.bind('inproc://overflow_front')
+        push = self.context.socket(zmq.PUSH)
+        push.connect('inproc://overflow_front')
+        self.push.setsockopt(zmq.SNDTIMEO, 10)
+
+        push.send('lost')
+        frontend.poll(1000)
+        counts, drops = [0], [0]
+        log_server.forward_batch(frontend, [self.push], 0, 10,
+                                 counts, drops)
+        self.assertEqual((counts, drops), ([0], [1]))
+        push.close(linger=0)
+        frontend.close(linger=0)
+
+
+class SpoolTest(unittest.TestCase):
+    """
+    Test the disk spool of --overflow=spool.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='spool_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_disk_spool(self):
+        """Messages come back in order across segments and runs"""
+        print(FCN_FMT % function_name())
+        spool = log_spool.DiskSpool(self.directory, segment_bytes=100)
+        for ndx in range(20):
+            self.assertTrue(spool.append(['host %d' % ndx], 1))
+        spool.append(log_wire.encode_batch(['host a', 'host b']), 2)
+        self.assertTrue(len(spool.segments) > 1)
+        spool.consume(len(spool.peek(3)))
+        spool.close()
+
+        # The next run starts again from the start of
+        # the oldest segment.
+        spool = log_spool.DiskSpool(self.directory, segment_bytes=100)
+        frames = []
+        while not spool.empty():
+            messages = spool.peek(1000)
+            frames += [message[0] for message in messages]
+            spool.consume(len(messages))
+        self.assertEqual(frames[:-1], [['host %d' % ndx]
+                                       for ndx in range(20)])
+        self.assertEqual(log_wire.decode_batch(frames[-1]),
+                         ['host a', 'host b'])
+        spool.close()
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_torn_and_full(self):
+        """A torn record ends its segment and a full spool drops"""
+        print(FCN_FMT % function_name())
+        spool = log_spool.DiskSpool(self.directory, max_bytes=100)
+        self.assertTrue(spool.append(['host 0'], 1))
+        self.assertTrue(spool.append(['host 1'], 1))
+        record_size = spool.size / 2
+        while spool.append(['host x'], 1):
+            pass
+        self.assertTrue(spool.size <= 100 < spool.size + record_size)
+        spool.close()
+        filename = log_spool.segment_filename(self.directory, 1)
+        with open(filename, 'r+b') as handle:
+            handle.truncate(2 * record_size + 3)
+
+        spool = log_spool.DiskSpool(self.directory)
+        messages = list(spool.peek(10))
+        self.assertEqual([message[0] for message in messages],
+                         [['host 0'], ['host 1']])
+        spool.consume(2)
+        self.assertEqual(len(spool.peek(10)), 0)
+        self.assertTrue(spool.empty())
+        self.assertEqual(spool.corrupt_count, 1)
+        self.assertFalse(os.path.exists(filename))
+
+    def test_replay_message(self):
+        """Plain logs get replayed in batches, batches as they are"""
+        print(FCN_FMT % function_name())
+        batch = log_wire.encode_batch(['host c'])
+        messages = [(['host a'], 1, 0), (['host b'], 1, 0), (batch, 1, 0)]
+        frames, count, taken = log_spool.replay_message(messages)
+        self.assertEqual(log_wire.decode_batch(frames), ['host a', 'host b'])
+        self.assertEqual((count, taken), (2, 2))
+        self.assertEqual(log_spool.replay_message(messages[2:]),
+                         (batch, 1, 1))
+        self.assertEqual(log_spool.replay_message(messages, 1),
+                         (['host a'], 1, 1))
+
+    def test_spool_sender(self):
+        """Spooled logs from an earlier run go out first, in order"""
+        print(FCN_FMT % function_name())
+        context = zmq.Context()
+        # A PUSH socket with no peer has no room for anything.
+        push = context.socket(zmq.PUSH)
+        push.bind('inproc://spool')
+        flow = log_client.OverflowSender(
+                push, 'spool', spool=log_spool.DiskSpool(self.directory))
+        for ndx in range(50):
+            flow.send(['host %d' % ndx])
+        self.assertEqual((flow.sent_count, flow.spill_count), (0, 50))
+        flow.spool.close()
+
+        pull = context.socket(zmq.PULL)
+        pull.connect('inproc://spool')
+        flow = log_client.OverflowSender(
+                push, 'spool', spool=log_spool.DiskSpool(self.directory))
+        # The push socket sees the new peer after a moment.
+        while not flow.send_spilled():
+            time.sleep(0.01)
+        flow.send(['host 50'])
+        flow.flush()
+        self.assertEqual(flow.sent_count, 51)
+        # The 50 spooled logs arrive as a single batch.
+        logs = log_wire.decode_batch(pull.recv_multipart()) + [pull.recv()]
+        self.assertEqual(logs, ['host %d' % ndx for ndx in range(51)])
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertIn('replayed:50', flow.report())
+        pull.close(linger=0)
+        push.close(linger=0)
+        context.term()
+
+    def test_spool_params(self):
+        """Spool options, and one spool per sending thread"""
+        print(FCN_FMT % function_name())
+        params = log_client.process_cmd_line(
+                ['--overflow=spool', '--spool-dir=/tmp/x',
+                 '--spool-max-bytes=1000', '--spool-segment-bytes=100'])
+        self.assertEqual(params['spool_dir'], '/tmp/x')
+        self.assertEqual(params['spool_max_bytes'], 1000)
+        self.assertEqual(params['spool_segment_bytes'], 100)
+        with self.assertRaises(SystemExit) as err:
+            log_client.process_cmd_line(['--overflow=spool', '--rate=10',
+                                         '--threads=2'])
+        self.assertEqual(err.exception.code, 1)
+
+
+class StatsTest(unittest.TestCase):
+    """
+    Test the latency histograms and the metrics endpoint.
+    """
+
+    def test_histogram(self):
+        """Values land in cumulative buckets"""
+        print(FCN_FMT % function_name())
+        hist = log_stats.Histogram([0.001, 0.01])
+        for value in [0.0005, 0.001, 0.005, 0.5]:
+            hist.observe(value)
+        stats = hist.to_dict()
+        self.assertEqual(stats['buckets'],
+                         [[0.001, 2], [0.01, 3], ['+Inf', 4]])
+        self.assertEqual(stats['count'], 4)
+        self.assertAlmostEqual(stats['sum'], 0.5065)
+
+        total = log_stats.add_stats({}, {'a': 1, 'h': stats, 's': 'x'})
+        log_stats.add_stats(total, {'a': 2, 'h': stats})
+        self.assertEqual(total['a'], 3)
+        self.assertEqual(total['h']['buckets'][-1], ['+Inf', 8])
+        self.assertNotIn('s', total)
+        # The merge leaves the original alone.
+        self.assertEqual(stats['buckets'][-1], ['+Inf', 4])
+
+    def test_quantile(self):
+        """Percentiles come from the buckets"""
+        print(FCN_FMT % function_name())
+        hist = log_stats.Histogram([1.0, 2.0, 4.0])
+        self.assertEqual(hist.quantile(0.5), 0.0)
+        for value in [0.5] * 50 + [1.5] * 49 + [3.0]:
+            hist.observe(value)
+        self.assertAlmostEqual(hist.quantile(0.5), 1.0)
+        self.assertAlmostEqual(hist.quantile(0.99), 2.0)
+        self.assertAlmostEqual(hist.quantile(1.0), 4.0)
+        summary = hist.percentiles()
+        self.assertEqual(summary['count'], 100)
+        self.assertAlmostEqual(summary['mean'], 1.015)
+        hist.observe(100.0)
+        self.assertEqual(hist.quantile(1.0), 4.0)
+
+    def test_prometheus_text(self):
+        """Numbers and histograms in the Prometheus format"""
+        print(FCN_FMT % function_name())
+        hist = log_stats.Histogram([0.5])
+        hist.observe(0.25)
+        text = log_stats.prometheus_text(
+                {'msgs': 3, 'lat': hist.to_dict(), 'workers': []})
+        self.assertEqual(text.splitlines(), [
+            '# TYPE log_server_lat histogram',
+            'log_server_lat_bucket{le="0.5"} 1',
+            'log_server_lat_bucket{le="+Inf"} 1',
+            'log_server_lat_sum 0.25',
+            'log_server_lat_count 1',
+            'log_server_msgs 3',
+        ])
+
+    def test_metrics_server(self):
+        """The stats get served over HTTP"""
+        print(FCN_FMT % function_name())
+        counts = {'msgs': 0}
+        metrics = log_stats.MetricsServer(0, lambda: counts)
+        counts['msgs'] = 7
+        url = 'http://127.0.0.1:%d' % metrics.port
+        try:
+            body = urllib2.urlopen(url + '/metrics', timeout=5).read()
+            self.assertEqual(body, 'log_server_msgs 7\n')
+            with self.assertRaises(urllib2.HTTPError):
+                urllib2.urlopen(url + '/other', timeout=5)
+        finally:
+            metrics.close()
+        params = log_server.process_cmd_line(['--metrics-port=9100'])
+        self.assertEqual(params['metrics_port'], 9100)
+
+
+class LoadTest(unittest.TestCase):
+    """
+    Test the open loop load schedule.
+    """
+
+    def test_arrival_times(self):
+        """Constant, Poisson and burst schedules"""
+        print(FCN_FMT % function_name())
+        times = log_load.arrival_times(100.0, 10)
+        self.assertEqual([round(next(times), 6) for _ in range(3)],
+                         [100.1, 100.2, 100.3])
+
+        rng = random.Random(1)
+        times = log_load.arrival_times(0.0, 1000, poisson=True, rng=rng)
+        last = [next(times) for _ in range(10000)][-1]
+        self.assertTrue(9.5 < last < 10.5)
+
+        self.assertEqual(log_load.rate_at(0.5, 10, 100, 1, 5), 100)
+        self.assertEqual(log_load.rate_at(3.0, 10, 100, 1, 5), 10)
+        self.assertEqual(log_load.rate_at(5.2, 10, 100, 1, 5), 100)
+
+    def test_send_load(self):
+        """A slow send shows up as lag, not a later schedule"""
+        print(FCN_FMT % function_name())
+        sent = []
+
+        def send(msg, intended):
+            sent.append((msg, intended))
+            if len(sent) == 1:
+                time.sleep(0.05)
+
+        start = time.time()
+        stats = log_load.send_load(send, start,
+                log_load.arrival_times(start, 1000), 20, 'x')
+        self.assertEqual(stats.sent, 20)
+        self.assertEqual(sent[0][0], '0: x')
+        # The schedule kept its pace despite the slow send.
+        self.assertAlmostEqual(sent[-1][1] - start, 0.02, places=4)
+        self.assertTrue(stats.max_lag >= 0.04)
+        self.assertTrue(stats.last_sent - start >= 0.05)
+
+    def test_load_params(self):
+        """Load options and their checks"""
+        print(FCN_FMT % function_name())
+        params = log_client.process_cmd_line(
+                ['--rate=500.5', '--arrivals=poisson', '--threads=4',
+                 '--duration-s=2', '--burst-rate=2000', '--burst-secs=1',
+                 '--burst-every-s=10'])
+        self.assertEqual(params['rate'], 500.5)
+        self.assertEqual(params['arrivals'], 'poisson')
+        self.assertEqual(params['threads'], 4)
+        self.assertEqual(params['duration_s'], 2.0)
+        self.assertEqual(params['burst_every_s'], 10.0)
+        for argv in [['--threads=2'], ['--rate=-1'], ['--arrivals=bursty']]:
+            with self.assertRaises(SystemExit) as err:
+                log_client.process_cmd_line(argv)
+            self.assertEqual(err.exception.code, 1)
+
+
+class FleetTest(unittest.TestCase):
+    """
+    Test many simulated clients sending from one process.
+    """
+
+    def run_fleet(self, argv, expected):
+        """Run the fleet set by argv against a PULL socket.
+        Answers the report lines and the logs received."""
+        context = zmq.Context()
+        pull = context.socket(zmq.PULL)
+        port = pull.bind_to_random_port('tcp://127.0.0.1')
+        params = log_client.process_cmd_line(
+                str_to_argv(argv) + ['--port=%d' % port])
+        lines = []
+        fleet = threading.Thread(
+                target=lambda: lines.extend(log_fleet.run_fleet(params)[1]))
+        fleet.start()
+        logs = []
+        while len(logs) < expected and pull.poll(5000):
+            frames = pull.recv_multipart()
+            if log_wire.is_batch(frames):
+                logs += log_wire.decode_batch(frames)
+            else:
+                logs += frames
+        fleet.join()
+        pull.close(linger=0)
+        context.term()
+        return lines, logs
+
+    def test_fleet(self):
+        """Every client sends its logs on a connection of its own"""
+        print(FCN_FMT % function_name())
+        lines, logs = self.run_fleet(
+                '--fleet=200 --count=5 --threads=4 --log_msg=x', 1000)
+        self.assertEqual(len(logs), 1000)
+        hosts = {}
+        for log in logs:
+            host, msg = log.split(' ', 1)
+            hosts.setdefault(host, []).append(msg)
+        self.assertEqual(len(hosts), 200)
+        self.assertEqual(sorted(hosts['pi0199']),
+                         ['%d: x' % ndx for ndx in range(5)])
+        self.assertTrue(lines[0].startswith(
+                'fleet clients:200 threads:4 sent:1000 dropped:0'))
+
+    def test_fleet_rate(self):
+        """The fleet as a whole sends at --rate"""
+        print(FCN_FMT % function_name())
+        lines, logs = self.run_fleet(
+                '--fleet=50 --count=2 --rate=5000 --send-time=true '
+                '--fleet-prefix=sim', 100)
+        self.assertEqual(len(logs), 100)
+        self.assertEqual(len(set([log.split()[0] for log in logs])), 50)
+        self.assertTrue(logs[0].startswith('sim00'))
+        self.assertTrue(lines[1].startswith('load target_rate:5000.0'))
+        self.assertTrue(' sent:100 ' in lines[1])
+
+    def test_fleet_connections(self):
+        """log_client --fleet connects once more only for an in-band exit"""
+        print(FCN_FMT % function_name())
+        from zmq.utils.monitor import recv_monitor_message
+        context = zmq.Context()
+        pull = context.socket(zmq.PULL)
+        port = pull.bind_to_random_port('tcp://127.0.0.1')
+        monitor = pull.get_monitor_socket(zmq.EVENT_ACCEPTED)
+        for svr_exit, connections in [('false', 10), ('true', 11)]:
+            client = subprocess.Popen(
+                    [sys.executable, LOG_CLIENT_NAME, '--fleet=10',
+                     '--count=5', '--svr-exit=%s' % svr_exit,
+                     '--endpoint=tcp://127.0.0.1:%d' % port],
+                    stdout=subprocess.PIPE)
+            logs = []
+            while len(logs) < 50 and pull.poll(5000):
+                logs.append(pull.recv())
+            client.communicate()
+            self.assertEqual(client.returncode, 0)
+            self.assertEqual(len(logs), 50)
+            exits = []
+            while pull.poll(100):
+                exits.append(pull.recv())
+            self.assertEqual(len(exits), connections - 10)
+            accepted = 0
+            while monitor.poll(100):
+                recv_monitor_message(monitor)
+                accepted += 1
+            self.assertEqual(accepted, connections)
+        pull.disable_monitor()
+        monitor.close(linger=0)
+        pull.close(linger=0)
+        context.term()
+
+    def test_fleet_params(self):
+        """--threads needs --rate or --fleet"""
+        print(FCN_FMT % function_name())
+        params = log_client.process_cmd_line(['--fleet=10', '--threads=2'])
+        self.assertEqual(params['fleet'], 10)
+        self.assertEqual(params['fleet_prefix'], 'pi')
+        self.assertEqual(log_fleet.fleet_host('pi', 7), 'pi0007')
+        with self.assertRaises(SystemExit) as err:
+            log_client.process_cmd_line(['--fleet=-1'])
+        self.assertEqual(err.exception.code, 1)
+
+
+class FixtureTest(unittest.TestCase):
+    """
+    Test servers started in this process on endpoints of their own.
+    """
+
+    def send_logs(self, endpoint, count):
+        context, push = log_client.setup_zmq(endpoint)
+        for ndx in range(count):
+            push.send('host %d' % ndx)
+        push.close()
+        context.term()
+
+    def test_tcp_fixture(self):
+        """Two servers on random ports at once"""
+        print(FCN_FMT % function_name())
+        with log_fixture.LogServerFixture() as first:
+            with log_fixture.LogServerFixture('--async=true') as second:
+                self.assertNotEqual(first.endpoint, second.endpoint)
+                self.send_logs(first.endpoint, 100)
+                self.send_logs(second.endpoint, 50)
+                self.assertTrue(first.drain(100)['drained'])
+                self.assertTrue(second.drain(50)['drained'])
+                self.assertEqual(len(first.lines()), 100)
+                self.assertEqual(len(second.lines()), 50)
+                work_dir = first.work_dir
+        self.assertFalse(os.path.exists(work_dir))
+
+    def test_ipc_client_exit(self):
+        """A log_client process stops the server once drained"""
+        print(FCN_FMT % function_name())
+        with log_fixture.LogServerFixture(transport='ipc') as server:
+            self.assertTrue(server.endpoint.startswith('ipc://'))
+            client = subprocess.Popen(
+                    [sys.executable, LOG_CLIENT_NAME, '--count=200',
+                     '--batch-size=10', '--svr-exit=true',
+                     '--endpoint=%s' % server.endpoint,
+                     '--control=%s' % server.control],
+                    stdout=subprocess.PIPE)
+            client.communicate()
+            self.assertEqual(client.returncode, 0)
+            server.thread.join(10)
+            self.assertFalse(server.thread.is_alive())
+            self.assertEqual(len(server.lines()), 200)
+
+
+class LossySocket(object):
+    """A socket that loses the message sent lost-th."""
+
+    def __init__(self, socket, lost):
+        self.socket = socket
+        self.lost = lost
+        self.sends = 0
+
+    def send_multipart(self, frames, flags=0):
+        self.sends += 1
+        if self.sends != self.lost:
+            self.socket.send_multipart(frames, flags)
+
+    def __getattr__(self, name):
+        return getattr(self.socket, name)
+
+
+class LogClientTest(unittest.TestCase):
+    """
+    Test the LogClient shared by the threads of a process.
+    """
+
+    def test_threads(self):
+        """Each thread sends on a socket of its own"""
+        print(FCN_FMT % function_name())
+        context = zmq.Context()
+        pull = context.socket(zmq.PULL)
+        port = pull.bind_to_random_port('tcp://127.0.0.1')
+        client = log_client.LogClient('tcp://127.0.0.1:%d' % port,
+                                      host='sensor')
+        self.assertIs(client.context, zmq.Context.instance())
+
+        def send_some(name):
+            for ndx in range(10):
+                client.send('%s %d' % (name, ndx))
+            client.send_many(['%s many' % name, u'%s \xb0C' % name])
+
+        threads = [threading.Thread(target=send_some, args=('t%d' % ndx,))
+                   for ndx in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        client.send('main')
+        self.assertEqual(len(client.sockets), 4)
+
+        logs = []
+        while len(logs) < 37 and pull.poll(5000):
+            frames = pull.recv_multipart()
+            if log_wire.is_batch(frames):
+                logs += log_wire.decode_batch(frames)
+            else:
+                logs += frames
+        self.assertEqual(len(logs), 37)
+        self.assertEqual([log for log in logs if log.startswith('sensor t1')],
+                         ['sensor t1 %d' % ndx for ndx in range(10)] +
+                         ['sensor t1 many', 'sensor t1 \xc2\xb0C'])
+        self.assertIn('sensor main', logs)
+        client.close()
+        self.assertEqual(client.sockets, [])
+        pull.close(linger=0)
+        context.term()
+
+
+class HandlerTest(unittest.TestCase):
+    """
+    Test the logging.Handler that sends from a background thread.
+    """
+
+    def setUp(self):
+        self.context = zmq.Context()
+        self.pull = self.context.socket(zmq.PULL)
+        port = self.pull.bind_to_random_port('tcp://127.0.0.1')
+        self.endpoint = 'tcp://127.0.0.1:%d' % port
+        self.logger = logging.getLogger(self.id())
+        self.logger.propagate = False
+
+    def tearDown(self):
+        self.pull.close(linger=0)
+        self.context.term()
+
+    def receive(self, count):
+        """Answer the next count logs, fewer if they stop."""
+        logs = []
+        while len(logs) < count and self.pull.poll(5000):
+            logs += log_wire.decode_batch(self.pull.recv_multipart())
+        return logs
+
+    def test_handler(self):
+        """Records from many threads get batched and sent"""
+        print(FCN_FMT % function_name())
+        handler = log_handler.ZmqLogHandler(self.endpoint, batch_size=50,
+                                            host='sensor')
+        self.logger.addHandler(handler)
+
+        def log_some(name):
+            for ndx in range(100):
+                self.logger.warning('%s reads %d', name, ndx)
+
+        threads = [threading.Thread(target=log_some, args=('t%d' % ndx,))
+                   for ndx in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        handler.flush()
+        self.logger.info('filtered out')
+        self.logger.error('last')
+        handler.close()
+        self.logger.removeHandler(handler)
+
+        logs = self.receive(401)
+        self.assertEqual(len(logs), 401)
+        self.assertFalse(self.pull.poll(100))
+        name = self.logger.name
+        self.assertEqual(logs[-1], 'sensor ERROR %s: last' % name)
+        self.assertEqual([log for log in logs if ' t2 ' in log],
+                         ['sensor WARNING %s: t2 reads %d' % (name, ndx)
+                          for ndx in range(100)])
+        self.assertTrue(handler.report().startswith(
+                'handler dropped:0 batches:'))
+
+    def test_unicode(self):
+        """Unicode records get sent as UTF-8 and the thread lives on"""
+        print(FCN_FMT % function_name())
+        handler = log_handler.ZmqLogHandler(self.endpoint, batch_size=2,
+                                            host='sensor')
+        self.logger.addHandler(handler)
+        self.logger.warning(u'caf\xe9 %s', u'\u2603')
+        self.logger.warning('plain')
+        self.logger.warning(u'x')
+        handler.flush()
+        self.assertTrue(handler.thread.is_alive())
+
+        # A batch that fails to send gets dropped and counted.
+        flow_send = handler.flow.send
+        def fail_send(frames, count):
+            handler.flow.send = flow_send
+            raise zmq.ZMQError(zmq.EINVAL)
+        handler.flow.send = fail_send
+        self.logger.warning('lost')
+        handler.flush()
+        self.logger.warning('after')
+        handler.close()
+        self.logger.removeHandler(handler)
+        self.assertFalse(handler.thread.is_alive())
+
+        name = self.logger.name
+        self.assertEqual(self.receive(4),
+                [u'sensor WARNING %s: caf\xe9 \u2603'.encode('utf-8') % name,
+                 'sensor WARNING %s: plain' % name,
+                 'sensor WARNING %s: x' % name,
+                 'sensor WARNING %s: after' % name])
+        self.assertTrue(handler.report().endswith(' errors:1'))
+
+    def test_queue_full(self):
+        """With no server a full queue drops instead of blocking"""
+        print(FCN_FMT % function_name())
+        handler = log_handler.ZmqLogHandler(
+                'ipc:///tmp/no_log_server', batch_size=1, queue_max=10,
+                sndhwm=1, linger_ms=0, close_timeout_ms=100)
+        self.logger.addHandler(handler)
+        start = time.time()
+        for ndx in range(1000):
+            self.logger.warning('%d', ndx)
+        self.assertTrue(time.time() - start < 1.0)
+        self.assertTrue(handler.drop_count >= 900)
+        handler.close()
+        self.logger.removeHandler(handler)
+        self.assertFalse(handler.thread.is_alive())
+
+
+class ReliableTest(unittest.TestCase):
+    """
+    Test acks, resends and dropping repeated logs with --reliable.
+    """
+
+    def send_reliable(self, server, argv, lost=0):
+        """Send from log_client set up by argv to server,
+        losing the lost-th message. Answers the flow."""
+        params = log_client.process_cmd_line(str_to_argv(
+                '--endpoint=%s --reliable=true %s' % (server.endpoint, argv)))
+        context = zmq.Context()
+        socket = log_client.connect_socket(context, params)
+        flow, batcher = log_client.make_senders(
+                LossySocket(socket, lost), params, 'host')
+        for ndx in range(params['count']):
+            batcher.send('%d' % ndx)
+        batcher.flush()
+        flow.flush()
+        socket.close()
+        context.term()
+        return flow
+
+    def test_reliable(self):
+        """Every log gets acked once written"""
+        print(FCN_FMT % function_name())
+        with log_fixture.LogServerFixture('--reliable=true') as server:
+            flow = self.send_reliable(server, '--count=2000 --batch-size=20')
+            self.assertEqual(flow.sent_count, 2000)
+            self.assertEqual(flow.unacked_logs, 0)
+            # Acked means written, so nothing is left to wait for.
+            self.assertEqual(len(server.lines()), 2000)
+            stats = json.loads(server.command('stats'))
+            self.assertEqual(stats['records_received'], 2000)
+            self.assertTrue(0 < stats['acks_sent'] <= 100)
+            self.assertEqual(stats['records_duplicated'], 0)
+
+    def test_ack_after_flush(self):
+        """Logs get flushed before they get acked"""
+        print(FCN_FMT % function_name())
+        with log_fixture.LogServerFixture(
+                '--reliable=true --flush-every-n=0 '
+                '--flush-interval-ms=600000') as server:
+            flow = self.send_reliable(server, '--count=500 --batch-size=50')
+            self.assertEqual(flow.sent_count, 500)
+            # Read while the server runs, with no interval flush due.
+            self.assertEqual(len(server.lines()), 500)
+            stats = json.loads(server.command('stats'))
+            self.assertTrue(0 < stats['flushes'] <= stats['acks_sent'])
+
+    def test_resend(self):
+        """A lost batch and those after it get sent again in order"""
+        print(FCN_FMT % function_name())
+        with log_fixture.LogServerFixture('--reliable=true') as server:
+            flow = self.send_reliable(
+                    server, '--count=100 --batch-size=10 --window=30 '
+                    '--ack-timeout-ms=100', lost=2)
+            self.assertEqual(flow.sent_count, 100)
+            self.assertTrue(flow.resend_count >= 1)
+            self.assertEqual([line.split()[-1] for line in server.lines()],
+                             [str(ndx) for ndx in range(100)])
+            stats = json.loads(server.command('stats'))
+            self.assertTrue(stats['batches_early'] >= 1)
+            self.assertEqual(stats['records_received'], 100)
+
+    def test_restart(self):
+        """A new server waits for the oldest log not acked"""
+        print(FCN_FMT % function_name())
+        with log_fixture.LogServerFixture('--reliable=true') as server:
+            # As after a restart that lost the first batch, a
+            # later one arrives first. It must not get acked.
+            flow = self.send_reliable(
+                    server, '--count=100 --batch-size=10 '
+                    '--ack-timeout-ms=100', lost=1)
+            self.assertEqual(flow.sent_count, 100)
+            self.assertEqual([line.split()[-1] for line in server.lines()],
+                             [str(ndx) for ndx in range(100)])
+            stats = json.loads(server.command('stats'))
+            self.assertTrue(stats['batches_early'] >= 1)
+            self.assertEqual(stats['records_missing'], 0)
+
+        with log_fixture.LogServerFixture('--reliable=true') as server:
+            context = zmq.Context()
+            dealer = context.socket(zmq.DEALER)
+            dealer.connect(server.endpoint)
+
+            def send(first, unacked):
+                dealer.send_multipart(log_wire.add_unacked(
+                        log_wire.encode_batch(
+                            ['host %d' % ndx
+                             for ndx in range(first, first + 10)],
+                            sequence=(7, first)), unacked))
+                return log_wire.decode_ack(dealer.recv())
+            # Logs 0 to 9 were acked by the old server.
+            self.assertEqual(send(20, 10), (7, 10))
+            self.assertEqual(send(10, 10), (7, 20))
+            self.assertEqual(send(20, 10), (7, 30))
+            dealer.close()
+            context.term()
+            self.assertEqual([line.split()[-1] for line in server.lines()],
+                             [str(ndx) for ndx in range(10, 30)])
+            stats = json.loads(server.command('stats'))
+            self.assertEqual(stats['records_missing'], 0)
+            self.assertEqual(stats['records_duplicated'], 0)
+
+    def test_duplicate(self):
+        """Logs the server already has get acked, not written"""
+        print(FCN_FMT % function_name())
+        with log_fixture.LogServerFixture('--reliable=true') as server:
+            context = zmq.Context()
+            dealer = context.socket(zmq.DEALER)
+            dealer.connect(server.endpoint)
+            frames = log_wire.encode_batch(['host %d' % ndx
+                                            for ndx in range(10)],
+                                           sequence=(7, 0))
+            dealer.send_multipart(frames)
+            self.assertEqual(log_wire.decode_ack(dealer.recv()), (7, 10))
+            dealer.send_multipart(frames)
+            self.assertEqual(log_wire.decode_ack(dealer.recv()), (7, 10))
+            dealer.close()
+            context.term()
+            self.assertEqual(len(server.lines()), 10)
+            stats = json.loads(server.command('stats'))
+            self.assertEqual(stats['records_duplicated'], 10)
+
+    def test_reliable_params(self):
+        """--reliable needs a server that writes as it receives"""
+        print(FCN_FMT % function_name())
+        params = log_client.process_cmd_line(
+                ['--reliable=true', '--window=500', '--ack-timeout-ms=50'])
+        self.assertTrue(params['reliable'])
+        self.assertEqual(params['window'], 500)
+        self.assertEqual(params['ack_timeout_ms'], 50)
+        with self.assertRaises(SystemExit) as err:
+            log_client.process_cmd_line(['--window=0'])
+        self.assertEqual(err.exception.code, 1)
+        self.assertTrue(log_server.process_cmd_line(
+                ['--reliable=true'])['reliable'])
+        with self.assertRaises(SystemExit) as err:
+            log_server.process_cmd_line(['--reliable=true', '--async=true'])
+        self.assertEqual(err.exception.code, 1)
+
+
+class ControlTest(unittest.TestCase):
+    """
+    Test the control socket commands.
+    """
+
+    filename = '/tmp/control_test.log'
+
+    def tearDown(self):
+        for name in glob.glob(self.filename + '*'):
+            os.remove(name)
+
+    def test_control_commands(self):
+        """Commands arrive out of band and exit writes everything"""
+        print(FCN_FMT % function_name())
+        params = log_server.process_cmd_line(str_to_argv(
+            '--log=%s --log-append=false --flush-every-n=0 '
+            '--control=inproc://control' % self.filename))
+        self.assertEqual(params['control'], 'inproc://control')
+        context = zmq.Context()
+        pull = context.socket(zmq.PULL)
+        pull.bind('inproc://control_data')
+        control = context.socket(zmq.REP)
+        control.bind(params['control'])
+        writer = log_server.make_writer(
+                log_server.open_log_file_for_writing(params),
+                params, context)
+        receiver = log_server.make_receiver(pull, params)
+        self.assertFalse(receiver.inband)
+        server = threading.Thread(target=log_server.serve,
+                args=(receiver, writer, control))
+        server.start()
+
+        push = context.socket(zmq.PUSH)
+        push.connect('inproc://control_data')
+        push.send('host a log with %s in it' % log_server.EXIT_SERVER)
+        for ndx in range(100):
+            push.send('host %d' % ndx)
+
+        def command(request):
+            return log_control.send_control(params['control'],
+                    request, context=context)
+        self.assertEqual(command('flush'), 'ok')
+        self.assertTrue(command('bogus').startswith('error'))
+        self.assertEqual(command('exit'), 'ok')
+        server.join()
+        writer.close()
+        self.assertEqual(receiver.msg_count, 101)
+        self.assertEqual(len(open(self.filename).readlines()), 101)
+
+        stats = json.loads(log_server.control_command(
+                'stats', receiver, writer))
+        self.assertEqual(stats['msgs_received'], 101)
+        self.assertEqual(stats['msgs_written'], 101)
+        self.assertEqual(stats['write_seconds']['count'], writer.write_count)
+        self.assertEqual(stats['recv_seconds']['count'],
+                         stats['format_seconds']['count'])
+
+        for sock in [pull, push, control]:
+            sock.close(linger=0)
+        context.term()
+
+    def test_drain(self):
+        """Drain replies once the logs are written and flushed"""
+        print(FCN_FMT % function_name())
+        params = log_server.process_cmd_line(str_to_argv(
+            '--log=%s --log-append=false --flush-every-n=0 --pipeline=true '
+            '--control=inproc://drain_control' % self.filename))
+        context = zmq.Context()
+        pull = context.socket(zmq.PULL)
+        pull.bind('inproc://drain_data')
+        control = context.socket(zmq.REP)
+        control.bind(params['control'])
+        writer = log_server.make_writer(
+                log_server.open_log_file_for_writing(params),
+                params, context)
+        receiver = log_server.make_receiver(pull, params)
+        server = threading.Thread(target=log_server.serve,
+                args=(receiver, writer, control))
+        server.start()
+
+        def drain(records, timeout):
+            return log_control.drain_server(params['control'], records,
+                                            timeout, context)
+        # Nothing sent yet, so the drain times out.
+        stats = drain(10, 50)
+        self.assertFalse(stats['drained'])
+        self.assertEqual(stats['records_received'], 0)
+
+        push = context.socket(zmq.PUSH)
+        push.connect('inproc://drain_data')
+        sender = threading.Thread(target=lambda:
+                [push.send('host %d' % ndx) for ndx in range(1000)])
+        sender.start()
+        stats = drain(1000, 5000)
+        self.assertTrue(stats['drained'])
+        self.assertEqual(stats['msgs_written'], 1000)
+        self.assertEqual(len(open(self.filename).readlines()), 1000)
+        sender.join()
+        self.assertTrue(log_control.send_control(params['control'],
+                'drain x', context=context).startswith('error'))
+        self.assertEqual(log_control.send_control(params['control'],
+                'exit', context=context), 'ok')
+        server.join()
+        writer.close()
+
+        for sock in [pull, push, control]:
+            sock.close(linger=0)
+        context.term()
+
+    def test_client_control_param(self):
+        """The client builds the control endpoint from its host"""
+        print(FCN_FMT % function_name())
+        params = log_client.process_cmd_line(
+                ['--control-port=5557', '--host=pi1'])
+        self.assertEqual(params['control'], 'tcp://pi1:5557')
+
+
+class AsyncServerTest(unittest.TestCase):
+    """
+    Test the event loop server mode.
+    """
+
+    filename = '/tmp/async_test.log'
+
+    def tearDown(self):
+        for name in glob.glob(self.filename + '*'):
+            os.remove(name)
+
+    def test_timers(self):
+        """Timer tasks run at their interval until stopped"""
+        print(FCN_FMT % function_name())
+        loop = log_server_async.EventLoop()
+        ticks = []
+        def tick():
+            ticks.append(time.time())
+            if len(ticks) == 3:
+                loop.stop()
+        start = time.time()
+        loop.call_every(0.01, tick)
+        loop.run()
+        self.assertEqual(len(ticks), 3)
+        self.assertTrue(ticks[-1] - start >= 0.03)
+
+    def test_async_server(self):
+        """Two endpoints, timed flushes and exit on command"""
+        print(FCN_FMT % function_name())
+        params = log_server.process_cmd_line(str_to_argv(
+            '--log=%s --log-append=false --async=true '
+            '--flush-every-n=0 --flush-interval-ms=10 '
+            '--control=inproc://async_control' % self.filename))
+        context = zmq.Context()
+        sockets = []
+        pushes = []
+        for ndx in range(2):
+            pull = context.socket(zmq.PULL)
+            pull.bind('inproc://async%d' % ndx)
+            push = context.socket(zmq.PUSH)
+            push.connect('inproc://async%d' % ndx)
+            sockets.append(pull)
+            pushes.append(push)
+        control = context.socket(zmq.REP)
+        control.bind(params['control'])
+        server = log_server_async.AsyncServer(params, context,
+                                              sockets, control)
+        thread = threading.Thread(target=server.run)
+        thread.start()
+
+        for ndx in range(50):
+            pushes[ndx % 2].send('host %d' % ndx)
+        time.sleep(0.1)
+        self.assertTrue(server.writer.writer.flush_count >= 1)
+        self.assertEqual(len(open(self.filename).readlines()), 50)
+        stats = json.loads(log_control.send_control(params['control'],
+                'stats', context=context))
+        self.assertEqual(stats['msgs_received'], 50)
+        pushes[0].send('host last')
+        stats = log_control.drain_server(params['control'], 51, 5000,
+                                         context)
+        self.assertTrue(stats['drained'])
+        self.assertEqual(len(open(self.filename).readlines()), 51)
+        self.assertEqual(log_control.send_control(params['control'],
+                'exit', context=context), 'ok')
+        thread.join()
+        self.assertEqual(len(open(self.filename).readlines()), 51)
+
+        for sock in sockets + pushes + [control]:
+            sock.close(linger=0)
+        context.term()
+
+
+class ShardTest(unittest.TestCase):
+    """
+    Test the shard naming, forwarding and merging used by --workers,
+    and a --workers server end to end.
+    """
+
+    filename = '/tmp/shard_test.log'
+
+    def tearDown(self):
+        for name in glob.glob(self.filename + '*'):
+            os.remove(name)
+
+    def test_workers_param(self):
+        """--workers must be a positive integer"""
+        print(FCN_FMT % function_name())
+        params = log_server.process_cmd_line(['--workers=4'])
+        self.assertEqual(params['workers'], 4)
+        with self.assertRaises(SystemExit) as err:
+            log_server.process_cmd_line(['--workers=0'])
+        self.assertEqual(err.exception.code, 1)
+
+    def test_merge_shards(self):
+        """Shards and their rotated segments merge into a
+        single time ordered log"""
+        print(FCN_FMT % function_name())
+        shards = [log_server.shard_filename(self.filename, shard)
+                  for shard in range(2)]
+        self.assertEqual(shards[1], self.filename + '.shard01')
+        with open(shards[0], 'w') as handle:
+            handle.write('2017-12-09 10:00:01 a 0\n'
+                         '2017-12-09 10:00:03 a 1\n')
+        with gzip.open(shards[1] + '.20171209-100001.gz', 'wb') as handle:
+            handle.write('2017-12-09 10:00:00 b 0\n')
+        with open(shards[1] + '.20171209-100002', 'w') as handle:
+            handle.write('2017-12-09 10:00:02 b 1\n')
+        with open(shards[1], 'w') as handle:
+            handle.write('2017-12-09 10:00:04 b 2\n')
+        with open(self.filename, 'w') as handle:
+            log_server.merge_shards(shards, handle)
+        lines = open(self.filename).read().splitlines()
+        self.assertEqual([line.split(' ', 2)[2] for line in lines],
+                ['b 0', 'a 0', 'b 1', 'a 1', 'b 2'])
+
+        # Binary shards merge into text lines.
+        for name in glob.glob(self.filename + '*'):
+            os.remove(name)
+        base_ns = 1512813600 * 10 ** 9
+        with open(shards[0], 'wb') as handle:
+            handle.write(log_server.pack_record(base_ns + 1000, 'a 0'))
+        with open(shards[1] + '.20171209-100000', 'wb') as handle:
+            handle.write(log_server.pack_record(base_ns, 'b 0'))
+        with open(shards[1], 'wb') as handle:
+            handle.write(log_server.pack_record(base_ns + 2000, 'b 1'))
+        with open(self.filename, 'w') as handle:
+            log_server.merge_shards(shards, handle, 'binary')
+        lines = open(self.filename).read().splitlines()
+        self.assertEqual([line.split(' ', 2)[2] for line in lines],
+                ['b 0', 'a 0', 'b 1'])
+
+    def test_forward_batch(self):
+        """Batches go round robin to the backends"""
+        print(FCN_FMT % function_name())
+        context = zmq.Context()
+        frontend = context.socket(zmq.PULL)
+        frontend.bind('inproc://forward_front')
+        push = context.socket(zmq.PUSH)
+        push.connect('inproc://forward_front')
+        backends = []
+        pulls = []
+        for ndx in range(2):
+            backend = context.socket(zmq.PUSH)
+            backend.bind('inproc://forward_back%d' % ndx)
+            pull = context.socket(zmq.PULL)
+            pull.connect('inproc://forward_back%d' % ndx)
+            backends.append(backend)
+            pulls.append(pull)
+
+        push.send('first')
+        frontend.poll(1000)
+        next_backend = log_server.forward_batch(frontend, backends, 0, 10)
+        self.assertEqual(next_backend, 1)
+        push.send('second')
+        frontend.poll(1000)
+        next_backend = log_server.forward_batch(frontend, backends,
+                next_backend, 10)
+        self.assertEqual(next_backend, 0)
+        self.assertEqual(pulls[0].recv(), 'first')
+        self.assertEqual(pulls[1].recv(), 'second')
+
+        for sock in backends + pulls + [frontend, push]:
+            sock.close(linger=0)
+        context.term()
+
+    def test_workers_end_to_end(self):
+        """log_server --workers=2 with rotation logs every
+        record once"""
+        print(FCN_FMT % function_name())
+        count = 2000
+        work_dir = tempfile.mkdtemp(prefix='shard_test_')
+        try:
+            log_filename = os.path.join(work_dir, 'workers.log')
+            endpoint = 'ipc://%s/data' % work_dir
+            control = 'ipc://%s/control' % work_dir
+            server = subprocess.Popen(
+                    [sys.executable, LOG_SERVER_NAME, '--workers=2',
+                     '--log=%s' % log_filename, '--bind=%s' % endpoint,
+                     '--control=%s' % control, '--rotate-bytes=4096'],
+                    stdout=subprocess.PIPE)
+            self.assertTrue(log_control.send_control(control, 'stats',
+                                                     timeout=10000))
+            client = subprocess.Popen(
+                    [sys.executable, LOG_CLIENT_NAME, '--count=%d' % count,
+                     '--batch-size=10', '--endpoint=%s' % endpoint],
+                    stdout=subprocess.PIPE)
+            client.communicate()
+            self.assertEqual(client.returncode, 0)
+            drained = json.loads(log_control.send_control(control,
+                    'drain %d 10000' % count, timeout=15000))
+            self.assertTrue(drained['drained'])
+            self.assertEqual(log_control.send_control(control, 'exit',
+                                                      timeout=15000), 'ok')
+            server.communicate()
+            self.assertEqual(server.returncode, 0)
+
+            streams = log_query.find_streams(log_filename)
+            self.assertEqual(len(streams), 2)
+            self.assertTrue(min([len(files) for files in streams]) > 1)
+            params = log_query.process_cmd_line(['--log=%s' % log_filename])
+            lines = list(log_query.query(params))
+            numbers = sorted([int(line.split(' ', 4)[3].rstrip(':'))
+                              for line in lines])
+            self.assertEqual(numbers, range(count))
+            merged = os.path.join(work_dir, 'merged.log')
+            with open(merged, 'w') as handle:
+                log_server.merge_shards(
+                        [log_server.shard_filename(log_filename, shard)
+                         for shard in range(2)], handle)
+            self.assertEqual(open(merged).readlines(), lines)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+class BenchTest(unittest.TestCase):
+    """
+    Test the benchmark sweep and baseline comparison.
+    """
+
+    def test_sweep(self):
+        """Every combination of the swept settings gets a run"""
+        print(FCN_FMT % function_name())
+        params = log_bench.process_cmd_line(
+                ['--sizes=16,256', '--clients=1,4', '--batch-sizes=100',
+                 '--transports=ipc', '--flush=none'])
+        runs = list(log_bench.runs(params))
+        self.assertEqual(len(runs), 4)
+        self.assertEqual(log_bench.run_key(runs[0]),
+                'size=16 clients=1 batch_size=100 transport=ipc flush=none')
+        with self.assertRaises(SystemExit) as err:
+            log_bench.process_cmd_line(['--transports=udp'])
+        self.assertEqual(err.exception.code, 1)
+        self.assertEqual(log_bench.process_cmd_line(
+                ['--count=500', '--repeat=3'])['count'], 500)
+        for arg in ['--count=500,1000', '--repeat=0', '--repeat=x']:
+            with self.assertRaises(SystemExit) as err:
+                log_bench.process_cmd_line([arg])
+            self.assertEqual(err.exception.code, 1)
+
+    def test_wait_rusage(self):
+        """A failed process gets its real return code"""
+        print(FCN_FMT % function_name())
+        for code, expected in [('pass', 0), ('raise SystemExit(4)', 4),
+                ('import os, signal; os.kill(os.getpid(), signal.SIGTERM)',
+                 -signal.SIGTERM)]:
+            proc = subprocess.Popen([sys.executable, '-c', code])
+            rusage = log_bench.wait_rusage(proc)
+            self.assertEqual(proc.returncode, expected)
+            self.assertTrue(rusage.ru_utime >= 0.0)
+
+    def test_compare(self):
+        """Slower, higher latency or lossier runs regress"""
+        print(FCN_FMT % function_name())
+        base = {'size': 16, 'clients': 1, 'batch_size': 1,
+                'transport': 'tcp', 'flush': 'every',
+                'records_per_sec': 1000.0, 'p99': 0.01, 'lost': 0}
+        same = dict(base, records_per_sec=950.0, p99=0.0105)
+        self.assertEqual(log_bench.compare([same], [base], 0.1), [])
+        worse = dict(base, records_per_sec=800.0, p99=0.02, lost=3)
+        self.assertEqual(len(log_bench.compare([worse], [base], 0.1)), 3)
+        other = dict(worse, size=256)
+        self.assertEqual(log_bench.compare([other], [base], 0.1), [])
+        self.assertEqual(log_bench.median_run([worse, base, same]), same)
+        # Latency does not get measured with batch size 1.
+        plain = dict(base, p99=None)
+        self.assertEqual(log_bench.compare([plain], [base], 0.1), [])
+        self.assertEqual(log_bench.compare([base], [plain], 0.1), [])
+
+    def test_server_stops_answering(self):
+        """A server that stops answering ends the wait"""
+        print(FCN_FMT % function_name())
+        replies = ['{"records_received": 5}', None]
+        send_control = log_bench.send_control
+        log_bench.send_control = lambda control, command: replies.pop(0)
+        try:
+            self.assertEqual(log_bench.wait_for_records('ipc://none', 10),
+                             (None, None))
+        finally:
+            log_bench.send_control = send_control
+
+
+class LogQueryTest(unittest.TestCase):
+    """
+    Test time range queries over logs, segments and shards.
+    """
+
+    filename = '/tmp/log_query_test.log'
+
+    def tearDown(self):
+        for name in glob.glob(self.filename + '*'):
+            os.remove(name)
+
+    def write_log(self, filename, minutes, host='a'):
+        """Write a line a minute past 10:00 for each of minutes."""
+        with open(filename, 'w') as handle:
+            for minute in minutes:
+                handle.write('2017-12-09 10:%02d:00.500000 %s at %d\n' %
+                        (minute, host, minute))
+
+    def test_parse_time(self):
+        """--start and --end accept several time formats"""
+        print(FCN_FMT % function_name())
+        self.assertEqual(log_query.parse_time('2017-12-09 10:02').minute, 2)
+        self.assertEqual(
+                log_query.parse_time('2017-12-09 10:02:30.25').microsecond,
+                250000)
+        with self.assertRaises(SystemExit) as err:
+            log_query.process_cmd_line(['--start=yesterday'])
+        self.assertEqual(err.exception.code, 1)
+
+    def test_text_range(self):
+        """Binary search finds the range in a text log"""
+        print(FCN_FMT % function_name())
+        self.write_log(self.filename, range(0, 60))
+        params = log_query.process_cmd_line([
+            '--log=%s' % self.filename,
+            '--start=2017-12-09 10:02', '--end=2017-12-09 10:05'])
+        lines = list(log_query.query(params))
+        self.assertEqual([line.split(' ', 2)[2] for line in lines],
+                ['a at 2\n', 'a at 3\n', 'a at 4\n'])
+        params['start'] = params['end'] = None
+        self.assertEqual(len(list(log_query.query(params))), 60)
+
+    def test_segments_and_shards(self):
+        """Rotated segments, compressed segments and shards
+        all get searched and merged in time order"""
+        print(FCN_FMT % function_name())
+        self.write_log(self.filename + '.20171209-100200', [0, 1])
+        self.write_log(self.filename + '.20171209-100400', [2, 3])
+        with open(self.filename + '.20171209-100400', 'rb') as src:
+            gz = gzip.open(self.filename + '.20171209-100400.gz', 'wb')
+            gz.write(src.read())
+            gz.close()
+        os.remove(self.filename + '.20171209-100400')
+        self.write_log(self.filename, [4, 5])
+        self.write_log(self.filename + '.shard01.20171209-100250', [2],
+                       host='b')
+        self.write_log(self.filename + '.shard01', [3, 4], host='b')
+
+        params = log_query.process_cmd_line([
+            '--log=%s' % self.filename,
+            '--start=2017-12-09 10:01', '--end=2017-12-09 10:05'])
+        lines = [line.split(' ', 2)[2].strip()
+                 for line in log_query.query(params)]
+        # The rotated shard segment belongs to the shard only.
+        self.assertEqual(lines,
+                ['a at 1', 'a at 2', 'b at 2', 'a at 3', 'b at 3',
+                 'a at 4', 'b at 4'])
+
+        params['host'] = 'b'
+        params['contains'] = ' 4'
+        lines = [line.split(' ', 2)[2].strip()
+                 for line in log_query.query(params)]
+        self.assertEqual(lines, ['b at 4'])
+
+    def test_binary_range(self):
+        """The side index finds the range in a binary log"""
+        print(FCN_FMT % function_name())
+        params = log_server.process_cmd_line(str_to_argv(
+            '--log=%s --log-append=false --format=binary --index-every=7' %
+            self.filename))
+        writer = log_server.LogWriter(
+                log_server.open_log_file_for_writing(params), params)
+        start = log_query.parse_time('2017-12-09 10:00')
+        writer.write_batch([log_segment.pack_record(
+            log_query.time_to_ns(start) + minute * 60 * 10**9,
+            'a at %d' % minute) for minute in range(60)])
+        writer.close()
+
+        params = log_query.process_cmd_line([
+            '--log=%s' % self.filename, '--format=binary',
+            '--start=2017-12-09 10:20', '--end=2017-12-09 10:23'])
+        lines = [line.split(' ', 2)[2] for line in log_query.query(params)]
+        self.assertEqual(lines, ['a at 20\n', 'a at 21\n', 'a at 22\n'])
+
+
 class LogClientCmdLineTest(unittest.TestCase):
     """
     Test the various options available from the command